@@ -0,0 +1,306 @@
+"""
+Microbenchmarks of the CapsNet building blocks and of the whole LaneCapsNet on synthetic data: throughput, latency
+percentiles, peak memory and number of parameters of `CapsuleLayer`, `PrimaryCap`, `Lane` and `LaneCapsNet` over a
+sweep of their hyperparameters. Every case runs in its own process, so peak memory is the case's own. Peak activation
+memory is the peak of the TensorFlow CPU allocator during the measured steps, above what was allocated before them.
+The first step of every case, which traces its function (and compiles it with XLA), is reported apart. Results are
+written as JSON and can be compared against a stored baseline to catch regressions. `--recompute_report` compares the
+training cases that recompute routing with the same cases that do not, `--xla_report` the cases compiled with XLA with
+the same cases run op by op.
+
+Usage:
+    python benchmark.py --output bench.json --save_baseline baseline.json
+    python benchmark.py --output bench.json --baseline baseline.json --tolerance 0.1
+    python benchmark.py --filter 'capsule_layer' --quick
+    python benchmark.py --filter 'recompute' --recompute_report
+    python benchmark.py --filter 'lane_capsnet' --quick --xla_report
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+# Input shape and number of classes of the datasets loaded by capsnet.py
+SHAPES = {'mnist': ((28, 28, 1), 10), 'cifar': ((32, 32, 3), 100)}
+
+
+def cases(quick=False):
+    """
+    The benchmark cases, as dicts with a unique `name`, the `kind` of block and its hyperparameters.
+    """
+    sweep = {
+        'capsule_layer': {'num_capsule': [1, 10], 'routings': [1, 3, 5], 'routing_tol': [None, 0.01],
+                          'in_caps': [128, 512, 2048], 'batch': [32, 128]},
+        'capsule_layer_train': {'num_capsule': [1, 10], 'routings': [3], 'in_caps': [512, 2048], 'batch': [128],
+                                'recompute': [None, 'lane', 'iteration']},
+        'primary_cap': {'dataset': ['mnist', 'cifar'], 'lane_size': [1, 4, 8], 'batch': [32, 128]},
+        'lane': {'dataset': ['mnist', 'cifar'], 'lane_size': [1, 4, 8], 'lane_depth': [1, 2], 'batch': [32],
+                 'xla': [False, True]},
+        'lane_capsnet': {'dataset': ['mnist', 'cifar'], 'num_lanes': [2, 8, 32], 'lane_size': [1, 4],
+                         'lane_depth': [1, 2], 'batch': [32], 'fused': [False, True], 'recompute': [None, 'lane'],
+                         'xla': [False, True]},
+    }
+    if quick:
+        sweep = {
+            'capsule_layer': {'num_capsule': [10], 'routings': [1, 3], 'in_caps': [128, 512], 'batch': [32]},
+            'capsule_layer_train': {'num_capsule': [10], 'routings': [3], 'in_caps': [512], 'batch': [32],
+                                    'recompute': [None, 'lane', 'iteration']},
+            'primary_cap': {'dataset': ['mnist'], 'lane_size': [1, 4], 'batch': [32]},
+            'lane': {'dataset': ['mnist'], 'lane_size': [1, 4], 'lane_depth': [1, 2], 'batch': [32]},
+            'lane_capsnet': {'dataset': ['mnist', 'cifar'], 'num_lanes': [2, 8], 'lane_size': [1], 'lane_depth': [1],
+                             'batch': [32], 'xla': [False, True]},
+        }
+    for kind, grid in sweep.items():
+        for values in itertools.product(*grid.values()):
+            params = dict(zip(grid.keys(), values))
+            # A single capsule has no routing iterations to recompute
+            if params.get('recompute') == 'iteration' and params.get('num_capsule') == 1:
+                continue
+            name = kind + '/' + ','.join('%s=%s' % (k, v) for k, v in params.items())
+            yield dict(params, name=name, kind=kind)
+
+
+def build(case):
+    """
+    Build the model of a case and its synthetic inputs.
+    :return: model, inputs, step where `step(inputs)` runs the measured computation once
+    """
+    import tensorflow as tf
+    from tensorflow.keras import layers, models
+    from capslayer import CapsuleLayer, PrimaryCap
+    from capsnet import Lane, LaneCapsNet, margin_loss
+
+    kind, batch = case['kind'], case['batch']
+    if kind == 'capsule_layer_train':
+        # One backward pass through the digit capsules, with respect to their inputs and weights
+        num_capsule = case['num_capsule']
+        x = layers.Input(shape=(case['in_caps'], 16))
+        model = models.Model(x, CapsuleLayer(num_capsule=num_capsule, dim_capsule=10 if num_capsule == 1 else 16,
+                                             routings=case['routings'], recompute=case['recompute'])(x))
+
+        @tf.function
+        def gradients(inputs):
+            with tf.GradientTape() as tape:
+                tape.watch(inputs)
+                loss = tf.reduce_sum(tf.square(model(inputs, training=True)))
+            return tape.gradient(loss, [inputs] + model.trainable_variables)
+        inputs = tf.constant(np.random.rand(batch, case['in_caps'], 16).astype(np.float32))
+        return model, inputs, lambda x: [g.numpy() for g in gradients(x)]
+    elif kind == 'capsule_layer':
+        # Digit capsules from 16D primary capsules: one capsule of n_class dimensions like a lane, or the n_class
+        # 16D capsules of the original CapsNet
+        num_capsule = case['num_capsule']
+        x = layers.Input(shape=(case['in_caps'], 16))
+        model = models.Model(x, CapsuleLayer(num_capsule=num_capsule, dim_capsule=10 if num_capsule == 1 else 16,
+                                             routings=case['routings'], routing_tol=case.get('routing_tol'))(x))
+        inputs = np.random.rand(batch, case['in_caps'], 16).astype(np.float32)
+    elif kind == 'primary_cap':
+        # The primary capsules of the first level of a lane, on top of its conv1
+        input_shape, _ = SHAPES[case['dataset']]
+        conv_shape = (input_shape[0] - 8, input_shape[1] - 8, case['lane_size'] * 16)
+        x = layers.Input(shape=conv_shape)
+        primarycaps = PrimaryCap(x, dim_capsule=16, n_channels=case['lane_size'] * 2, kernel_size=6, strides=2,
+                                 padding='valid')
+        model = models.Model(x, primarycaps)
+        inputs = np.random.rand(batch, *conv_shape).astype(np.float32)
+    elif kind == 'lane':
+        input_shape, n_class = SHAPES[case['dataset']]
+        x = layers.Input(shape=input_shape)
+        model = models.Model(x, Lane(0, n_class, case['lane_size'], 1, x, 3, stacked=case['lane_depth']))
+        inputs = np.random.rand(batch, *input_shape).astype(np.float32)
+    else:
+        # One training step of the whole model, decoder included
+        input_shape, n_class = SHAPES[case['dataset']]
+        model, _, _ = LaneCapsNet(input_shape, n_class, 3, num_lanes=case['num_lanes'], lanesize=case['lane_size'],
+                                  lanedepth=case['lane_depth'], gpus=0, fused=case.get('fused', False),
+                                  recompute=case.get('recompute'))
+        model.compile(optimizer='adam', loss=[margin_loss, 'mse'], loss_weights=[1., 0.392],
+                      jit_compile=case.get('xla', False))
+        x = np.random.rand(batch, *input_shape).astype(np.float32)
+        y = np.eye(n_class, dtype=np.float32)[np.random.randint(n_class, size=batch)]
+        return model, ((x, y), (y, x)), lambda data: model.train_on_batch(*data)
+
+    predict = tf.function(lambda x: model(x, training=False), jit_compile=case.get('xla', False))
+    return model, inputs, lambda x: predict(x).numpy()
+
+
+def run_case(case, warmup, iterations):
+    """
+    Measure one case in this process.
+    """
+    import tensorflow as tf
+
+    model, inputs, step = build(case)
+    # Tracing, and compiling with XLA
+    begin = time.perf_counter()
+    step(inputs)
+    first_step = time.perf_counter() - begin
+    for _ in range(warmup - 1):
+        step(inputs)
+    tf.config.experimental.reset_memory_stats('CPU:0')
+    allocated = tf.config.experimental.get_memory_info('CPU:0')['current']
+    latencies = []
+    for _ in range(iterations):
+        begin = time.perf_counter()
+        step(inputs)
+        latencies.append(time.perf_counter() - begin)
+    latencies = np.array(latencies)
+    return dict(case, params=int(model.count_params()), first_step=first_step,
+                throughput=case['batch'] / float(np.mean(latencies)),
+                latency_mean=float(np.mean(latencies)),
+                latency_p50=float(np.percentile(latencies, 50)),
+                latency_p90=float(np.percentile(latencies, 90)),
+                latency_p99=float(np.percentile(latencies, 99)),
+                # ru_maxrss is in kilobytes on Linux
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+                peak_activation_mb=(tf.config.experimental.get_memory_info('CPU:0')['peak'] - allocated) / 2. ** 20)
+
+
+def run_isolated(case, warmup, iterations):
+    """
+    Measure one case in a new process.
+    :return: the results of the case, None if it failed
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case),
+               '--warmup', str(warmup), '--iterations', str(iterations)]
+    completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if completed.returncode != 0:
+        print('Case %s failed:\n%s' % (case['name'], completed.stderr[-2000:]))
+        return None
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+# Metric: True if higher is better
+METRICS = {'throughput': True, 'latency_p50': False, 'latency_p99': False, 'peak_rss_mb': False,
+           'peak_activation_mb': False}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results against baseline results of the same cases.
+    :param tolerance: relative change of a metric tolerated before it is a regression
+    :return: list of (case name, metric, baseline value, value) of the regressions
+    """
+    base = {result['name']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        if result['name'] not in base:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if metric not in base[result['name']]:
+                # Not measured by the baseline
+                continue
+            old, new = base[result['name']][metric], result[metric]
+            if (higher_is_better and new < old * (1 - tolerance)) or \
+                    (not higher_is_better and new > old * (1 + tolerance)):
+                regressions.append((result['name'], metric, old, new))
+    return regressions
+
+
+def option_report(results, option, metrics):
+    """
+    Some metrics of every case with an option on (recomputation, XLA) against the same case with it off.
+    :return: list of dicts with the case name without the option, the option, and the metrics of both cases, those of
+        the case with the option on prefixed with `{option}_`
+    """
+    def key(result):
+        return re.sub(r',?%s=[^,]*' % option, '', result['name'])
+
+    stored = {key(result): result for result in results if option in result and not result[option]}
+    report = []
+    for result in results:
+        if not result.get(option) or key(result) not in stored:
+            continue
+        base = stored[key(result)]
+        row = {'name': key(result), option: result[option]}
+        for metric in metrics:
+            row[metric], row[option + '_' + metric] = base[metric], result[metric]
+        report.append(row)
+    return report
+
+
+def environment():
+    import tensorflow as tf
+    return {'tensorflow': tf.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CapsNet microbenchmarks")
+    parser.add_argument('--output', default='benchmark.json',
+                        help="Write the results to this JSON file")
+    parser.add_argument('--baseline', default=None,
+                        help="Compare the results against this JSON file, exit with status 1 on regressions")
+    parser.add_argument('--save_baseline', default=None,
+                        help="Also write the results to this JSON file, as the new baseline")
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help="Relative change of a metric tolerated before it is a regression")
+    parser.add_argument('--filter', default=None,
+                        help="Only run the cases whose name matches this regular expression")
+    parser.add_argument('--quick', action='store_true',
+                        help="Run a smaller sweep")
+    parser.add_argument('--recompute_report', action='store_true',
+                        help="Compare the peak activation memory and latency of the cases recomputing routing with the "
+                             "same cases keeping its intermediates")
+    parser.add_argument('--xla_report', action='store_true',
+                        help="Compare the first step (tracing and compiling) and latency of the cases compiled with "
+                             "XLA with the same cases run op by op")
+    parser.add_argument('--warmup', default=3, type=int,
+                        help="Steps before the measured ones, the first one being reported as first_step")
+    parser.add_argument('--iterations', default=20, type=int)
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        # Child process of `run_isolated`: the results are the last line of stdout
+        print(json.dumps(run_case(json.loads(args.case), args.warmup, args.iterations)))
+        sys.exit(0)
+
+    results = []
+    for case in cases(args.quick):
+        if args.filter is not None and not re.search(args.filter, case['name']):
+            continue
+        result = run_isolated(case, args.warmup, args.iterations)
+        if result is None:
+            continue
+        results.append(result)
+        print('[MO833] Case,%s,Params,%d,Throughput,%.1f,P50,%.4f,P99,%.4f,Peak RSS,%.1f,Peak activations,%.1f' %
+              (result['name'], result['params'], result['throughput'], result['latency_p50'],
+               result['latency_p99'], result['peak_rss_mb'], result['peak_activation_mb']))
+
+    report = {'environment': environment(), 'results': results}
+    if args.recompute_report:
+        report['recompute'] = option_report(results, 'recompute', ['peak_activation_mb', 'latency_p50'])
+        for row in report['recompute']:
+            print('[MO833] Recompute,%s,Mode,%s,Peak activations,%.1f,%.1f,P50,%.4f,%.4f' %
+                  (row['name'], row['recompute'], row['peak_activation_mb'], row['recompute_peak_activation_mb'],
+                   row['latency_p50'], row['recompute_latency_p50']))
+    if args.xla_report:
+        report['xla'] = option_report(results, 'xla', ['first_step', 'latency_p50'])
+        for row in report['xla']:
+            print('[MO833] XLA,%s,First step,%.4f,%.4f,P50,%.4f,%.4f' %
+                  (row['name'], row['first_step'], row['xla_first_step'], row['latency_p50'], row['xla_latency_p50']))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, metric, old, new in regressions:
+            print('Regression in %s: %s %.4f -> %.4f' % (name, metric, old, new))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against %s' % args.baseline)
@@ -19,9 +19,11 @@ class Length(layers.Layer):
     Using this layer as model's output can directly predict labels by using `y_pred = np.argmax(model.predict(x), 1)`
     inputs: shape=[None, num_vectors, dim_vector]
     output: shape=[None, num_vectors]
+    Computed in float32 whatever the input type, as `squash`.
     """
     def call(self, inputs, **kwargs):
-        return tf.sqrt(tf.reduce_sum(tf.square(inputs), -1) + K.epsilon())
+        lengths = tf.sqrt(tf.reduce_sum(tf.square(tf.cast(inputs, tf.float32)), -1) + K.epsilon())
+        return tf.cast(lengths, inputs.dtype)
 
     def compute_output_shape(self, input_shape):
         return input_shape[:-1]
@@ -59,7 +61,7 @@ class Mask(layers.Layer):
         # inputs.shape=[None, num_capsule, dim_capsule]
         # mask.shape=[None, num_capsule]
         # masked.shape=[None, num_capsule * dim_capsule]
-        masked = K.batch_flatten(inputs * tf.expand_dims(mask, -1))
+        masked = K.batch_flatten(inputs * tf.expand_dims(tf.cast(mask, inputs.dtype), -1))
         return masked
 
     def compute_output_shape(self, input_shape):
@@ -78,11 +80,110 @@ def squash(vectors, axis=-1):
     The non-linear activation used in Capsule. It drives the length of a large vector to near 1 and small vector to 0
     :param vectors: some vectors to be squashed, N-dim tensor
     :param axis: the axis to squash
-    :return: a Tensor with same shape as input vectors
+    :return: a Tensor with same shape and type as input vectors
     """
+    # Squared norms overflow float16 and epsilon underflows it, so reduced precision vectors are squashed in float32
+    dtype = vectors.dtype
+    vectors = tf.cast(vectors, tf.float32)
     s_squared_norm = tf.reduce_sum(tf.square(vectors), axis, keepdims=True)
     scale = s_squared_norm / (1 + s_squared_norm) / tf.sqrt(s_squared_norm + K.epsilon())
-    return scale * vectors
+    return tf.cast(scale * vectors, dtype)
+
+
+# Granularities of the recomputation of routing in the backward pass, see `CapsuleLayer`
+RECOMPUTE = (None, 'lane', 'iteration')
+
+
+def dynamic_routing(inputs_hat, routings, recompute=False):
+    """
+    Routing-by-agreement over the prediction vectors of a capsule layer. Any leading axes (batch, lanes, ...) are
+    treated as batch dimensions.
+    :param inputs_hat: prediction vectors, shape=[..., num_capsule, input_num_capsule, dim_capsule]
+    :param routings: number of routing iterations, should be > 0
+    :param recompute: if True, only the logits `b` between iterations are kept for the backward pass and the
+        intermediates of every iteration are recomputed from them
+    :return: output capsules, shape=[..., num_capsule, dim_capsule]
+    """
+    assert routings > 0, 'The routings should be > 0.'
+    if inputs_hat.shape[-3] == 1:
+        # With a single output capsule the coupling coefficients are all 1 whatever the agreement, so more iterations
+        # give the same outputs (and gradients)
+        routings = 1
+    # The prior for coupling coefficient, initialized as zeros.
+    # b.shape = [..., num_capsule, 1, input_num_capsule]
+    b = tf.zeros_like(tf.expand_dims(inputs_hat[..., 0], -2))
+
+    def iteration(b, inputs_hat):
+        # c.shape=[..., num_capsule, 1, input_num_capsule]
+        c = tf.nn.softmax(b, axis=-3)
+
+        # matmal: [input_num_capsule] x [input_num_capsule, dim_capsule] -> [dim_capsule].
+        # outputs.shape=[..., num_capsule, 1, dim_capsule]
+        return squash(tf.matmul(c, inputs_hat))
+
+    def agreement(b, inputs_hat):
+        # matmal: [dim_capsule] x [input_num_capsule, dim_capsule]^T -> [input_num_capsule].
+        # b.shape=[..., num_capsule, 1, input_num_capsule]
+        return b + tf.matmul(iteration(b, inputs_hat), inputs_hat, transpose_b=True)
+
+    if recompute:
+        iteration, agreement = tf.recompute_grad(iteration), tf.recompute_grad(agreement)
+    # The outputs of the iterations before the last are only needed through b
+    for i in range(routings - 1):
+        b = agreement(b, inputs_hat)
+    return tf.squeeze(iteration(b, inputs_hat), axis=-2)
+
+
+def adaptive_routing(inputs_hat, routings, tolerance, recompute=False):
+    """
+    Routing-by-agreement that stops early, as soon as no coupling coefficient changed by more than `tolerance` since
+    the previous iteration. The whole batch stops at the same iteration, so it stays a single graph loop, and it is
+    differentiable.
+    :param inputs_hat: prediction vectors, shape=[..., num_capsule, input_num_capsule, dim_capsule]
+    :param routings: maximum number of routing iterations, should be > 0
+    :param tolerance: largest change of the coupling coefficients considered as converged
+    :param recompute: if True, the intermediates of every iteration are recomputed in the backward pass, as in
+        `dynamic_routing`
+    :return: output capsules, shape=[..., num_capsule, dim_capsule], and the number of iterations done
+    """
+    assert routings > 0, 'The routings should be > 0.'
+    if inputs_hat.shape[-3] == 1:
+        # Converged from the start, see `dynamic_routing`
+        return dynamic_routing(inputs_hat, 1, recompute), tf.constant(1)
+    # b.shape = c.shape = [..., num_capsule, 1, input_num_capsule]
+    b = tf.zeros_like(tf.expand_dims(inputs_hat[..., 0], -2))
+    # outputs.shape=[..., num_capsule, 1, dim_capsule]
+    outputs = tf.zeros_like(inputs_hat[..., :1, :])
+
+    def converged(i, b, c_prev, outputs, delta):
+        return delta > tolerance
+
+    def step(b, inputs_hat):
+        c = tf.nn.softmax(b, axis=-3)
+        outputs = squash(tf.matmul(c, inputs_hat))
+        return c, outputs, b + tf.matmul(outputs, inputs_hat, transpose_b=True)
+
+    if recompute:
+        step = tf.recompute_grad(step)
+
+    def iteration(i, b, c_prev, outputs, delta):
+        if recompute:
+            c, outputs, agreed = step(b, inputs_hat)
+        else:
+            c = tf.nn.softmax(b, axis=-3)
+            outputs = squash(tf.matmul(c, inputs_hat))
+            # The last iteration does not need the agreement
+            agreed = tf.cond(i < routings - 1, lambda: b + tf.matmul(outputs, inputs_hat, transpose_b=True),
+                             lambda: b)
+        delta = tf.cond(i > 0, lambda: tf.cast(tf.reduce_max(tf.abs(c - c_prev)), tf.float32),
+                        lambda: tf.constant(float('inf')))
+        return i + 1, agreed, c, outputs, delta
+
+    iterations, _, _, outputs, _ = tf.while_loop(converged, iteration,
+                                                 (tf.constant(0), b, tf.zeros_like(b), outputs,
+                                                  tf.constant(float('inf'))),
+                                                 maximum_iterations=routings)
+    return tf.squeeze(outputs, axis=-2), iterations
 
 
 class CapsuleLayer(layers.Layer):
@@ -95,14 +196,33 @@ class CapsuleLayer(layers.Layer):
     :param num_capsule: number of capsules in this layer
     :param dim_capsule: dimension of the output vectors of the capsules in this layer
     :param routings: number of iterations for the routing algorithm
+    :param implementation: 'batched' computes the prediction vectors of the whole batch with a single einsum,
+        'map_fn' is the original per-sample `tf.map_fn` version. Both use the same weights.
+    :param routing_tol: if not None, routing stops early when the coupling coefficients change by less than this, with
+        `routings` as maximum, and the number of iterations is reported as the metric `{name}_routings`. Only used by
+        the batched implementation.
+    :param recompute: trade compute for activation memory in training, only used by the batched implementation.
+        'lane' keeps only the inputs of the layer for the backward pass and recomputes the prediction vectors and the
+        whole routing from them, 'iteration' keeps the prediction vectors and the logits between routing iterations and
+        recomputes the intermediates of each iteration, None keeps everything. A single capsule routes in one iteration,
+        so 'iteration' needs num_capsule > 1
     """
     def __init__(self, num_capsule, dim_capsule, routings=3,
                  kernel_initializer='glorot_uniform',
+                 implementation='batched',
+                 routing_tol=None,
+                 recompute=None,
                  **kwargs):
         super(CapsuleLayer, self).__init__(**kwargs)
+        assert implementation in ('batched', 'map_fn'), "implementation should be 'batched' or 'map_fn'"
+        assert recompute in RECOMPUTE, "recompute should be one of %s" % (RECOMPUTE,)
+        assert recompute != 'iteration' or num_capsule > 1, "a single capsule has no routing iterations to recompute"
         self.num_capsule = num_capsule
         self.dim_capsule = dim_capsule
         self.routings = routings
+        self.implementation = implementation
+        self.routing_tol = routing_tol
+        self.recompute = recompute
         self.kernel_initializer = initializers.get(kernel_initializer)
 
     def build(self, input_shape):
@@ -119,6 +239,31 @@ class CapsuleLayer(layers.Layer):
         self.built = True
 
     def call(self, inputs, training=None):
+        if self.implementation == 'map_fn':
+            return self._call_map_fn(inputs)
+
+        iterations = []
+
+        def capsules(inputs):
+            # W.shape=[num_capsule, input_num_capsule, dim_capsule, input_dim_capsule]
+            # inputs.shape=[None, input_num_capsule, input_dim_capsule]
+            # inputs_hat.shape=[None, num_capsule, input_num_capsule, dim_capsule]
+            inputs_hat = tf.einsum('jiok,bik->bjio', self.W, inputs)
+
+            # outputs.shape=[None, num_capsule, dim_capsule]
+            recompute = self.recompute == 'iteration'
+            if self.routing_tol is None:
+                return dynamic_routing(inputs_hat, self.routings, recompute)
+            outputs, done = adaptive_routing(inputs_hat, self.routings, self.routing_tol, recompute)
+            iterations.append(done)
+            return outputs
+
+        outputs = tf.recompute_grad(capsules)(inputs) if self.recompute == 'lane' else capsules(inputs)
+        if self.routing_tol is not None:
+            self.add_metric(tf.cast(iterations[0], tf.float32), name=self.name + '_routings', aggregation='mean')
+        return outputs
+
+    def _call_map_fn(self, inputs):
         # inputs_expand.shape=[None, 1, input_num_capsule, input_dim_capsule]
         inputs_expand = tf.expand_dims(tf.expand_dims(inputs, 1), -1)
 
@@ -171,12 +316,260 @@ class CapsuleLayer(layers.Layer):
         config = {
             'num_capsule': self.num_capsule,
             'dim_capsule': self.dim_capsule,
-            'routings': self.routings
+            'routings': self.routings,
+            'implementation': self.implementation,
+            'routing_tol': self.routing_tol,
+            'recompute': self.recompute
         }
         base_config = super(CapsuleLayer, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
 
+def _per_lane(initializer):
+    """
+    Wrap an initializer so that a weight of shape=[num_lanes, ...] is initialized lane by lane, with the same fan-in and
+    fan-out as the per-lane layers it replaces.
+    """
+    initializer = initializers.get(initializer)
+
+    def init(shape, dtype=None):
+        # A new instance per lane: an unseeded initializer returns the same values every time it is called
+        return tf.stack([initializer.__class__.from_config(initializer.get_config())(shape[1:], dtype=dtype)
+                         for _ in range(shape[0])])
+    return init
+
+
+class FusedLanes(layers.Layer):
+    """
+    All the lanes of a LaneCapsNet computed together. Each stage (conv, primary capsules, routing) runs as one grouped
+    convolution or one batched op over a lane axis instead of `num_lanes` separate subgraphs. Every weight has a leading
+    lane axis and groups never mix lanes, so the lanes stay independent exactly like the per-lane `Lane` layers.
+    inputs: shape=[None, width, height, channels]
+    output: shape=[None, n_class, num_lanes], the same as the concatenated lanes of LaneCapsNet
+
+    :param num_lanes: number of lanes
+    :param n_class: number of classes, the dimension of each lane's digit capsule
+    :param lanesize: size of the lanes, as in `Lane`
+    :param lanedepth: depth of the lanes, as in `Lane`
+    :param routings: number of iterations for the routing algorithm
+    :param lane_dropout: fraction of lanes dropped per batch during training. The dropped lanes are chosen before the
+        lanes run and only the kept lanes' weights are gathered, so dropped lanes cost no forward or backward compute.
+        The kept lanes are scaled by num_lanes/num_kept and the dropped ones are zeros.
+    :param routing_tol: if not None, routing stops early as in `CapsuleLayer`, all the lanes together, and the number of
+        iterations is reported as the metric `{name}_routings`
+    :param recompute: 'lane' keeps only the input images for the backward pass and recomputes the convolutions,
+        primary capsules and routing of all the lanes together. Every lane routes to a single capsule in one iteration,
+        so there is no 'iteration' mode
+    """
+    def __init__(self, num_lanes, n_class, lanesize=1, lanedepth=1, routings=3, lane_dropout=0.,
+                 kernel_initializer='glorot_uniform',
+                 routing_tol=None,
+                 recompute=None,
+                 **kwargs):
+        super(FusedLanes, self).__init__(**kwargs)
+        self.num_lanes = num_lanes
+        self.n_class = n_class
+        self.lanesize = lanesize
+        self.lanedepth = lanedepth
+        self.routings = routings
+        self.lane_dropout = lane_dropout
+        self.routing_tol = routing_tol
+        assert recompute in (None, 'lane'), "recompute should be None or 'lane'"
+        self.recompute = recompute
+        self.kernel_initializer = initializers.get(kernel_initializer)
+        self.filters = lanesize * 16
+        self.dim_capsule = 16
+        self.n_channels = lanesize * 2
+
+    def build(self, input_shape):
+        assert len(input_shape) == 4, "The input Tensor should have shape=[None, width, height, channels]"
+        init = _per_lane(self.kernel_initializer)
+        caps_channels = self.dim_capsule * self.n_channels
+        in_channels = input_shape[3]
+        height, width = input_shape[1], input_shape[2]
+
+        self.conv_kernels, self.conv_biases = [], []
+        self.primary_kernels, self.primary_biases = [], []
+        input_num_capsule = 0
+        for d in range(self.lanedepth):
+            strides = 2 if d == 0 else 3
+            # conv1 output, then primary capsules output
+            height, width = height - 8, width - 8
+            height, width = (height - 6) // strides + 1, (width - 6) // strides + 1
+            self.conv_kernels.append(self.add_weight(shape=[self.num_lanes, 9, 9, in_channels, self.filters],
+                                                     initializer=init, name='conv_kernel_d%d' % d))
+            self.conv_biases.append(self.add_weight(shape=[self.num_lanes, self.filters],
+                                                    initializer='zeros', name='conv_bias_d%d' % d))
+            self.primary_kernels.append(self.add_weight(shape=[self.num_lanes, 6, 6, self.filters, caps_channels],
+                                                        initializer=init, name='primarycap_kernel_d%d' % d))
+            self.primary_biases.append(self.add_weight(shape=[self.num_lanes, caps_channels],
+                                                       initializer='zeros', name='primarycap_bias_d%d' % d))
+            num_capsule = height * width * self.n_channels
+            input_num_capsule += num_capsule
+            # Stacked lanes convolve the previous capsules as a [num_capsule, dim_capsule, 1] image
+            in_channels = 1
+            height, width = num_capsule, self.dim_capsule
+
+        # Transform matrix of every lane's digit capsule layer
+        self.W = self.add_weight(shape=[self.num_lanes, 1, input_num_capsule, self.n_class, self.dim_capsule],
+                                 initializer=init, name='W')
+
+        self.built = True
+
+    def _grouped_conv(self, inputs, kernel, bias, strides):
+        # kernel.shape=[num_lanes, k, k, in_channels, filters] -> [k, k, in_channels, num_lanes*filters]
+        # Output channels of lane l are [l*filters, (l+1)*filters), one group per lane.
+        _, k, _, in_channels, _ = kernel.shape
+        kernel = tf.reshape(tf.transpose(kernel, [1, 2, 3, 0, 4]), [k, k, in_channels, -1])
+        outputs = tf.nn.conv2d(inputs, kernel, strides=strides, padding='VALID')
+        return tf.nn.bias_add(outputs, tf.reshape(bias, [-1]))
+
+    def _to_capsules(self, outputs, num_lanes):
+        # outputs.shape=[None, h, w, num_lanes*caps_channels] -> [None, num_lanes, num_capsule, dim_capsule]
+        shape = tf.shape(outputs)
+        outputs = tf.reshape(outputs, [shape[0], shape[1], shape[2], num_lanes, -1])
+        outputs = tf.transpose(outputs, [0, 3, 1, 2, 4])
+        return squash(tf.reshape(outputs, [shape[0], num_lanes, -1, self.dim_capsule]))
+
+    def call(self, inputs, training=None):
+        if self.lane_dropout == 0:
+            outputs, iterations = self._all_lanes(inputs)
+        else:
+            outputs, iterations = K.in_train_phase(lambda: self._dropout_lanes(inputs),
+                                                   lambda: self._all_lanes(inputs), training=training)
+        if self.routing_tol is not None:
+            self.add_metric(tf.cast(iterations, tf.float32), name=self.name + '_routings', aggregation='mean')
+        return outputs
+
+    def _all_lanes(self, inputs):
+        return self._lanes(inputs, self.conv_kernels, self.conv_biases, self.primary_kernels, self.primary_biases,
+                           self.W, self.num_lanes)
+
+    def _dropout_lanes(self, inputs):
+        num_kept = max(1, self.num_lanes - int(round(self.lane_dropout * self.num_lanes)))
+        # kept.shape=[num_kept], the lanes that run in this batch
+        kept = tf.sort(tf.random.shuffle(tf.range(self.num_lanes))[:num_kept])
+
+        def gather(weights):
+            return [tf.gather(w, kept) for w in weights]
+
+        # outputs.shape=[None, n_class, num_kept]
+        outputs, iterations = self._lanes(inputs, gather(self.conv_kernels), gather(self.conv_biases),
+                              gather(self.primary_kernels), gather(self.primary_biases),
+                              tf.gather(self.W, kept), num_kept)
+
+        # Scatter the kept lanes back to their positions, dropped lanes are zeros
+        # outputs.shape=[None, n_class, num_lanes]
+        outputs = tf.transpose(outputs, [2, 0, 1])
+        outputs = tf.scatter_nd(tf.expand_dims(kept, -1), outputs,
+                                tf.stack([self.num_lanes, tf.shape(outputs)[1], self.n_class]))
+        return tf.transpose(outputs, [1, 2, 0]) * (self.num_lanes / num_kept), iterations
+
+    def _lanes(self, inputs, conv_kernels, conv_biases, primary_kernels, primary_biases, W, num_lanes):
+        if self.recompute != 'lane':
+            return self._compute_lanes(inputs, conv_kernels, conv_biases, primary_kernels, primary_biases, W,
+                                       num_lanes)
+        iterations = []
+        depth = self.lanedepth
+
+        def lanes(inputs, *weights):
+            outputs, done = self._compute_lanes(inputs, *[list(weights[i * depth:(i + 1) * depth]) for i in range(4)],
+                                                weights[-1], num_lanes)
+            iterations.append(done)
+            return outputs
+
+        # Only the input images are kept for the backward pass, the convolutions, primary capsules and routing of the
+        # lanes are recomputed. The weights are arguments, not captured, as the dropped lanes' are gathers
+        outputs = tf.recompute_grad(lanes)(inputs, *conv_kernels, *conv_biases, *primary_kernels, *primary_biases, W)
+        return outputs, iterations[0]
+
+    def _compute_lanes(self, inputs, conv_kernels, conv_biases, primary_kernels, primary_biases, W, num_lanes):
+        primarycaps = []
+        outputs = inputs
+        for d in range(self.lanedepth):
+            if d > 0:
+                # [None, num_lanes, num_capsule, dim_capsule] -> [None, num_capsule, dim_capsule, num_lanes]
+                outputs = tf.transpose(primarycaps[-1], [0, 2, 3, 1])
+            outputs = tf.nn.relu(self._grouped_conv(outputs, conv_kernels[d], conv_biases[d], strides=1))
+            outputs = self._grouped_conv(outputs, primary_kernels[d], primary_biases[d], strides=2 if d == 0 else 3)
+            primarycaps.append(self._to_capsules(outputs, num_lanes))
+
+        # allprimarycaps.shape=[None, num_lanes, input_num_capsule, dim_capsule]
+        allprimarycaps = primarycaps[0] if self.lanedepth == 1 else tf.concat(primarycaps, axis=2)
+
+        # inputs_hat.shape=[None, num_lanes, 1, input_num_capsule, n_class]
+        inputs_hat = tf.einsum('ljiok,blik->bljio', W, allprimarycaps)
+
+        # digitcaps.shape=[None, num_lanes, 1, n_class]
+        if self.routing_tol is None:
+            digitcaps, iterations = dynamic_routing(inputs_hat, self.routings), tf.constant(self.routings)
+        else:
+            digitcaps, iterations = adaptive_routing(inputs_hat, self.routings, self.routing_tol)
+
+        # digitcaps.shape=[None, num_lanes, n_class] -> [None, n_class, num_lanes]
+        digitcaps = tf.squeeze(digitcaps, axis=2)
+        return tf.transpose(digitcaps, [0, 2, 1]), iterations
+
+    def _lane_layers(self, model, laneID):
+        for d in range(self.lanedepth):
+            yield (d, model.get_layer('conv1' + str(laneID) + 'd' + str(d)),
+                   model.get_layer('primarycap_conv2d' + str(laneID + 1000*d)))
+
+    def load_lane_weights(self, model):
+        """
+        Copy the weights of a per-lane LaneCapsNet (layers `conv1{i}d{d}`, `primarycap_conv2d{i}` and `digitcaps{i}`)
+        into this layer, so checkpoints of the per-lane model can be used with the fused one.
+        """
+        conv_kernels = [[] for _ in range(self.lanedepth)]
+        conv_biases = [[] for _ in range(self.lanedepth)]
+        primary_kernels = [[] for _ in range(self.lanedepth)]
+        primary_biases = [[] for _ in range(self.lanedepth)]
+        W = []
+        for i in range(self.num_lanes):
+            for d, conv, primary in self._lane_layers(model, i):
+                kernel, bias = conv.get_weights()
+                conv_kernels[d].append(kernel)
+                conv_biases[d].append(bias)
+                kernel, bias = primary.get_weights()
+                primary_kernels[d].append(kernel)
+                primary_biases[d].append(bias)
+            W.append(model.get_layer('digitcaps' + str(i)).get_weights()[0])
+
+        for d in range(self.lanedepth):
+            self.conv_kernels[d].assign(np.stack(conv_kernels[d]))
+            self.conv_biases[d].assign(np.stack(conv_biases[d]))
+            self.primary_kernels[d].assign(np.stack(primary_kernels[d]))
+            self.primary_biases[d].assign(np.stack(primary_biases[d]))
+        self.W.assign(np.stack(W))
+
+    def store_lane_weights(self, model):
+        """
+        The inverse of `load_lane_weights`: write the weights of every lane back into a per-lane LaneCapsNet.
+        """
+        for i in range(self.num_lanes):
+            for d, conv, primary in self._lane_layers(model, i):
+                conv.set_weights([self.conv_kernels[d][i].numpy(), self.conv_biases[d][i].numpy()])
+                primary.set_weights([self.primary_kernels[d][i].numpy(), self.primary_biases[d][i].numpy()])
+            model.get_layer('digitcaps' + str(i)).set_weights([self.W[i].numpy()])
+
+    def compute_output_shape(self, input_shape):
+        return tuple([input_shape[0], self.n_class, self.num_lanes])
+
+    def get_config(self):
+        config = {
+            'num_lanes': self.num_lanes,
+            'n_class': self.n_class,
+            'lanesize': self.lanesize,
+            'lanedepth': self.lanedepth,
+            'routings': self.routings,
+            'lane_dropout': self.lane_dropout,
+            'routing_tol': self.routing_tol,
+            'recompute': self.recompute
+        }
+        base_config = super(FusedLanes, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
 def PrimaryCap(inputs, dim_capsule, n_channels, kernel_size, strides, padding, i = 0):
     """
     Apply Conv2D `n_channels` times and concatenate all capsules
@@ -1,3 +1,7 @@
+import time
+# Startup begins before the imports
+initial_time = time.time()
+
 import numpy as np
 from tensorflow.keras import layers, models, optimizers
 from tensorflow.keras.layers import concatenate, Permute, Lambda
@@ -6,37 +10,57 @@ from tensorflow.keras.utils import to_categorical
 from tensorflow.keras.utils import custom_object_scope
 from tensorflow.keras import regularizers
 from tensorflow.keras import callbacks
-from PIL import Image
-import random
-import scipy
 from capslayer import *
+from pipeline import train_dataset, eval_dataset, InputWait
+import checkpoint
+from coordination import make_coordinator
+from evaluation import evaluate, report
+from gradsync import BatchBalancer, SyncedModel, SyncReport
+from costmodel import DATASETS, parse_lane_layout
+import datacache
+from profiling import ProfilerTrigger
+from telemetry import RoutingIterations, RunningStats, StartupTimer, Telemetry, significant_digit
 import json
-import time
 
 import os
 import argparse
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from tensorflow.keras import callbacks
-import json
+import csv
+import resource
 #from tensorflow.keras.utils import multi_gpu_model
 
-initial_time = 0
-iteration_begin = 0
 epoch_begin = 0
 total_epochs = 0
 node = 0
+num_workers = 1
 epoch_cur = 0
-time_iterations = []
-stad_deviation_digit = 0
-digit_pos = 0
-training = True
-metrics = {}
+startup = None
+
+# Custom objects needed to deserialize a LaneCapsNet
+CUSTOM_OBJECTS = {"CapsuleLayer": CapsuleLayer, "FusedLanes": FusedLanes, "Mask": Mask, "Length": Length}
+
+METRICS_KEYS = ['id', 'last_iteration', 'last_epoch', 'num_epoch', 'average', 'standard_deviation']
 
 class CustomCallback(callbacks.Callback):
-        
+    """
+    Stop training once the iteration time of every node has stabilized: every 10 batches the first significant digit
+    of the standard deviation of the iteration times (and its position) is compared with the previous check, and a
+    node has finished when it did not change. Iteration times are kept as streaming statistics.
+    """
+
+    def __init__(self, coordinator, save_dir='result'):
+        super(CustomCallback, self).__init__()
+        self.coordinator = coordinator
+        self.save_dir = save_dir
+        self.iterations = RunningStats()
+        self.digit = None
+        self.training = True
+        self.metrics = {}
+
     def on_train_begin(self, logs=None):
         initialization_time = time.time() - initial_time
         print(f"[MO833] Rank,{node},Initialization Time: {initialization_time}")
+        if startup is not None and not startup.done:
+            startup.lap('setup')
 
     def on_epoch_begin(self, epoch, logs=None):
         global epoch_cur
@@ -50,83 +74,52 @@ class CustomCallback(callbacks.Callback):
         print(f"\n[MO833] Rank,{node},Epoch,{epoch},Epoch time,{epoch_end:.4f},Elapsed time,{elapsed_time:.4f}")
 
     def on_train_batch_begin(self, batch, logs=None):
-        global iteration_begin
-        iteration_begin = time.time() 
+        self.iteration_begin = time.time()
 
     def on_train_batch_end(self, batch, logs=None):
-        global stad_deviation_digit
-        global stad_deviation_count
-        global digit_pos
-        global training
-        global metrics
-        iteration_end = time.time() - iteration_begin
-        elapsed_time = time.time() - initial_time
-        # Calculate average and standard deviation each 10 iterations
+        iteration_end = time.time() - self.iteration_begin
+        if startup is not None and not startup.done:
+            # Tracing and the first run of the train function
+            startup.lap('first_step')
+            startup.report(node, self.save_dir)
+        # Check the standard deviation each 10 iterations
         if (batch + 1) % 10 == 0:
-            average = sum(time_iterations)/len(time_iterations)
-            stad_deviation = sum([((x - average) ** 2) for x in time_iterations]) / len(time_iterations)
-            stad_deviation = stad_deviation ** 0.5
-            print('\nStandard_deviation:',str(stad_deviation), ', Average:', average)
-            # Find first not zero digit
-            digit = stad_deviation
-            if not training and node == 0:
-                # Verify if all nodes finish training
-                tf_config = json.loads(os.environ['TF_CONFIG'])
-                result_files = os.listdir('result/')
-                total_nodes = len(tf_config['cluster']['worker'])
-                stop_traning = True
-                for i in range(1, total_nodes):
-                    if ('metrics-'+ str(i)+'.json') not in result_files:
-                        stop_traning = False
-                        break
-                if stop_traning:
-                    for i in range(1, total_nodes):
-                        os.system('scp ubuntu@'+ (tf_config['cluster']['worker'])[i].split(':')[0] + ':~/lanes-capsnet/result/* ~/lanes-capsnet/result/')
-                    with open('result/metrics-'+str(node)+'.json', 'w') as outfile:
-                        json.dump(metrics, outfile)   
-                    exit()
-            if digit != 0:
-                digit_pos_nw = 0
-                while((int(digit*10))%10 == 0):
-                    digit = digit*10
-                    digit_pos_nw = digit_pos_nw + 1 
-                digit = int(digit*10)
-                if (digit == stad_deviation_digit and digit_pos_nw == digit_pos):
+            if self.training and self.iterations.std != 0:
+                digit = significant_digit(self.iterations.std)
+                if digit == self.digit:
                     # Finish node
-                    #Write metrics
-                    metrics['node'] = []
-                    metrics['node'].append({
+                    self.metrics = {
                         'id' : node,
                         'last_iteration': batch + 1,
                         'last_epoch': epoch_cur,
-                        'num_epoch': total_epochs,
-                        'average': average,
-                        'standard_deviation': stad_deviation
-                    }) 
-                    if (node == 0):                         
-                        # Finish training
-                        training = False
-                    elif training:
-                        # Write metrics in JSON file
-                        with open('result/metrics-'+str(node)+'.json', 'w') as outfile:
-                            json.dump(metrics, outfile)
-                        # Send metrics to node 0
-                        tf_config = json.loads(os.environ['TF_CONFIG'])
-                        res = 1
-                        while res != 0:
-                            res = os.system('scp result/metrics-'+str(node)+'.json ubuntu@'+ (tf_config['cluster']['worker'])[0].split(':')[0] + ':~/lanes-capsnet/result/')
-                        # Finish training
-                        training = False
+                        'num_epoch': self.params['epochs'],
+                        'average': self.iterations.mean,
+                        'standard_deviation': self.iterations.std
+                    }
+                    self.training = False
                 else:
-                    stad_deviation_digit = digit
-                    digit_pos = digit_pos_nw
+                    self.digit = digit
+            # All nodes agree in the same step whether every one of them has finished
+            stop_training, node_metrics = self.coordinator.agree(
+                node, not self.training, [self.metrics.get(key, 0) for key in METRICS_KEYS[1:]])
+            if stop_training:
+                metrics = {'node': [{'id': i,
+                                     'last_iteration': int(values[0]),
+                                     'last_epoch': int(values[1]),
+                                     'num_epoch': int(values[2]),
+                                     'average': float(values[3]),
+                                     'standard_deviation': float(values[4])}
+                                    for i, values in enumerate(node_metrics)]}
+                with open(self.save_dir + '/metrics-' + str(node) + '.json', 'w') as outfile:
+                    json.dump(metrics, outfile)
+                self.model.stop_training = True
         elif batch != 0:
-            time_iterations.append(iteration_end)    
-        print(f"\n[MO833] Rank,{node},Epoch,{epoch_cur},Iteration,{batch},It. time,{iteration_end:.4f},Elapsed time,{elapsed_time:.4f}")
+            self.iterations.add(iteration_end)
 
 K.set_image_data_format('channels_last')
 
-def Lane(laneID, n_class, lanesize, lanetype, lane_input, routings, stacked = 1):
+def Lane(laneID, n_class, lanesize, lanetype, lane_input, routings, stacked = 1, implementation = 'batched',
+         routing_tol = None, recompute = None):
     primarycaps = []
     output = layers.Conv2D(filters=lanesize*16, kernel_size=9, strides=1, padding='valid', activation='relu', name='conv1'+str(laneID)+'d0')(lane_input)
     primarycaps = primarycaps + [PrimaryCap(output, dim_capsule=16, n_channels=lanesize*2, kernel_size=6, strides=2, padding='valid', i = laneID)]
@@ -141,25 +134,63 @@ def Lane(laneID, n_class, lanesize, lanetype, lane_input, routings, stacked = 1)
     else:
         allprimarycaps = Lambda(lambda ls : concatenate(ls, axis=1))(primarycaps)
 
-    digitcaps = CapsuleLayer(num_capsule=1, dim_capsule=n_class, routings=routings, name='digitcaps'+str(laneID))(allprimarycaps)
+    digitcaps = CapsuleLayer(num_capsule=1, dim_capsule=n_class, routings=routings, implementation=implementation,
+                             routing_tol=routing_tol, recompute=recompute,
+                             name='digitcaps'+str(laneID))(allprimarycaps)
 
     return digitcaps
 
 
-def LaneCapsNet(input_shape, n_class, routings, num_lanes = 4, lanesize = 1, lanedepth = 1, lanetype = 1, gpus = 1):
-    x = layers.Input(shape=input_shape, batch_size=args.batch_size)
+def Decoder(input_shape, n_class, num_lanes):
+    """
+    The decoder of LaneCapsNet: from the masked digit capsules, shape=[None, n_class*num_lanes], to the reconstructed
+    image.
+    """
+    decoder = models.Sequential(name='decoder')
+    decoder.add(layers.Dense(512, activation='relu', input_dim=num_lanes*n_class))
+    decoder.add(layers.Dense(1024, activation='relu'))
+    decoder.add(layers.Dense(np.prod(input_shape), activation='sigmoid'))
+    decoder.add(layers.Reshape(target_shape=input_shape, name='out_recon'))
+    return decoder
+
+
+def LaneCapsNet(input_shape, n_class, routings, num_lanes = 4, lanesize = 1, lanedepth = 1, lanetype = 1, gpus = 1,
+                caps_impl = 'batched', fused = False, lane_dropout = 0., batch_size = None, dropout = 0.,
+                routing_tol = None, lane_ids = None, lane_layout = None, recompute = None):
+    # Lanes of their own size and depth, (lanesize, lanedepth) of every lane
+    if lane_layout is None:
+        lane_layout = [(lanesize, lanedepth)] * num_lanes
+    num_lanes = len(lane_layout)
+    # Skipping the compute of dropped lanes needs the lanes fused
+    fused = fused or lane_dropout > 0
+    assert not fused or len(set(lane_layout)) == 1, 'Fused lanes all have the same size and depth'
+    lanesize, lanedepth = lane_layout[0]
+    # A subset of the lanes keeps their layer names, so the weights of the full model still load by name
+    assert lane_ids is None or not fused, 'A subset of lanes cannot be fused'
+    lane_ids = list(range(num_lanes)) if lane_ids is None else list(lane_ids)
+    num_lanes = len(lane_ids)
+    x = layers.Input(shape=input_shape, batch_size=batch_size)
 
     lanes = []
-    for i in range(0, num_lanes):
+    for i in ([] if fused else lane_ids):
         if (gpus != 0):
             with tf.device("/gpu:%d" % (i % gpus)):
-                lanes = lanes + [Lane(i, n_class, lanesize, lanetype, x, routings, stacked = lanedepth)]
+                lanes = lanes + [Lane(i, n_class, lane_layout[i][0], lanetype, x, routings,
+                                      stacked = lane_layout[i][1], implementation = caps_impl,
+                                      routing_tol = routing_tol, recompute = recompute)]
         else:
-            lanes = lanes + [Lane(i, n_class, lanesize, lanetype, x, routings, stacked = lanedepth)]
-
-    digitcaps1 = Lambda(lambda ls : K.permute_dimensions(concatenate(ls, axis=1), [0,2,1]))(lanes)
+            lanes = lanes + [Lane(i, n_class, lane_layout[i][0], lanetype, x, routings, stacked = lane_layout[i][1],
+                                  implementation = caps_impl, routing_tol = routing_tol, recompute = recompute)]
+
+    if fused:
+        # All lanes as one grouped convolution and one batched routing over a lane axis
+        digitcaps1 = FusedLanes(num_lanes, n_class, lanesize=lanesize, lanedepth=lanedepth, routings=routings,
+                                lane_dropout=lane_dropout, routing_tol=routing_tol, recompute=recompute,
+                                name='fused_lanes')(x)
+    else:
+        digitcaps1 = Lambda(lambda ls : K.permute_dimensions(concatenate(ls, axis=1), [0,2,1]))(lanes)
 
-    digitcaps = layers.Dropout(args.dropout, (1, digitcaps1.get_shape()[2]))(digitcaps1)
+    digitcaps = layers.Dropout(dropout, (1, digitcaps1.get_shape()[2]))(digitcaps1)
 
     out_caps = Length(name='capsnet')(digitcaps)
 
@@ -170,21 +201,10 @@ def LaneCapsNet(input_shape, n_class, routings, num_lanes = 4, lanesize = 1, lan
 
     
     # Shared Decoder model in training and prediction
-    decoder = models.Sequential(name='decoder')
-    decoder.add(layers.Dense(512, activation='relu', input_dim=num_lanes*n_class))
-    decoder.add(layers.Dense(1024, activation='relu'))
-    decoder.add(layers.Dense(np.prod(input_shape), activation='sigmoid'))
-    decoder.add(layers.Reshape(target_shape=input_shape, name='out_recon'))
+    decoder = Decoder(input_shape, n_class, num_lanes)
 
-    # Models for training and evaluation (prediction)
+    # Models for training and evaluation (prediction), sharing their layers and weights
     train_model = models.Model([x, y], [out_caps, decoder(masked_by_y)])
-    # Retrieve the config
-    config = train_model.get_config()
-
-    # At loading time, register the custom objects with a `custom_object_scope`:
-    custom_objects = {"CapsuleLayer": CapsuleLayer, "Mask": Mask, "Length": Length}
-    with custom_object_scope(custom_objects):
-        train_model = models.Model.from_config(config)
     eval_model = models.Model(x, [out_caps, decoder(masked)])
 
     # manipulate model
@@ -195,73 +215,200 @@ def LaneCapsNet(input_shape, n_class, routings, num_lanes = 4, lanesize = 1, lan
 
     return train_model, eval_model, manipulate_model
 
+def load_weights(model, weights, args, input_shape, n_class):
+    """
+    Load `weights` into `model`. A fused model also accepts the weights of a per-lane model, whose lanes are copied
+    into the `fused_lanes` layer.
+    """
+    try:
+        model.load_weights(weights)
+    except ValueError:
+        if 'fused_lanes' not in [layer.name for layer in model.layers]:
+            raise
+        lane_model, _, _ = LaneCapsNet(input_shape=input_shape, n_class=n_class, routings=args.routings,
+                                       num_lanes=args.num_lanes, lanesize=args.lane_size, lanedepth=args.lane_depth,
+                                       lanetype=args.lane_type, gpus=0, batch_size=args.batch_size,
+                                       dropout=args.dropout, lane_layout=args.lane_layout)
+        lane_model.load_weights(weights)
+        model.get_layer('fused_lanes').load_lane_weights(lane_model)
+        model.get_layer('decoder').set_weights(lane_model.get_layer('decoder').get_weights())
+
 def margin_loss(y_true, y_pred):
     L = y_true * tf.square(tf.maximum(0., 0.9 - y_pred)) + \
             0.5 * (1 - y_true) * tf.square(tf.maximum(0., y_pred - 0.1))
     return tf.reduce_mean(tf.reduce_sum(L, 1))
 
+def logged_metrics(path, epoch):
+    """
+    The metrics of an epoch written to a CSVLogger log, {} if it was not logged.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        rows = [row for row in csv.DictReader(f) if row['epoch'] == str(epoch)]
+    return {key: float(value) for key, value in rows[-1].items() if key != 'epoch' and value != ''} if rows else {}
+
+
 def train(model, data, args, strategy, initial_epoch):
     # unpacking the data
     (x_train, y_train), (x_test, y_test) = data
+    n_class = model.outputs[0].shape[-1]
 
     # callbacks
-    log = callbacks.CSVLogger(args.save_dir + '/log.csv')
+    resume = args.load_dir is not None and os.path.isdir(args.load_dir)
+    # A resumed run, over one or two fits when resumed mid-epoch, adds to the history of the run it resumes
+    log = callbacks.CSVLogger(args.save_dir + '/log.csv', append=args.load_dir is not None)
     #checkpoint = callbacks.ModelCheckpoint(args.save_dir + 'weights-{epoch:02d}.h5', monitor='val_capsnet_acc',
     #                                       save_best_only=True, save_weights_only=True, verbose=1)
-    checkpoint = callbacks.ModelCheckpoint(args.save_dir + '/model-epoch-{epoch:02d}-node-'+ str(node) +'.h5', save_best_only=False, save_weights_only=False, mode='auto', save_freq=1, period=1, verbose=0)
     lr_decay = callbacks.LearningRateScheduler(schedule=lambda epoch: args.lr * (args.lr_decay ** epoch))
 
+    initial_step = 0
     with strategy.scope():
-        if args.load_dir is None:
-            model.compile(optimizer=optimizers.Adam(lr=args.lr),
+        if args.load_dir is None or resume:
+            # The legacy Adam applies each variable's update with one fused op, which traces much faster than the
+            # per-variable functions of the new optimizer
+            model.compile(optimizer=optimizers.legacy.Adam(learning_rate=args.lr),
                         loss=[margin_loss, 'mse'],
                         loss_weights=[1., args.lam_recon],
-                        metrics={'capsnet': 'accuracy'})
+                        metrics={'capsnet': 'accuracy'},
+                        jit_compile=args.xla)
+        if resume:
+            initial_epoch, initial_step = checkpoint.restore(model, args.load_dir)
+    if initial_step >= x_train.shape[0] // args.batch_size:
+        # Taken after the last batch of an epoch, before the end of the epoch
+        initial_epoch, initial_step = initial_epoch + 1, 0
+    if startup is not None:
+        startup.lap('compile')
+
+    # Snapshots written in the background, only the last ckpt_keep are kept
+    ckpt = checkpoint.AsyncCheckpoint(args.save_dir + '/checkpoints', every_steps=args.ckpt_steps,
+                                      every_secs=args.ckpt_secs, keep=args.ckpt_keep, rank=node,
+                                      initial_step=initial_step)
+
+    # Streamed input: every worker reads its own shard, shift-augmented and prefetched. With balanced batches every
+    # batch of a worker is of the size last agreed on, starting from an even share
+    input_wait = InputWait(rank=node)
+    local_batch = None
+    if args.balance_batches:
+        with tf.device('/cpu:0'):
+            local_batch = tf.Variable(args.batch_size // num_workers, dtype=tf.int64, trainable=False,
+                                      name='local_batch')
+    dataset = strategy.distribute_datasets_from_function(
+        lambda input_context: train_dataset(x_train, y_train, args.batch_size, shift_fraction=args.shift_fraction,
+                                            input_context=input_context, monitor=input_wait, n_class=n_class,
+                                            local_batch=local_batch))
+    steps_per_epoch = x_train.shape[0] // args.batch_size
 
-    # Training without data augmentation:
     total_epochs = epochs=args.epochs
-    model.fit((x_train, y_train), (y_train, x_train), batch_size=args.batch_size, epochs=args.epochs, initial_epoch=initial_epoch,
-              validation_data=((x_test, y_test), (y_test, x_test)), callbacks=[log, checkpoint, lr_decay, CustomCallback()],  workers=2, use_multiprocessing=True)
+    coordinator = make_coordinator(strategy, num_workers)
+    # Per-step phase timings, after the callbacks they read from
+    telemetry = Telemetry(args.save_dir, rank=node, input_wait=input_wait, checkpoint=ckpt)
+    sync_report = SyncReport(args.save_dir, rank=node, num_workers=num_workers)
+    train_callbacks = [input_wait, log, ckpt, telemetry, lr_decay, CustomCallback(coordinator, save_dir=args.save_dir)]
+    if isinstance(model, SyncedModel):
+        train_callbacks.insert(4, sync_report)
+    if isinstance(model, SyncedModel) and args.balance_batches:
+        # A worker trains on twice its even share at most, bounding its memory
+        train_callbacks.insert(1, BatchBalancer(coordinator, node, args.batch_size, local_batch,
+                                                max_batch=2 * args.batch_size // num_workers,
+                                                every=args.balance_batches))
+    if args.routing_tol is not None:
+        train_callbacks.append(RoutingIterations(args.save_dir, rank=node))
+    # Traces slow steps, or on demand, into save_dir/profiles
+    os.makedirs(args.save_dir + '/profiles', exist_ok=True)
+    train_callbacks.append(ProfilerTrigger(args.save_dir + '/profiles', rank=node,
+                                           percentile=args.profile_percentile or None, steps=args.profile_steps))
+    history = None
+    if initial_step > 0:
+        # Finish the epoch the checkpoint was taken in
+        history = model.fit(dataset, steps_per_epoch=steps_per_epoch - initial_step, epochs=initial_epoch + 1,
+                            initial_epoch=initial_epoch,
+                            validation_data=eval_dataset(x_test, y_test, args.batch_size, n_class),
+                            callbacks=train_callbacks)
+        initial_epoch += 1
+    if initial_epoch < args.epochs:
+        history = model.fit(dataset, steps_per_epoch=steps_per_epoch, epochs=args.epochs, initial_epoch=initial_epoch,
+                            validation_data=eval_dataset(x_test, y_test, args.batch_size, n_class),
+                            callbacks=train_callbacks)
+
+    if history is not None:
+        metrics = {key: float(values[-1]) for key, values in history.history.items()}
+        # The first step traces the train function, and compiles it with --xla
+        step_time = telemetry.phases['step'].sketch.quantile(0.5)
+        first_step = dict(startup.phases).get('first_step', 0.) if startup is not None else 0.
+        print(f"[MO833] Rank,{node},XLA,{int(args.xla)},First step,{first_step:.4f},"
+              f"Compile,{max(0., first_step - step_time):.4f},Steady step,{step_time:.4f}")
+    else:
+        # Resumed after the last step of the last epoch, nothing was trained: the metrics are those the resumed run
+        # logged for it, the validation ones evaluated again if it stopped before logging them, and there are no step
+        # times
+        metrics, step_time, first_step = logged_metrics(args.save_dir + '/log.csv', args.epochs - 1), None, None
+        if 'val_capsnet_accuracy' not in metrics:
+            metrics.update({'val_' + key: float(value) for key, value in model.evaluate(
+                eval_dataset(x_test, y_test, args.batch_size, n_class), return_dict=True, verbose=0).items()})
 
     model.save_weights(args.save_dir + '/trained_model.h5')
     print('Trained model saved to \'%s/trained_model.h5\'' % args.save_dir)
 
+    # Outcome of the run, e.g. for sweep.py
+    summary = {'args': vars(args), 'params': int(model.count_params()),
+               'metrics': metrics,
+               'step_time': step_time,
+               'first_step_time': first_step,
+               'xla': args.xla,
+               'all_reduced_bytes_per_step': model.sync_bytes() if isinstance(model, SyncedModel) else None,
+               'sync_wait': sync_report.wait.summary()['p50'],
+               # ru_maxrss is in kilobytes on Linux
+               'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+               'elapsed': time.time() - initial_time}
+    with open(args.save_dir + '/summary.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+
     return model
 
-def test(model, data, args):
+def test(model, data, args, strategy=None):
+    """
+    Evaluate a model on the test set a batch at a time, every worker on its own shard, see `evaluation.py`.
+    :param model: a LaneCapsNet eval model, or a train model
+    """
     x_test, y_test = data
-    y_pred, x_recon = model.predict(x_test, batch_size=100)
     print('-'*30 + 'Begin: test' + '-'*30)
-    print('Test acc:', np.sum(np.argmax(y_pred, 1) == np.argmax(y_test, 1))/y_test.shape[0])
-
-    img = combine_images(np.concatenate([x_test[:50],x_recon[:50]]))
-    image = img * 255
-    Image.fromarray(image.astype(np.uint8)).save(args.save_dir + "/real_and_recon.png")
-    print()
-    print('Reconstructed images are saved to %s/real_and_recon.png' % args.save_dir)
+    evaluator = evaluate(model, x_test, y_test, batch_size=100, shard=node, num_shards=num_workers)
+    if strategy is not None and num_workers > 1:
+        # Every worker sums the counts of all the shards, the first one holds the sample of reconstructions
+        _, states = make_coordinator(strategy, num_workers).agree(node, True, evaluator.state())
+        evaluator.load_state(states.sum(0))
+    report(evaluator, args.save_dir if node == 0 else None)
     print('-' * 30 + 'End: test' + '-' * 30)
-    plt.imshow(plt.imread(args.save_dir + "/real_and_recon.png"))
-    plt.show()
 
 def manipulate_latent(model, data, args):
+    """
+    Reconstruct a test image of class `args.digit` with every dimension of its digit capsule (one per lane) shifted by
+    -0.25 to 0.25, one row per dimension, all in a single batched prediction.
+    :param model: a LaneCapsNet manipulate model
+    :param data: test images and their one-hot labels, shape=[None, n_class], or class ids, shape=[None]
+    """
+    from PIL import Image
+    from utils import combine_images
     print('-'*30 + 'Begin: manipulate' + '-'*30)
     x_test, y_test = data
-    index = np.argmax(y_test, 1) == args.digit
+    n_class, num_lanes = model.inputs[2].shape[1:]
+    # One-hot labels, or class ids as in the dataset cache
+    labels = y_test if y_test.ndim == 1 else np.argmax(y_test, 1)
+    index = labels == args.digit
     number = np.random.randint(low=0, high=sum(index) - 1)
-    x, y = x_test[index][number], y_test[index][number]
-    x, y = np.expand_dims(x, 0), np.expand_dims(y, 0)
-    noise = np.zeros([1, 10, 16])
-    x_recons = []
-    for dim in range(16):
-        for r in [-0.25, -0.2, -0.15, -0.1, -0.05, 0, 0.05, 0.1, 0.15, 0.2, 0.25]:
-            tmp = np.copy(noise)
-            tmp[:,:,dim] = r
-            x_recon = model.predict([x, y, tmp])
-            x_recons.append(x_recon)
-
-    x_recons = np.concatenate(x_recons)
-
-    img = combine_images(x_recons, height=16)
+    x, y = x_test[index][number], np.eye(n_class, dtype=np.float32)[args.digit]
+
+    # noise.shape=[num_lanes*11, n_class, num_lanes], row dim*11+k shifts dimension dim by offsets[k]
+    offsets = np.array([-0.25, -0.2, -0.15, -0.1, -0.05, 0, 0.05, 0.1, 0.15, 0.2, 0.25], dtype=np.float32)
+    noise = np.zeros([num_lanes, len(offsets), n_class, num_lanes], dtype=np.float32)
+    noise[np.arange(num_lanes), :, :, np.arange(num_lanes)] = offsets[:, None]
+    noise = noise.reshape([-1, n_class, num_lanes])
+    xs = np.repeat(np.expand_dims(x, 0), len(noise), axis=0)
+    ys = np.repeat(np.expand_dims(y, 0), len(noise), axis=0)
+    x_recons = model.predict([xs, ys, noise], batch_size=args.batch_size)
+
+    img = combine_images(x_recons, height=num_lanes)
     image = img*255
     Image.fromarray(image.astype(np.uint8)).save(args.save_dir + '/manipulate-%d.png' % args.digit)
     print('manipulated result saved to %s/manipulate-%d.png' % (args.save_dir, args.digit))
@@ -293,9 +440,6 @@ def load_mnist():
 
 if __name__ == "__main__":
 
-    # Tempo inicial
-    initial_time = time.time()
-
     parser = argparse.ArgumentParser(description="Multi-lane Capsule Network")
 
     parser.add_argument('--epochs', default=2, type=int)
@@ -308,69 +452,185 @@ if __name__ == "__main__":
                         help="The coefficient for the loss of decoder")
     parser.add_argument('-r', '--routings', default=3, type=int,
                         help="Number of iterations used in routing algorithm. should > 0")
+    parser.add_argument('--routing_tol', default=None, type=float,
+                        help="Stop routing early when the coupling coefficients change by less than this, "
+                             "--routings being the maximum. Iterations used are written to save_dir/routings-*")
+    parser.add_argument('--recompute', default=None, choices=['lane'],
+                        help="Recompute the routing of every lane in the backward pass instead of keeping its "
+                             "intermediates, or with --fused_lanes the whole fused lanes from the input images. Lanes "
+                             "route to a single capsule in one iteration, there are no iterations to recompute")
+    parser.add_argument('--xla', action='store_true',
+                        help="Compile the train, validation and predict steps with XLA")
+    parser.add_argument('--xla_cache', default=os.path.join(datacache.DEFAULT_CACHE_DIR, 'xla'),
+                        help="Directory where XLA executables are persisted across runs with --xla, '' disables. "
+                             "Only GPU executables can be persisted")
+    parser.add_argument('--grad_accum', default=1, type=int,
+                        help="Split every batch into this many micro-batches and sum their gradients before "
+                             "all-reducing them, for large batches in little memory with one all-reduce per batch")
+    parser.add_argument('--grad_compression', default=None, choices=['fp16', 'bf16'],
+                        help="All-reduce the gradients as float16 or bfloat16, half the bytes of float32")
+    parser.add_argument('--allreduce_bucket_mb', default=0, type=float,
+                        help="All-reduce the gradients in buckets of about this many MB, 0 for a single fused "
+                             "all-reduce of all of them")
+    parser.add_argument('--balance_batches', default=0, type=int,
+                        help="Every this many steps, size the batch of every worker from its measured speed so that "
+                             "stragglers read and train on fewer images, the global batch staying the same. 0 "
+                             "disables it")
     parser.add_argument('--shift_fraction', default=0.1, type=float,
                         help="Fraction of pixels to shift at most in each direction.")
     parser.add_argument('--debug', action='store_true',
                         help="Save weights by TensorBoard")
     parser.add_argument('--save_dir', default='./result')
+    parser.add_argument('--tf_config', default='tf_config.json',
+                        help="Cluster configuration (TF_CONFIG) of a multi-worker run. Without it, or if it is '', "
+                             "runs as a single worker")
     parser.add_argument('-t', '--testing', action='store_true',
                         help="Test the trained model on testing dataset")
     parser.add_argument('--digit', default=5, type=int,
                         help="Digit to manipulate")
     parser.add_argument('--dropout', default=0, type=float,
                         help="Percentage of lanes to be dropout per batch")
+    parser.add_argument('--lane_dropout', default=0, type=float,
+                        help="Fraction of lanes dropped per batch before they run, skipping their compute. "
+                             "Implies --fused_lanes")
     parser.add_argument('--num_lanes', default=16, type=int,
                         help="Number of lanes")
     parser.add_argument('--lane_size', default=8, type=int,
                         help="Lane size")
     parser.add_argument('--lane_depth', default=1, type=int,
                         help="Lane depth")
+    parser.add_argument('--lane_layout', default=None, type=parse_lane_layout,
+                        help="Size and depth of every lane, e.g. 4x8:1,2x4:2 for four lanes of size 8 and depth 1 "
+                             "and two of size 4 and depth 2, see costmodel.py. Overrides --num_lanes, --lane_size "
+                             "and --lane_depth")
     parser.add_argument('--gpus', default=0, type=int,
                         help="number of gpus to be used")
     parser.add_argument('--node', default=0, type=int,
                         help="number of node")
     parser.add_argument('--lane_type', default=1, type=int,
                         help="Type of the lane")
+    parser.add_argument('--caps_impl', default='batched', choices=['batched', 'map_fn'],
+                        help="CapsuleLayer implementation. Both share the same weights")
+    parser.add_argument('--fused_lanes', action='store_true',
+                        help="Run all lanes as one grouped convolution and one batched routing")
     parser.add_argument('-w', '--weights', default=None, help="The path of the saved weights. Should be specified when testing")
-    parser.add_argument('--dataset', default='mnist')
-    parser.add_argument('--load_dir', default=None)
+    parser.add_argument('--dataset', default='mnist', choices=list(DATASETS),
+                        help="mnist for Fashion-MNIST, cifar for CIFAR-100")
+    parser.add_argument('--profile_percentile', default=99., type=float,
+                        help="Trace the next --profile_steps steps when a step takes longer than this percentile of "
+                             "the last 200 ones, 0 for on demand traces only (SIGUSR1 or "
+                             "save_dir/profiles/profile-now)")
+    parser.add_argument('--profile_steps', default=5, type=int,
+                        help="Number of steps of a trace")
+    parser.add_argument('--data_cache', default=datacache.DEFAULT_CACHE_DIR,
+                        help="Directory of the preprocessed dataset cache shared by the processes of the host, see "
+                             "datacache.py. '' loads the dataset in this process only")
+    parser.add_argument('--load_dir', default=None,
+                        help="Checkpoint directory to resume from, or the path of a saved model")
+    parser.add_argument('--ckpt_steps', default=0, type=int,
+                        help="Save a checkpoint every this many batches, 0 disables")
+    parser.add_argument('--ckpt_secs', default=600, type=float,
+                        help="Save a checkpoint every this many seconds, 0 disables")
+    parser.add_argument('--ckpt_keep', default=3, type=int,
+                        help="Number of checkpoints to keep")
     args = parser.parse_args()
+    if args.lane_layout is not None:
+        args.num_lanes = len(args.lane_layout)
+    startup = StartupTimer(initial_time)
+    startup.lap('imports')
+
+    os.makedirs(args.save_dir, exist_ok=True)
+
+    if args.xla and args.xla_cache:
+        # Read by TensorFlow when it first compiles. It cannot serialize CPU executables, those are compiled every run
+        os.environ['TF_XLA_FLAGS'] = ' '.join([os.environ.get('TF_XLA_FLAGS', ''),
+                                               '--tf_xla_persistent_cache_directory=' + args.xla_cache,
+                                               '--tf_xla_persistent_cache_device_types=GPU']).strip()
 
     # Set TF_CONFIG
-    with open('tf_config.json', 'r') as reader:
-        os.environ["TF_CONFIG"] = reader.read()
+    if args.tf_config and os.path.exists(args.tf_config):
+        with open(args.tf_config, 'r') as reader:
+            os.environ["TF_CONFIG"] = reader.read()
 
     regularizers.l1_l2(l1=0.008, l2=0.008)
 
-    (x_train, y_train), (x_test, y_test) = load_mnist() if args.dataset == "mnist" else load_cifar()
+    if args.data_cache:
+        # Memory-mapped, shared with the other processes of the host, labels as class ids
+        ((x_train, y_train), (x_test, y_test)), n_class = datacache.load(args.dataset, args.data_cache)
+    else:
+        (x_train, y_train), (x_test, y_test) = load_mnist() if args.dataset == "mnist" else load_cifar()
+        n_class = y_train.shape[1]
+    startup.lap('dataset')
 
     strategy = tf.distribute.MultiWorkerMirroredStrategy(cluster_resolver=None, communication_options=None)
+    startup.lap('strategy')
 
-    tf_config = json.loads(os.environ['TF_CONFIG'])
-    num_workers = len(tf_config['cluster']['worker'])
-    # Get node:
-    node=tf_config['task']['index']
+    if 'TF_CONFIG' in os.environ:
+        tf_config = json.loads(os.environ['TF_CONFIG'])
+        num_workers = len(tf_config['cluster']['worker'])
+        # Get node:
+        node=tf_config['task']['index']
     args.batch_size = args.batch_size * num_workers
+    if (args.batch_size // num_workers) % args.grad_accum:
+        parser.error('--grad_accum should divide the batch size of every worker')
+    # Balanced workers train on batches of any size
+    model_batch = None if args.balance_batches else args.batch_size
 
     initial_epoch = 0
 
     with strategy.scope():
-        if args.load_dir is None:
+        if args.load_dir is None or os.path.isdir(args.load_dir):
             model, eval_model, manipulate_model = LaneCapsNet(input_shape=x_train.shape[1:],
-                                                            n_class=len(np.unique(np.argmax(y_train, 1))),
+                                                            n_class=n_class,
                                                             routings=args.routings,
                                                             num_lanes = args.num_lanes,
                                                             lanesize = args.lane_size,
                                                             lanedepth = args.lane_depth,
                                                             lanetype = args.lane_type,
-                                                            gpus = args.gpus)
+                                                            gpus = args.gpus,
+                                                            caps_impl = args.caps_impl,
+                                                            fused = args.fused_lanes,
+                                                            lane_dropout = args.lane_dropout,
+                                                            batch_size = model_batch,
+                                                            dropout = args.dropout,
+                                                            routing_tol = args.routing_tol,
+                                                            lane_layout = args.lane_layout,
+                                                            recompute = args.recompute)
+            if args.weights is not None:
+                load_weights(model, args.weights, args, x_train.shape[1:], n_class)
+            if not args.testing:
+                # Trained with the gradient synchronization configured, the weights are those of the model. A saved
+                # model is trained as it was compiled
+                model = SyncedModel(model.inputs, model.outputs, name=model.name, accumulation=args.grad_accum,
+                                    compression=args.grad_compression,
+                                    bucket_bytes=int(args.allreduce_bucket_mb * 2 ** 20),
+                                    balance=args.balance_batches > 0)
         else:
-            custom_objects = {"CapsuleLayer": CapsuleLayer, "Mask": Mask, "Length": Length, "margin_loss": margin_loss}
-            with custom_object_scope(custom_objects):
-                model = models.load_model(args.load_dir)
+            # The epoch of a saved model is the third '-'-separated field of its path
+            try:
                 initial_epoch = int(args.load_dir.split('-')[2]) - 1
+            except (IndexError, ValueError):
+                parser.error("--load_dir should be a checkpoint directory or a saved model whose path holds its epoch "
+                             "as the third '-'-separated field, e.g. result/model-epoch-03-0.91.h5, not '%s'"
+                             % args.load_dir)
+            with custom_object_scope(dict(CUSTOM_OBJECTS, margin_loss=margin_loss)):
+                model = models.load_model(args.load_dir)
+                # Tested with the reconstruction of the true class
+                eval_model = model
+            for layer in model.layers:
+                if isinstance(layer, CapsuleLayer):
+                    layer.implementation = args.caps_impl
+                    layer.routing_tol = args.routing_tol
+                    layer.recompute = args.recompute
+    startup.lap('build')
 
     model.summary()
 
 #    gpu_model = multi_gpu_model(model, gpus=args.gpus)
-    train(model=model, data=((x_train, y_train), (x_test, y_test)), args=args, strategy = strategy, initial_epoch = initial_epoch)
+    if args.xla:
+        eval_model.jit_compile = True
+    if args.testing:
+        test(model=eval_model, data=(x_test, y_test), args=args, strategy=strategy)
+    else:
+        train(model=model, data=((x_train, y_train), (x_test, y_test)), args=args, strategy=strategy,
+              initial_epoch=initial_epoch)
@@ -0,0 +1,164 @@
+"""
+Asynchronous checkpointing for LaneCapsNet training. The model and optimizer state is copied to host memory in the
+training loop and written to disk by a background thread, atomically, keeping only the last few checkpoints.
+"""
+
+import glob
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+from tensorflow.keras import callbacks
+
+
+def _optimizer_variables(optimizer, var_list=None):
+    """
+    The variables of a Keras optimizer (including `iterations`), created first for `var_list` if they do not exist yet.
+    """
+    if var_list is not None:
+        if hasattr(optimizer, 'build'):
+            optimizer.build(var_list)
+        else:
+            optimizer._create_all_weights(var_list)
+    variables = optimizer.variables
+    return variables() if callable(variables) else variables
+
+
+def checkpoints(directory):
+    """
+    The checkpoints in `directory`, oldest first.
+    """
+    return sorted(glob.glob(os.path.join(directory, 'ckpt-*.npz')))
+
+
+def restore_weights(model, directory):
+    """
+    Set the model weights from the latest checkpoint in `directory`, without the optimizer state.
+    :return: the path of the checkpoint, None if there is no checkpoint
+    """
+    files = checkpoints(directory)
+    if not files:
+        return None
+    with np.load(files[-1]) as ckpt:
+        model.set_weights([ckpt['model_%d' % i] for i in range(int(ckpt['num_model']))])
+    return files[-1]
+
+
+def restore(model, directory):
+    """
+    Restore the model weights, the optimizer state and the training position from the latest checkpoint in
+    `directory`. The model should be compiled.
+    :return: (epoch, step) where training stopped, `step` being the number of batches already done in `epoch`.
+        (0, 0) if there is no checkpoint.
+    """
+    path = restore_weights(model, directory)
+    if path is None:
+        return 0, 0
+    with np.load(path) as ckpt:
+        variables = _optimizer_variables(model.optimizer, model.trainable_variables)
+        for i, variable in enumerate(variables):
+            variable.assign(ckpt['optimizer_%d' % i])
+        epoch, step = int(ckpt['epoch']), int(ckpt['step'])
+    print('Restored checkpoint %s, epoch %d, step %d' % (path, epoch, step))
+    return epoch, step
+
+
+class AsyncCheckpoint(callbacks.Callback):
+    """
+    Save the model weights, the optimizer state and the epoch/step every `every_steps` batches and/or every
+    `every_secs` seconds. The training loop only blocks to copy the state to host memory (or when the previous
+    checkpoint is still being written); files are written by a background thread to a temporary name and renamed into
+    place, and only the last `keep` checkpoints are kept.
+
+    :param directory: where checkpoints are written, as `ckpt-{global step}.npz`
+    :param every_steps: save every this many batches, 0 disables
+    :param every_secs: save every this many seconds, 0 disables
+    :param keep: number of checkpoints to keep
+    :param rank: rank of this worker, only rank 0 writes
+    :param initial_step: batches already done in the first epoch, when resuming
+    """
+    def __init__(self, directory, every_steps=0, every_secs=0, keep=3, rank=0, initial_step=0):
+        super(AsyncCheckpoint, self).__init__()
+        self.directory = directory
+        self.every_steps = every_steps
+        self.every_secs = every_secs
+        self.keep = keep
+        self.rank = rank
+        self.epoch = None
+        self.step = initial_step
+        self.steps_since_save = 0
+        self.last_save = time.time()
+        self.blocking_time = 0.
+        self.saved = 0
+        self.queue = queue.Queue(maxsize=1)
+        self.writer = None
+
+    def on_train_begin(self, logs=None):
+        if self.rank == 0 and self.writer is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.writer = threading.Thread(target=self._write_loop, daemon=True)
+            self.writer.start()
+        self.last_save = time.time()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if self.epoch is not None and epoch != self.epoch:
+            self.step = 0
+        self.epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        self.steps_since_save += 1
+        if (self.every_steps and self.steps_since_save >= self.every_steps) or \
+                (self.every_secs and time.time() - self.last_save >= self.every_secs):
+            self.save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        # Resuming from the end of an epoch starts the next one
+        self.epoch, self.step = epoch + 1, 0
+
+    def on_train_end(self, logs=None):
+        if self.steps_since_save > 0:
+            self.save()
+        if self.writer is not None:
+            self.queue.join()
+        print(f"\n[MO833] Rank,{self.rank},Checkpoints,{self.saved},Checkpoint blocking time,{self.blocking_time:.4f}")
+
+    def save(self):
+        """
+        Snapshot the training state and hand it to the writer thread.
+        """
+        self.steps_since_save = 0
+        self.last_save = time.time()
+        if self.rank != 0:
+            return
+        begin = time.time()
+        variables = _optimizer_variables(self.model.optimizer)
+        arrays = {'model_%d' % i: w for i, w in enumerate(self.model.get_weights())}
+        arrays.update({'optimizer_%d' % i: v.numpy() for i, v in enumerate(variables)})
+        arrays.update(num_model=len(self.model.weights), epoch=self.epoch, step=self.step)
+        global_step = int(self.model.optimizer.iterations.numpy())
+        self.queue.put((global_step, arrays))
+        self.blocking_time += time.time() - begin
+        self.saved += 1
+
+    def _write_loop(self):
+        while True:
+            global_step, arrays = self.queue.get()
+            try:
+                self._write(global_step, arrays)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, global_step, arrays):
+        path = os.path.join(self.directory, 'ckpt-%010d.npz' % global_step)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        for old in checkpoints(self.directory)[:-self.keep]:
+            os.remove(old)
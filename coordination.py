@@ -0,0 +1,58 @@
+"""
+Coordinators used by the training callbacks to make decisions that every worker has to agree on, like when to stop
+training. Each worker gives its own vote and values, and gets back the votes and values of all the workers, so all of
+them reach the same decision in the same step.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+
+class LocalCoordinator(object):
+    """
+    Coordinator of a single worker: its decision is everyone's decision.
+    """
+    num_workers = 1
+
+    def agree(self, rank, vote, values):
+        """
+        :param rank: index of this worker
+        :param vote: this worker's vote
+        :param values: list of floats reported by this worker
+        :return: (True if every worker voted True, array of shape=[num_workers, len(values)] with everyone's values)
+        """
+        return bool(vote), np.array([values], dtype=np.float64)
+
+
+class CollectiveCoordinator(object):
+    """
+    Coordinator over the collectives of a distribution strategy (e.g. `MultiWorkerMirroredStrategy`). Every worker has
+    to call `agree` in the same steps, in the same order, like any other collective.
+    """
+    def __init__(self, strategy, num_workers):
+        self.strategy = strategy
+        self.num_workers = num_workers
+        # Every local replica contributes the worker's row
+        self.local_replicas = max(1, strategy.num_replicas_in_sync // num_workers)
+        self._all_reduce = tf.function(self._replica_all_reduce)
+
+    @staticmethod
+    def _replica_all_reduce(x):
+        # x is placed on the replica's device before reducing
+        return tf.distribute.get_replica_context().all_reduce(tf.distribute.ReduceOp.SUM, tf.identity(x))
+
+    def agree(self, rank, vote, values):
+        rows = np.zeros([self.num_workers, 1 + len(values)], dtype=np.float64)
+        rows[rank] = [float(bool(vote))] + list(values)
+        reduced = self.strategy.run(self._all_reduce, args=(rows,))
+        reduced = self.strategy.experimental_local_results(reduced)[0].numpy() / self.local_replicas
+        return bool(np.all(reduced[:, 0] > 0.5)), reduced[:, 1:]
+
+
+def make_coordinator(strategy, num_workers):
+    """
+    A collective coordinator when training with several workers, a local one otherwise.
+    """
+    if num_workers > 1:
+        return CollectiveCoordinator(strategy, num_workers)
+    return LocalCoordinator()
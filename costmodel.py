@@ -0,0 +1,301 @@
+"""
+Analytical cost model of LaneCapsNet. Predicts the FLOPs, number of parameters, activation memory and CPU latency of a
+lane layout from the shapes of its layers alone, without building it, and suggests the layouts that fit a latency,
+memory or parameter budget.
+
+A lane layout gives the size (`--lane_size`, the width of its convolutions is size*16) and the depth (`--lane_depth`)
+of every lane, as comma separated `size:depth` entries, `NxS:D` standing for N lanes of size S and depth D:
+    4x8:1,2x4:2    four lanes of size 8 and depth 1, then two lanes of size 4 and depth 2
+
+Memory is that of the weights (and for training their gradients and Adam moments) and of the activations, without
+the footprint of TensorFlow itself. Latency is estimated as a linear function of the FLOPs, the activation bytes and
+the number of ops of the model, whose coefficients `--calibrate` fits to the times of a few models measured on this
+host.
+
+Usage:
+    python costmodel.py --lane_layout 4x8:1,2x4:2 --dataset mnist --batch_size 32
+    python costmodel.py --calibrate --calibration costmodel.json
+    python costmodel.py --suggest --calibration costmodel.json --max_latency 0.05 --max_memory 2000 --mode train
+"""
+
+import argparse
+import itertools
+import json
+import time
+
+import numpy as np
+
+
+# Input shape and number of classes of the datasets loaded by capsnet.py
+DATASETS = {'mnist': ((28, 28, 1), 10), 'cifar': ((32, 32, 3), 100)}
+
+# Bytes of a float32
+FLOAT = 4
+
+# Latency coefficients (seconds per FLOP, per activation byte, per op, and constant) used without a calibration, a
+# rough multi-core CPU: 20 GFLOP/s, 5 GB/s and 20us per op
+DEFAULT_COEFFICIENTS = {'inference': [5e-11, 2e-10, 2e-5, 0.], 'train': [5e-11, 2e-10, 2e-5, 0.]}
+
+
+def parse_lane_layout(layout):
+    """
+    :param layout: a lane layout, e.g. '4x8:1,2x4:2'
+    :return: the (size, depth) of every lane, e.g. [(8, 1)] * 4 + [(4, 2)] * 2
+    """
+    lanes = []
+    for entry in layout.split(','):
+        count, _, lane = entry.strip().rpartition('x')
+        size, _, depth = lane.partition(':')
+        lanes += [(int(size), int(depth or 1))] * int(count or 1)
+    return lanes
+
+
+def format_lane_layout(lanes):
+    """
+    The inverse of `parse_lane_layout`, consecutive identical lanes grouped.
+    """
+    return ','.join('%dx%d:%d' % (len(list(group)), size, depth)
+                    for (size, depth), group in itertools.groupby(lanes))
+
+
+def _conv(height, width, in_channels, filters, kernel_size, strides):
+    """
+    Output height and width, params and FLOPs of a 'valid' Conv2D.
+    """
+    height, width = (height - kernel_size) // strides + 1, (width - kernel_size) // strides + 1
+    params = kernel_size * kernel_size * in_channels * filters + filters
+    flops = 2 * height * width * kernel_size * kernel_size * in_channels * filters
+    return height, width, params, flops
+
+
+def lane_cost(input_shape, n_class, lanesize, lanedepth):
+    """
+    Cost of one `Lane`, per image.
+    :return: dict with the FLOPs, params, activations (number of values of the outputs of its layers), ops and the
+        number of its primary capsules `capsules`
+    """
+    height, width, channels = input_shape
+    filters, dim_capsule, n_channels = lanesize * 16, 16, lanesize * 2
+    flops = params = activations = ops = capsules = 0
+    for d in range(lanedepth):
+        if d > 0:
+            # Stacked levels convolve the previous capsules as a [num_capsule, dim_capsule, 1] image
+            height, width, channels = num_capsule, dim_capsule, 1
+            ops += 1
+        height, width, p, f = _conv(height, width, channels, filters, 9, 1)
+        params, flops, activations = params + p, flops + f, activations + height * width * filters
+        height, width, p, f = _conv(height, width, filters, dim_capsule * n_channels, 6, 2 if d == 0 else 3)
+        if height < 1 or width < 1:
+            raise ValueError('A lane of depth %d is too deep for the input shape %s' % (lanedepth, input_shape))
+        num_capsule = height * width * n_channels
+        # Primary capsules: conv, reshape and squash (about 4 FLOPs per value)
+        params, flops = params + p, flops + f + 4 * num_capsule * dim_capsule
+        activations += 3 * num_capsule * dim_capsule
+        ops += 5
+        capsules += num_capsule
+    if lanedepth > 1:
+        activations, ops = activations + capsules * dim_capsule, ops + 1
+
+    # Digit capsule: inputs_hat, then one routing iteration as the single capsule is always fully coupled
+    params += capsules * n_class * dim_capsule
+    flops += 2 * capsules * n_class * dim_capsule + 2 * capsules * n_class + 4 * n_class
+    activations += capsules * n_class + n_class
+    ops += 4
+    return {'flops': flops, 'params': params, 'activations': activations, 'ops': ops, 'capsules': capsules}
+
+
+def model_cost(input_shape, n_class, lanes, batch_size=1):
+    """
+    Cost of the LaneCapsNet with the lanes `lanes` and its decoder, for a batch of `batch_size` images.
+    :param lanes: the (size, depth) of every lane, see `parse_lane_layout`
+    :return: dict with the forward FLOPs, params, forward activation bytes and ops of the classifier (`inference`, no
+        decoder) and of a training step (`train`, decoder included, backward pass as twice the forward FLOPs, with the
+        gradients and the two Adam moments of every weight), each with its `memory` bytes
+    """
+    costs = [lane_cost(input_shape, n_class, size, depth) for size, depth in lanes]
+    flops, params, activations, ops = [sum(cost[key] for cost in costs) for key in ['flops', 'params',
+                                                                                  'activations', 'ops']]
+    # Concatenated digit capsules and their lengths
+    digitcaps = n_class * len(lanes)
+    flops, activations, ops = flops + 3 * digitcaps, activations + 2 * digitcaps + n_class, ops + 2
+    inference = {'flops': flops * batch_size, 'params': params,
+                 'activation_bytes': activations * batch_size * FLOAT, 'ops': ops}
+    inference['memory'] = params * FLOAT + inference['activation_bytes']
+
+    # Mask and decoder
+    decoder = [digitcaps, 512, 1024, int(np.prod(input_shape))]
+    decoder_params = sum(n_in * n_out + n_out for n_in, n_out in zip(decoder[:-1], decoder[1:]))
+    decoder_flops = sum(2 * n_in * n_out for n_in, n_out in zip(decoder[:-1], decoder[1:]))
+    train_flops = 3 * (flops + decoder_flops + digitcaps) * batch_size
+    train_activations = (activations + digitcaps + sum(decoder[1:])) * batch_size * FLOAT
+    train = {'flops': train_flops, 'params': params + decoder_params, 'activation_bytes': train_activations,
+             'ops': 3 * (ops + 5)}
+    # Weights, their gradients and two Adam moments
+    train['memory'] = 4 * train['params'] * FLOAT + train_activations
+    return {'inference': inference, 'train': train}
+
+
+def _features(cost):
+    return [cost['flops'], cost['activation_bytes'], cost['ops'], 1.]
+
+
+def estimate_latency(cost, coefficients):
+    """
+    :param cost: the `inference` or `train` cost of `model_cost`
+    :param coefficients: seconds per FLOP, per activation byte, per op, and constant
+    :return: estimated seconds of one forward pass or training step
+    """
+    return float(np.dot(_features(cost), coefficients))
+
+
+def fit(costs, latencies):
+    """
+    Least squares latency coefficients of measured models, none negative.
+    :param costs: `inference` or `train` costs of the models, see `model_cost`
+    :param latencies: the measured seconds of the models
+    """
+    features = np.array([_features(cost) for cost in costs], dtype=np.float64)
+    latencies = np.array(latencies, dtype=np.float64)
+    # Scale the features so that the FLOPs do not dominate the least squares
+    scale = np.maximum(np.abs(features).max(0), 1e-12)
+    active = list(range(features.shape[1]))
+    while True:
+        solution = np.linalg.lstsq(features[:, active] / scale[active], latencies, rcond=None)[0]
+        if np.all(solution >= 0) or len(active) == 1:
+            break
+        # Drop the most negative coefficient and fit again
+        del active[int(np.argmin(solution))]
+    coefficients = np.zeros(features.shape[1])
+    coefficients[active] = np.maximum(solution, 0) / scale[active]
+    return coefficients.tolist()
+
+
+def calibrate(dataset, batch_size, layouts, repeats=5):
+    """
+    Measure the forward pass and the training step of the models of `layouts` on this host, and fit the latency
+    coefficients to them.
+    :return: dict with the `inference` and `train` coefficients and the measurements
+    """
+    import tensorflow as tf
+    from tensorflow.keras import models
+    from capsnet import LaneCapsNet, margin_loss
+
+    input_shape, n_class = DATASETS[dataset]
+    x = np.random.rand(batch_size, *input_shape).astype(np.float32)
+    y = np.eye(n_class, dtype=np.float32)[np.random.randint(n_class, size=batch_size)]
+    measurements = []
+    for layout in layouts:
+        lanes = parse_lane_layout(layout)
+        model, _, _ = LaneCapsNet(input_shape, n_class, 3, gpus=0, lane_layout=lanes)
+        model.compile(optimizer='adam', loss=[margin_loss, 'mse'], loss_weights=[1., 0.392])
+        clf = models.Model(model.inputs[0], model.get_layer('capsnet').output)
+        predict = tf.function(lambda images: clf(images, training=False))
+        latencies = {}
+        for mode, step in [('inference', lambda: predict(x).numpy()),
+                           ('train', lambda: model.train_on_batch([x, y], [y, x]))]:
+            step()
+            begin = time.perf_counter()
+            for _ in range(repeats):
+                step()
+            latencies[mode] = (time.perf_counter() - begin) / repeats
+        measurements.append({'lane_layout': format_lane_layout(lanes), 'latency': latencies})
+        print('[MO833] Layout,%s,Inference,%.4f,Train,%.4f' % (measurements[-1]['lane_layout'],
+                                                              latencies['inference'], latencies['train']))
+
+    calibration = {'dataset': dataset, 'batch_size': batch_size, 'measurements': measurements}
+    for mode in ['inference', 'train']:
+        costs = [model_cost(input_shape, n_class, parse_lane_layout(m['lane_layout']), batch_size)[mode]
+                 for m in measurements]
+        calibration[mode] = fit(costs, [m['latency'][mode] for m in measurements])
+    return calibration
+
+
+def candidate_layouts(num_lanes, sizes, depths, max_kinds=2):
+    """
+    Lane layouts of `num_lanes` lanes made of at most `max_kinds` different (size, depth) lanes, larger lanes first.
+    """
+    kinds = sorted(itertools.product(sizes, depths), reverse=True)
+    for n_kinds in range(1, max_kinds + 1):
+        for chosen in itertools.combinations(kinds, n_kinds):
+            # Every way of splitting num_lanes between the chosen kinds, at least one lane each
+            for cuts in itertools.combinations(range(1, num_lanes), n_kinds - 1):
+                counts = np.diff([0] + list(cuts) + [num_lanes])
+                yield [kind for kind, count in zip(chosen, counts) for _ in range(count)]
+
+
+def suggest(input_shape, n_class, batch_size, coefficients, mode, lane_counts, sizes, depths, max_latency=None,
+            max_memory=None, max_params=None, top=10):
+    """
+    The layouts that fit the budgets, the ones with the most parameters first as the largest models that fit.
+    :param max_memory: in MB
+    :return: list of dicts with the layout and its cost and estimated latency
+    """
+    fitting = []
+    for num_lanes in lane_counts:
+        for lanes in candidate_layouts(num_lanes, sizes, depths):
+            try:
+                cost = model_cost(input_shape, n_class, lanes, batch_size)[mode]
+            except ValueError:
+                continue
+            latency = estimate_latency(cost, coefficients)
+            if (max_latency is None or latency <= max_latency) and \
+                    (max_memory is None or cost['memory'] <= max_memory * 2 ** 20) and \
+                    (max_params is None or cost['params'] <= max_params):
+                fitting.append(dict(cost, lane_layout=format_lane_layout(lanes), num_lanes=num_lanes,
+                                    latency=latency))
+    return sorted(fitting, key=lambda layout: (-layout['params'], layout['latency']))[:top]
+
+
+def _print(layout, cost, latency):
+    print('[MO833] Layout,%s,FLOPs,%.3e,Params,%d,Activations MB,%.1f,Memory MB,%.1f,Latency,%.4f' %
+          (layout, cost['flops'], cost['params'], cost['activation_bytes'] / 2 ** 20, cost['memory'] / 2 ** 20,
+           latency))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analytical cost model of LaneCapsNet lane layouts")
+    parser.add_argument('--lane_layout', default=None,
+                        help="Lane layout to estimate, e.g. 4x8:1,2x4:2")
+    parser.add_argument('--dataset', default='mnist', choices=list(DATASETS))
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--mode', default='inference', choices=['inference', 'train'],
+                        help="Cost of the classifier forward pass or of a training step")
+    parser.add_argument('--calibration', default=None,
+                        help="Latency coefficients JSON file, written by --calibrate")
+    parser.add_argument('--calibrate', action='store_true',
+                        help="Measure --calibration_layouts on this host and write the coefficients to --calibration")
+    parser.add_argument('--calibration_layouts', default=['2x1:1', '4x2:1', '8x1:1', '2x4:1', '2x2:2', '4x4:1'],
+                        nargs='+')
+    parser.add_argument('--suggest', action='store_true',
+                        help="List the layouts that fit the budgets")
+    parser.add_argument('--max_latency', default=None, type=float, help="Seconds")
+    parser.add_argument('--max_memory', default=None, type=float, help="MB")
+    parser.add_argument('--max_params', default=None, type=int)
+    parser.add_argument('--num_lanes', default=[2, 4, 8, 16, 32], type=int, nargs='+',
+                        help="Numbers of lanes of the suggested layouts")
+    parser.add_argument('--lane_sizes', default=[1, 2, 4, 8], type=int, nargs='+')
+    parser.add_argument('--lane_depths', default=[1, 2], type=int, nargs='+')
+    parser.add_argument('--top', default=10, type=int)
+    args = parser.parse_args()
+
+    input_shape, n_class = DATASETS[args.dataset]
+    if args.calibrate:
+        calibration = calibrate(args.dataset, args.batch_size, args.calibration_layouts)
+        with open(args.calibration or 'costmodel.json', 'w') as f:
+            json.dump(calibration, f, indent=2)
+        coefficients = calibration[args.mode]
+    elif args.calibration is not None:
+        with open(args.calibration) as f:
+            coefficients = json.load(f)[args.mode]
+    else:
+        coefficients = DEFAULT_COEFFICIENTS[args.mode]
+
+    if args.lane_layout is not None:
+        lanes = parse_lane_layout(args.lane_layout)
+        cost = model_cost(input_shape, n_class, lanes, args.batch_size)[args.mode]
+        _print(format_lane_layout(lanes), cost, estimate_latency(cost, coefficients))
+    if args.suggest:
+        for layout in suggest(input_shape, n_class, args.batch_size, coefficients, args.mode, args.num_lanes,
+                              args.lane_sizes, args.lane_depths, args.max_latency, args.max_memory, args.max_params,
+                              args.top):
+            _print(layout['lane_layout'], layout, layout['latency'])
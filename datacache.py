@@ -0,0 +1,106 @@
+"""
+On-disk cache of the preprocessed datasets, shared by every process of a host. The images are written once as float32
+in [0, 1] and the labels as integer class ids, one `.npy` file per array in `cache_dir/<dataset>-v<VERSION>`, and every
+process memory-maps them read-only: co-located workers and sweep runs share the same pages of the page cache instead
+of each holding a private copy, and start without decoding the dataset again.
+
+Usage:
+    python datacache.py --dataset cifar --cache_dir ~/.cache/mlcn    # build ahead of time
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from costmodel import DATASETS
+
+
+# Bumped whenever the preprocessing or the layout of the cache changes, older caches are then rebuilt
+VERSION = 1
+
+ARRAYS = ['x_train', 'y_train', 'x_test', 'y_test']
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mlcn')
+
+
+def preprocess(dataset):
+    """
+    Load a dataset with `keras.datasets` and preprocess it as capsnet.py does, but with class ids as labels.
+    :return: (x_train, y_train), (x_test, y_test), images as float32 in [0, 1], labels as the smallest unsigned
+        integer type holding the class ids
+    """
+    if dataset == 'mnist':
+        from keras.datasets import fashion_mnist
+        (x_train, y_train), (x_test, y_test) = fashion_mnist.load_data()
+        shape = (28, 28, 1)
+    else:
+        from keras.datasets import cifar100
+        (x_train, y_train), (x_test, y_test) = cifar100.load_data()
+        shape = (32, 32, 3)
+
+    n_class = int(max(y_train.max(), y_test.max())) + 1
+    label_type = np.uint8 if n_class <= 256 else np.int32
+    x_train = x_train.reshape((-1,) + shape).astype('float32') / 255.
+    x_test = x_test.reshape((-1,) + shape).astype('float32') / 255.
+    return ((x_train, y_train.reshape(-1).astype(label_type)), (x_test, y_test.reshape(-1).astype(label_type)))
+
+
+def cache_path(dataset, cache_dir=DEFAULT_CACHE_DIR):
+    return os.path.join(cache_dir, '%s-v%d' % (dataset, VERSION))
+
+
+def build(dataset, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Write the cache of a dataset unless it exists. Processes building the same cache at the same time wait for the
+    first one instead of building it again.
+    :return: the directory of the cache
+    """
+    path = cache_path(dataset, cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            return path
+        begin = time.time()
+        (x_train, y_train), (x_test, y_test) = preprocess(dataset)
+        # Written aside and renamed, a cache directory is always complete
+        partial = path + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        for name, array in zip(ARRAYS, [x_train, y_train, x_test, y_test]):
+            np.save(os.path.join(partial, name + '.npy'), array)
+        meta = {'version': VERSION, 'dataset': dataset, 'n_class': int(max(y_train.max(), y_test.max())) + 1,
+                'shapes': {name: list(array.shape) for name, array in zip(ARRAYS, [x_train, y_train, x_test, y_test])}}
+        with open(os.path.join(partial, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.rename(partial, path)
+        print('[MO833] Data cache,%s,Built,%.4f' % (path, time.time() - begin))
+    return path
+
+
+def load(dataset, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Map the cache of a dataset, building it first if needed.
+    :return: ((x_train, y_train), (x_test, y_test)), n_class, the arrays being read-only memory maps with the labels as
+        class ids
+    """
+    path = cache_path(dataset, cache_dir)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        build(dataset, cache_dir)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    x_train, y_train, x_test, y_test = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in ARRAYS]
+    return ((x_train, y_train), (x_test, y_test)), meta['n_class']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the preprocessed dataset cache")
+    parser.add_argument('--dataset', default='mnist', choices=list(DATASETS))
+    parser.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+    print('Dataset cache in \'%s\'' % build(args.dataset, args.cache_dir))
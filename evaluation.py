@@ -0,0 +1,236 @@
+"""
+Streaming evaluation of a LaneCapsNet. The test set is predicted a chunk at a time and only running counts are kept:
+the confusion matrix, from which the accuracy and per-class accuracy follow, and the sums of the margin and
+reconstruction losses, plus the first few images and their reconstructions for `real_and_recon.png`. Peak memory does
+not grow with the size of the test set.
+
+Evaluation is sharded by giving every worker a contiguous shard of the test set; the states of the shards are merged
+by summing them, e.g. over the workers of a distribution strategy (see `capsnet.test`) or over the worker processes
+of `evaluate_parallel`.
+
+Usage:
+    python evaluation.py -w result/trained_model.h5 --num_lanes 16 --lane_size 8 --workers 2
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+
+def margin_losses(y_true, y_pred):
+    """
+    The margin loss of every sample, as `capsnet.margin_loss` before its mean over the batch.
+    :return: shape=[None]
+    """
+    L = y_true * np.square(np.maximum(0., 0.9 - y_pred)) + \
+        0.5 * (1 - y_true) * np.square(np.maximum(0., y_pred - 0.1))
+    return L.sum(1)
+
+
+class StreamingEvaluator(object):
+    """
+    Evaluation metrics of a classifier and its decoder, accumulated batch by batch.
+    """
+    def __init__(self, n_class, samples=50):
+        """
+        :param n_class: number of classes
+        :param samples: number of images and reconstructions kept, the first ones seen
+        """
+        self.n_class = n_class
+        self.samples = samples
+        self.confusion = np.zeros([n_class, n_class], dtype=np.int64)
+        self.margin_loss = 0.
+        self.recon_loss = 0.
+        self.images = []
+        self.recons = []
+
+    @property
+    def count(self):
+        return int(self.confusion.sum())
+
+    def update(self, y_true, y_pred, x=None, x_recon=None):
+        """
+        Add a batch.
+        :param y_true: one-hot labels, shape=[None, n_class], or class ids, shape=[None]
+        :param y_pred: capsule lengths, shape=[None, n_class]
+        :param x: images, shape=[None, width, height, channels]
+        :param x_recon: reconstructions of the images, same shape as x
+        """
+        y_true = np.asarray(y_true)
+        if y_true.ndim == 1:
+            y_true = np.eye(self.n_class, dtype=np.float32)[y_true]
+        np.add.at(self.confusion, (np.argmax(y_true, 1), np.argmax(y_pred, 1)), 1)
+        self.margin_loss += float(margin_losses(y_true, y_pred).sum())
+        if x is not None and x_recon is not None:
+            self.recon_loss += float(np.square(x - x_recon).reshape(len(x), -1).mean(1).sum())
+            kept = sum(len(images) for images in self.images)
+            if kept < self.samples:
+                self.images.append(np.array(x[:self.samples - kept]))
+                self.recons.append(np.array(x_recon[:self.samples - kept]))
+
+    def state(self):
+        """
+        The counts as one vector, to be summed over shards, see `load_state`.
+        :return: shape=[2 + n_class*n_class], float64
+        """
+        return np.concatenate([[self.margin_loss, self.recon_loss], self.confusion.ravel()]).astype(np.float64)
+
+    def load_state(self, state):
+        self.margin_loss, self.recon_loss = float(state[0]), float(state[1])
+        self.confusion = np.rint(state[2:]).astype(np.int64).reshape(self.n_class, self.n_class)
+
+    def merge(self, other):
+        """
+        Add the counts of another shard. The samples of this evaluator come first.
+        """
+        self.load_state(self.state() + other.state())
+        kept = sum(len(images) for images in self.images)
+        for images, recons in zip(other.images, other.recons):
+            if kept >= self.samples:
+                break
+            self.images.append(images[:self.samples - kept])
+            self.recons.append(recons[:self.samples - kept])
+            kept += len(self.images[-1])
+        return self
+
+    def sample(self):
+        """
+        :return: (images, reconstructions) kept, None if there are none
+        """
+        if not self.images:
+            return None
+        return np.concatenate(self.images), np.concatenate(self.recons)
+
+    def result(self):
+        """
+        :return: dict with count, accuracy, per_class_accuracy (NaN for classes without samples), margin_loss and
+            recon_loss (means over the samples) and confusion (rows are the true classes)
+        """
+        count = max(self.count, 1)
+        support = self.confusion.sum(1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            per_class = np.diag(self.confusion) / support
+        return {'count': self.count, 'accuracy': float(np.trace(self.confusion)) / count,
+                'per_class_accuracy': per_class.tolist(), 'margin_loss': self.margin_loss / count,
+                'recon_loss': self.recon_loss / count, 'confusion': self.confusion.tolist()}
+
+
+def shard_range(size, shard, num_shards):
+    """
+    The contiguous range [begin, end) of shard `shard` out of `num_shards` of `size` samples.
+    """
+    return size * shard // num_shards, size * (shard + 1) // num_shards
+
+
+def evaluate(model, x, y, batch_size=100, evaluator=None, shard=0, num_shards=1, samples=50):
+    """
+    Evaluate a model on shard `shard` of (x, y), `batch_size` samples at a time.
+    :param model: a LaneCapsNet eval model, taking x, or train model, taking [x, y] and reconstructing the true class
+    :param x: images, shape=[None, width, height, channels]
+    :param y: one-hot labels, shape=[None, n_class], or class ids, shape=[None]
+    :param evaluator: the `StreamingEvaluator` to update, a new one by default
+    :return: the evaluator
+    """
+    n_class = model.outputs[0].shape[-1]
+    if evaluator is None:
+        evaluator = StreamingEvaluator(n_class, samples=samples)
+    begin, end = shard_range(len(x), shard, num_shards)
+    for i in range(begin, end, batch_size):
+        x_batch, y_batch = x[i:min(i + batch_size, end)], y[i:min(i + batch_size, end)]
+        if len(model.inputs) > 1:
+            y_onehot = np.eye(n_class, dtype=np.float32)[y_batch] if y_batch.ndim == 1 else y_batch
+            y_pred, x_recon = model.predict_on_batch([x_batch, y_onehot])
+        else:
+            y_pred, x_recon = model.predict_on_batch(x_batch)
+        evaluator.update(y_batch, y_pred, x_batch, x_recon)
+    return evaluator
+
+
+def _evaluate_worker(args, x, y, batch_size, samples):
+    """
+    Worker process of `evaluate_parallel`: rebuild the trained model and evaluate its shard, given as x and y.
+    :return: (state, images, reconstructions)
+    """
+    import tensorflow as tf
+    from export import build_trained_model
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    _, eval_model, _ = build_trained_model(args)
+    evaluator = evaluate(eval_model, x, y, batch_size=batch_size, samples=samples)
+    return (evaluator.state(),) + (evaluator.sample() or (None, None))
+
+
+def evaluate_parallel(args, x, y, n_class, num_workers=2, batch_size=100, samples=50):
+    """
+    Evaluate the trained model described by `args` (see `export.add_model_arguments`) with `num_workers` processes,
+    each one on its own shard of (x, y).
+    :return: the merged `StreamingEvaluator`
+    """
+    shards = [shard_range(len(x), shard, num_workers) for shard in range(num_workers)]
+    with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+        states = pool.starmap(_evaluate_worker, [(args, x[begin:end], y[begin:end], batch_size, samples)
+                                                 for begin, end in shards])
+    evaluator = StreamingEvaluator(n_class, samples=samples)
+    for state, images, recons in states:
+        shard = StreamingEvaluator(n_class, samples=samples)
+        shard.load_state(state)
+        if images is not None:
+            shard.images, shard.recons = [images], [recons]
+        evaluator.merge(shard)
+    return evaluator
+
+
+def report(evaluator, save_dir=None):
+    """
+    Print the metrics of an evaluator and save them to `save_dir/evaluation.json`, with its sample of images and
+    reconstructions as `save_dir/real_and_recon.png`.
+    """
+    result = evaluator.result()
+    print('Test acc:', result['accuracy'])
+    print('[MO833] Test,Images,%d,Acc,%.4f,Margin loss,%.4f,Recon loss,%.4f' %
+          (result['count'], result['accuracy'], result['margin_loss'], result['recon_loss']))
+    if save_dir is None:
+        return result
+    with open(os.path.join(save_dir, 'evaluation.json'), 'w') as f:
+        json.dump(result, f, indent=2)
+    sample = evaluator.sample()
+    if sample is not None:
+        from PIL import Image
+        from utils import combine_images
+        image = combine_images(np.concatenate(sample)) * 255
+        Image.fromarray(image.astype(np.uint8)).save(os.path.join(save_dir, 'real_and_recon.png'))
+        print('Reconstructed images are saved to %s/real_and_recon.png' % save_dir)
+    return result
+
+
+if __name__ == "__main__":
+    from export import DATASETS, add_model_arguments
+
+    parser = add_model_arguments(argparse.ArgumentParser(description="Streaming evaluation of a LaneCapsNet"))
+    parser.add_argument('--workers', default=1, type=int,
+                        help="Number of worker processes, each evaluating its own shard of the test set")
+    parser.add_argument('--batch_size', default=100, type=int)
+    parser.add_argument('--samples', default=50, type=int,
+                        help="Number of images and reconstructions saved to real_and_recon.png")
+    parser.add_argument('--save_dir', default='./result')
+    args = parser.parse_args()
+
+    from capsnet import load_mnist, load_cifar
+    _, n_class = DATASETS[args.dataset]
+    _, (x_test, y_test) = load_mnist() if args.dataset == 'mnist' else load_cifar()
+    begin = time.time()
+    if args.workers > 1:
+        evaluator = evaluate_parallel(args, x_test, y_test, n_class, num_workers=args.workers,
+                                      batch_size=args.batch_size, samples=args.samples)
+    else:
+        from export import build_trained_model
+        _, eval_model, _ = build_trained_model(args)
+        evaluator = evaluate(eval_model, x_test, y_test, batch_size=args.batch_size, samples=args.samples)
+    elapsed = time.time() - begin
+    os.makedirs(args.save_dir, exist_ok=True)
+    report(evaluator, args.save_dir)
+    print('[MO833] Workers,%d,Images,%d,Time,%.4f,Throughput,%.1f' %
+          (args.workers, len(x_test), elapsed, len(x_test) / elapsed))
@@ -0,0 +1,129 @@
+"""
+Export a trained LaneCapsNet as an inference-only classifier: the capsule lengths, without the decoder, with a dynamic
+batch dimension, saved as a self-contained SavedModel. Also a batch prediction entry point for exported classifiers.
+
+Usage:
+    python export.py -w result/trained_model.h5 --export_dir result/classifier --num_lanes 16 --lane_size 8
+    python export.py --export_dir result/classifier --predict x.npy --output y_pred.npy
+"""
+
+import argparse
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import models
+
+import checkpoint
+from capslayer import CapsuleLayer
+from capsnet import LaneCapsNet, load_weights
+from costmodel import DATASETS, parse_lane_layout
+
+
+def add_model_arguments(parser):
+    """
+    The architecture arguments of capsnet.py, needed to rebuild a trained model.
+    """
+    parser.add_argument('-r', '--routings', default=3, type=int)
+    parser.add_argument('--routing_tol', default=None, type=float)
+    parser.add_argument('--num_lanes', default=16, type=int)
+    parser.add_argument('--lane_size', default=8, type=int)
+    parser.add_argument('--lane_depth', default=1, type=int)
+    parser.add_argument('--lane_type', default=1, type=int)
+    parser.add_argument('--lane_layout', default=None, type=parse_lane_layout,
+                        help="Size and depth of every lane, see costmodel.py")
+    parser.add_argument('--fused_lanes', action='store_true')
+    parser.add_argument('--lane_ids', default=None, type=int, nargs='+',
+                        help="Lanes kept in a pruned model, see lane_prune.py")
+    parser.add_argument('--dataset', default='mnist', choices=list(DATASETS))
+    parser.add_argument('-w', '--weights', default=None,
+                        help="Trained weights, or a checkpoint directory")
+    return parser
+
+
+def build_trained_model(args, batch_size=None):
+    """
+    Rebuild the LaneCapsNet described by `args` with the given batch size (None for a dynamic one) and load its
+    trained weights from `args.weights`.
+    :return: train_model, eval_model, manipulate_model, as LaneCapsNet
+    """
+    input_shape, n_class = DATASETS[args.dataset]
+    if args.lane_layout is not None:
+        args.num_lanes = len(args.lane_layout)
+    model_args = argparse.Namespace(**vars(args))
+    model_args.batch_size, model_args.dropout = batch_size, 0.
+    model, eval_model, manipulate_model = LaneCapsNet(input_shape=input_shape, n_class=n_class,
+                                                      routings=args.routings, num_lanes=args.num_lanes,
+                                                      lanesize=args.lane_size, lanedepth=args.lane_depth,
+                                                      lanetype=args.lane_type, gpus=0, fused=args.fused_lanes,
+                                                      batch_size=batch_size, routing_tol=args.routing_tol,
+                                                      lane_ids=args.lane_ids, lane_layout=args.lane_layout)
+    if args.weights is not None:
+        if os.path.isdir(args.weights):
+            checkpoint.restore_weights(model, args.weights)
+        else:
+            load_weights(model, args.weights, model_args, input_shape, n_class)
+    return model, eval_model, manipulate_model
+
+
+def classifier(model):
+    """
+    The classification part of a LaneCapsNet train model: images to capsule lengths, sharing its layers and weights.
+    """
+    for layer in model.layers:
+        if isinstance(layer, CapsuleLayer):
+            # The batched implementation works with any batch size
+            layer.implementation = 'batched'
+    return models.Model(model.inputs[0], model.get_layer('capsnet').output)
+
+
+def export_classifier(model, export_dir):
+    """
+    Save the classifier of a LaneCapsNet train model as a SavedModel, with a `serving_default` signature taking
+    `x` of shape=[None, width, height, channels] and returning `capsnet`, the capsule lengths.
+    """
+    clf = classifier(model)
+
+    @tf.function(input_signature=[tf.TensorSpec([None] + list(clf.input_shape[1:]), tf.float32, name='x')])
+    def serve(x):
+        return {'capsnet': clf(x, training=False)}
+
+    tf.saved_model.save(clf, export_dir, signatures={'serving_default': serve})
+    print('Classifier exported to \'%s\'' % export_dir)
+
+
+def load_classifier(export_dir):
+    """
+    Load an exported classifier, no custom objects needed.
+    :return: a function from a batch of images to capsule lengths
+    """
+    serving = tf.saved_model.load(export_dir).signatures['serving_default']
+    return lambda x: serving(x=tf.convert_to_tensor(x, tf.float32))['capsnet']
+
+
+def predict(clf, x, batch_size=256):
+    """
+    Capsule lengths of any number of images, computed `batch_size` images at a time.
+    :param clf: a function from a batch of images to capsule lengths, as returned by `load_classifier`
+    :param x: images, shape=[None, width, height, channels]
+    :return: shape=[None, n_class]
+    """
+    return np.concatenate([clf(x[i:i + batch_size]).numpy() for i in range(0, len(x), batch_size)])
+
+
+if __name__ == "__main__":
+    parser = add_model_arguments(argparse.ArgumentParser(description="Export a LaneCapsNet classifier"))
+    parser.add_argument('--export_dir', required=True)
+    parser.add_argument('--predict', default=None,
+                        help="Predict the images in this .npy file with the exported classifier")
+    parser.add_argument('--output', default='y_pred.npy')
+    parser.add_argument('--batch_size', default=256, type=int)
+    args = parser.parse_args()
+
+    if args.predict is None:
+        model, _, _ = build_trained_model(args)
+        export_classifier(model, args.export_dir)
+    else:
+        y_pred = predict(load_classifier(args.export_dir), np.load(args.predict), batch_size=args.batch_size)
+        np.save(args.output, y_pred)
+        print('Predictions of %d images saved to \'%s\'' % (len(y_pred), args.output))
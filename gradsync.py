@@ -0,0 +1,224 @@
+"""
+Gradient synchronization of multi-worker training. `SyncedModel` is a LaneCapsNet train model whose training step
+all-reduces the gradients itself instead of leaving it to the optimizer:
+- the batch of a step is processed in `accumulation` micro-batches, bounding the activation memory, whose gradients
+  are summed before the single all-reduce of the batch,
+- the gradients can be all-reduced as float16 or bfloat16, half the bytes of float32,
+- all the gradients are all-reduced as one fused collective, or in buckets of about `bucket_bytes`,
+- every worker can train on its own number of images per step, `BatchBalancer` sizing the batches of its input
+  pipeline from the measured speed of every worker so that a slower worker gets fewer images instead of making the
+  others wait. The gradients are then weighted by the number of images of every worker.
+
+`SyncReport` reports the bytes all-reduced per step and the time every step waits in the all-reduce, which includes
+waiting for the slowest worker.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import callbacks, models
+
+from telemetry import PhaseStats
+
+
+COMPRESSION = {None: tf.float32, 'fp16': tf.float16, 'bf16': tf.bfloat16}
+
+
+class SyncedModel(models.Model):
+    """
+    A functional model, built as `SyncedModel(model.inputs, model.outputs)` to share the layers and weights of `model`,
+    with a training step synchronizing gradients as configured.
+
+    :param accumulation: number of micro-batches every batch is split into, their gradients summed before all-reducing
+    :param compression: None, 'fp16' or 'bf16', the type of the gradients all-reduced
+    :param bucket_bytes: 0 to all-reduce all the gradients as one collective, otherwise packs of about this many bytes
+    :param balance: if True, the batches of every worker can be of any size, see `BatchBalancer`
+    """
+    def __init__(self, *args, accumulation=1, compression=None, bucket_bytes=0, balance=False, **kwargs):
+        super(SyncedModel, self).__init__(*args, **kwargs)
+        assert compression in COMPRESSION, "compression should be one of %s" % (list(COMPRESSION),)
+        self.accumulation = accumulation
+        self.compression = compression
+        self.bucket_bytes = bucket_bytes
+        self.balance = balance
+        # The logs of every worker are its own, sync_time and local_batch, the metrics being aggregated already
+        self.distribute_reduction_method = 'first'
+
+    def sync_bytes(self):
+        """
+        Bytes all-reduced every step, the gradients and, when balancing, the number of images.
+        """
+        size = COMPRESSION[self.compression].size
+        return sum(int(np.prod(v.shape)) for v in self.trainable_variables) * size + (4 if self.balance else 0)
+
+    def _gradients(self, x, y):
+        # The gradients of one micro-batch, updating the metrics
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compute_loss(x, y, y_pred)
+        self.compiled_metrics.update_state(y, y_pred)
+        # Some lose their static shape with batches of unknown size, which the all-reduce needs to pack them
+        return [tf.ensure_shape(tf.convert_to_tensor(g), v.shape)
+                for g, v in zip(tape.gradient(loss, self.trainable_variables), self.trainable_variables)]
+
+    def train_step(self, data):
+        x, y = data
+        batch = tf.shape(tf.nest.flatten(x)[0])[0]
+
+        if self.accumulation == 1:
+            gradients = self._gradients(x, y)
+        else:
+            micro_batch = batch // self.accumulation
+
+            def accumulate(i, gradients):
+                micro_x, micro_y = tf.nest.map_structure(lambda t: t[i * micro_batch:(i + 1) * micro_batch], (x, y))
+                return i + 1, [a + g for a, g in zip(gradients, self._gradients(micro_x, micro_y))]
+
+            _, gradients = tf.while_loop(lambda i, _: i < self.accumulation, accumulate,
+                                         [tf.constant(0), [tf.zeros_like(v) for v in self.trainable_variables]])
+            # The loss is a mean over the images of a micro-batch
+            gradients = [g / self.accumulation for g in gradients]
+
+        if self.balance:
+            # The loss of a replica is scaled by 1 / replicas. Every worker's mean gradient weighted by its images,
+            # divided by the images of all the workers below, is the mean gradient over all the images
+            replicas = tf.distribute.get_strategy().num_replicas_in_sync
+            gradients = [g * tf.cast(batch * replicas, g.dtype) for g in gradients]
+
+        context = tf.distribute.get_replica_context()
+        dtype = COMPRESSION[self.compression]
+        # XLA has no timestamps, the wait is not measured with jit_compile
+        timed = not self.jit_compile
+        with tf.control_dependencies(gradients):
+            begin = tf.timestamp() if timed else tf.constant(0., tf.float64)
+        with tf.control_dependencies([begin]):
+            reduced = context.all_reduce(
+                tf.distribute.ReduceOp.SUM, [tf.cast(g, dtype) for g in gradients],
+                options=tf.distribute.experimental.CommunicationOptions(bytes_per_pack=self.bucket_bytes))
+            if self.balance:
+                total = context.all_reduce(tf.distribute.ReduceOp.SUM, tf.cast(batch, tf.float32))
+        with tf.control_dependencies(reduced):
+            end = tf.timestamp() if timed else begin
+        reduced = [tf.cast(g, v.dtype) for g, v in zip(reduced, self.trainable_variables)]
+        if self.balance:
+            reduced = [g / total for g in reduced]
+
+        self.optimizer.apply_gradients(zip(reduced, self.trainable_variables), experimental_aggregate_gradients=False)
+        logs = dict(self.get_metrics_result(), local_batch=batch)
+        if timed:
+            logs['sync_time'] = end - begin
+        return logs
+
+
+class SyncReport(callbacks.Callback):
+    """
+    Bytes all-reduced and time waiting in the all-reduce per step, from the logs of a `SyncedModel`. Printed every
+    epoch, and written to `{directory}/sync-{rank}.json` at the end of training.
+    """
+    def __init__(self, directory, rank=0, num_workers=1):
+        super(SyncReport, self).__init__()
+        self.path = os.path.join(directory, 'sync-%d.json' % rank)
+        self.rank = rank
+        self.num_workers = num_workers
+        self.wait = PhaseStats()
+        self.epoch_wait = PhaseStats()
+        self.images = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_wait = PhaseStats()
+
+    def on_train_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        self.images += int(logs.get('local_batch', 0))
+        if 'sync_time' in logs:
+            self.wait.add(float(logs['sync_time']))
+            self.epoch_wait.add(float(logs['sync_time']))
+
+    def _bytes(self):
+        payload = self.model.sync_bytes()
+        # A ring all-reduce sends 2 * (n - 1) / n of the payload from every worker
+        return payload, int(2 * (self.num_workers - 1) * payload / self.num_workers)
+
+    def on_epoch_end(self, epoch, logs=None):
+        payload, sent = self._bytes()
+        s = self.epoch_wait.summary()
+        print(f"\n[MO833] Rank,{self.rank},Epoch,{epoch},All-reduced bytes per step,{payload},Sent bytes per step,"
+              f"{sent},Sync wait mean,{s['mean']:.4f},P50,{s['p50']:.4f},P99,{s['p99']:.4f}")
+
+    def on_train_end(self, logs=None):
+        payload, sent = self._bytes()
+        with open(self.path, 'w') as f:
+            json.dump({'rank': self.rank, 'all_reduced_bytes_per_step': payload, 'sent_bytes_per_step': sent,
+                       'images': self.images, 'accumulation': self.model.accumulation,
+                       'compression': self.model.compression, 'bucket_bytes': self.model.bucket_bytes,
+                       'sync_wait': self.wait.summary()}, f, indent=2)
+
+
+def balanced_batches(seconds_per_image, total, unit=1, max_batch=None):
+    """
+    Split `total` images per step between workers in proportion to their speed.
+    :param seconds_per_image: compute time per image of every worker
+    :param unit: every batch is a multiple of this, e.g. the number of micro-batches
+    :return: list of the number of images of every worker
+    """
+    speed = 1. / np.maximum(np.asarray(seconds_per_image, dtype=np.float64), 1e-9)
+    units = total // unit
+    shares = np.maximum(1, np.floor(units * speed / speed.sum())).astype(int)
+    if max_batch is not None:
+        shares = np.minimum(shares, max_batch // unit)
+    # What rounding left goes to the fastest workers with room left
+    for w in np.argsort(-speed):
+        if shares.sum() >= units:
+            break
+        room = units - shares.sum() if max_batch is None else min(units - shares.sum(), max_batch // unit - shares[w])
+        shares[w] += max(0, room)
+    return [int(s) * unit for s in shares]
+
+
+class BatchBalancer(callbacks.Callback):
+    """
+    Every `every` steps, size the batch of every worker of a balancing `SyncedModel` from the compute time per image of
+    every worker over those steps, the step time less the time waiting in the all-reduce. All the workers agree on the
+    sizes through `coordinator`, in the same steps, and every worker assigns its own to `local_batch`, the batch size
+    of its input pipeline (see `pipeline.train_dataset`), so that it only reads the images it trains on.
+
+    :param total: images per step of all the workers together
+    :param local_batch: `tf.Variable` the batch size of this worker is assigned to
+    :param max_batch: images per step of a worker at most
+    """
+    def __init__(self, coordinator, rank, total, local_batch, max_batch=None, every=50):
+        super(BatchBalancer, self).__init__()
+        self.coordinator = coordinator
+        self.rank = rank
+        self.total = total
+        self.local_batch = local_batch
+        self.max_batch = max_batch
+        self.every = every
+        self.compute = 0.
+        self.images = 0
+        self.batch_begin = 0.
+        self.steps = 0
+
+    def on_train_begin(self, logs=None):
+        even = balanced_batches(np.ones(self.coordinator.num_workers), self.total, unit=self.model.accumulation)
+        self.local_batch.assign(even[self.rank])
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_begin = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        # The first step traces the train function
+        if self.steps > 1:
+            self.compute += max(0., time.time() - self.batch_begin - float(logs.get('sync_time', 0.)))
+            self.images += int(logs.get('local_batch', 0))
+        if self.steps % self.every == 0:
+            _, values = self.coordinator.agree(self.rank, True, [self.compute / max(1, self.images)])
+            batches = balanced_batches(values[:, 0], self.total, unit=self.model.accumulation,
+                                       max_batch=self.max_batch)
+            self.local_batch.assign(batches[self.rank])
+            print(f"\n[MO833] Rank,{self.rank},Balanced batches,{'-'.join(str(b) for b in batches)}")
+            self.compute, self.images = 0., 0
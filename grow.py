@@ -0,0 +1,241 @@
+"""
+Grow a trained LaneCapsNet with new lanes without training the old ones again. Lanes are independent until their digit
+capsules are concatenated, so the old lanes are frozen and their digit capsules are computed once for the whole
+training and test sets and cached as memory-mapped `.npy` files in `save_dir/frozen`. The new lanes and the decoder are
+then trained against the cached capsules: a step runs only the new lanes, whatever the number of old ones.
+
+The decoder starts from the old one, its weights for the new lanes being zeros, so the grown model starts with the
+reconstructions of the old one. The images are not shift-augmented, as the cached capsules are those of the images as
+they are. The grown model is saved as a LaneCapsNet with the old lanes followed by the new ones, see the printed
+--lane_layout to load it with the other tools.
+
+Usage:
+    python grow.py -w result/trained_model.h5 --num_lanes 8 --lane_size 4 --new_lanes 4 --epochs 5 \
+        --save_dir result/grown
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import callbacks, layers, models, optimizers
+
+import datacache
+from capslayer import Length, Mask
+from capsnet import Decoder, Lane, LaneCapsNet, load_cifar, load_mnist, margin_loss
+from costmodel import format_lane_layout, parse_lane_layout
+from export import DATASETS, add_model_arguments, build_trained_model
+from lane_pool import lane_layout, lane_weights, per_lane_model
+from telemetry import Telemetry
+
+
+def frozen_digitcaps(model, x, path, batch_size=256):
+    """
+    The digit capsules of all the lanes of `model` for the images x, computed `batch_size` images at a time into the
+    memory-mapped file `path`, unless it exists.
+    :return: read-only memory map, shape=[len(x), n_class, num_lanes]
+    """
+    if not os.path.exists(path):
+        # The output of the lanes, before lane dropout
+        lanes = models.Model(model.inputs[0], model.get_layer('capsnet').input)
+        partial = path + '.partial'
+        digitcaps = np.lib.format.open_memmap(partial, mode='w+', dtype=np.float32,
+                                              shape=(len(x),) + tuple(lanes.output_shape[1:]))
+        for i in range(0, len(x), batch_size):
+            digitcaps[i:i + batch_size] = lanes.predict_on_batch(x[i:i + batch_size])
+        digitcaps.flush()
+        del digitcaps
+        os.rename(partial, path)
+    return np.load(path, mmap_mode='r')
+
+
+def cache_frozen(model, args, data, directory):
+    """
+    Cache the digit capsules of the old lanes for the training and test sets in `directory`, computed again if the
+    model, its weights or the dataset changed.
+    :return: (train, test) memory maps
+    """
+    (x_train, _), (x_test, _) = data
+    key = {'weights': os.path.abspath(args.weights), 'mtime': os.path.getmtime(args.weights),
+           'lane_layout': format_lane_layout(lane_layout(args)), 'routings': args.routings,
+           'dataset': args.dataset, 'train': len(x_train), 'test': len(x_test)}
+    os.makedirs(directory, exist_ok=True)
+    meta = os.path.join(directory, 'frozen.json')
+    if os.path.exists(meta):
+        with open(meta) as f:
+            if json.load(f) != key:
+                for name in ['train.npy', 'test.npy']:
+                    if os.path.exists(os.path.join(directory, name)):
+                        os.remove(os.path.join(directory, name))
+    begin = time.time()
+    train = frozen_digitcaps(model, x_train, os.path.join(directory, 'train.npy'))
+    test = frozen_digitcaps(model, x_test, os.path.join(directory, 'test.npy'))
+    with open(meta, 'w') as f:
+        json.dump(key, f, indent=2)
+    print('[MO833] Frozen lanes,%d,Cache,%s,Time,%.4f' % (train.shape[2], directory, time.time() - begin))
+    return train, test
+
+
+def grow_model(input_shape, n_class, args, layout, old_lanes, dropout=0.):
+    """
+    The new lanes on top of the cached digit capsules of the old ones: takes [x, frozen digit capsules, y] and gives
+    [capsule lengths, reconstruction], as a LaneCapsNet train model. Layers are named as in a LaneCapsNet of `layout`.
+    :param layout: the (size, depth) of every lane, the old ones first
+    """
+    x = layers.Input(shape=input_shape)
+    frozen = layers.Input(shape=(n_class, old_lanes))
+    y = layers.Input(shape=(n_class,))
+    outputs = [Lane(i, n_class, layout[i][0], args.lane_type, x, args.routings, stacked=layout[i][1],
+                    routing_tol=args.routing_tol) for i in range(old_lanes, len(layout))]
+    new = layers.Concatenate(axis=1)(outputs) if len(outputs) > 1 else outputs[0]
+    # digitcaps.shape=[None, n_class, num_lanes], the old lanes first
+    digitcaps = layers.Concatenate(axis=2)([frozen, layers.Permute([2, 1])(new)])
+    dropped = layers.Dropout(dropout, (1, len(layout)))(digitcaps)
+    out_caps = Length(name='capsnet')(dropped)
+    decoder = Decoder(input_shape, n_class, len(layout))
+    return models.Model([x, frozen, y], [out_caps, decoder(Mask()([digitcaps, y]))])
+
+
+def grow_decoder(old, new, n_class, old_lanes):
+    """
+    Set the weights of the decoder `new` from those of `old`, the weights of the first layer for the new lanes being
+    zeros. The masked capsules are flattened class by class, lanes within a class.
+    """
+    weights = old.get_weights()
+    kernel = weights[0].reshape(n_class, old_lanes, -1)
+    grown = np.zeros((n_class, new.input_shape[1] // n_class, kernel.shape[2]), dtype=kernel.dtype)
+    grown[:, :old_lanes] = kernel
+    new.set_weights([grown.reshape(-1, kernel.shape[2])] + weights[1:])
+
+
+def dataset(x, y, frozen, batch_size, n_class, shuffle=True):
+    """
+    Batches of ((x, frozen digit capsules, y), (y, x)), read by index from the arrays, which can be memory-mapped.
+    """
+    def gather(indices):
+        return x[indices], frozen[indices], y[indices]
+
+    def batch(indices):
+        images, digitcaps, labels = tf.numpy_function(gather, [indices], [tf.float32, tf.float32,
+                                                                          tf.as_dtype(y.dtype)])
+        images = tf.ensure_shape(images, (None,) + tuple(x.shape[1:]))
+        digitcaps = tf.ensure_shape(digitcaps, (None,) + tuple(frozen.shape[1:]))
+        if y.ndim == 1:
+            labels = tf.one_hot(tf.cast(labels, tf.int32), n_class)
+        labels = tf.ensure_shape(tf.cast(labels, tf.float32), (None, n_class))
+        return (images, digitcaps, labels), (labels, images)
+
+    indices = tf.data.Dataset.from_tensor_slices(np.arange(len(x)))
+    if shuffle:
+        indices = indices.shuffle(len(x), reshuffle_each_iteration=True)
+    return indices.batch(batch_size, drop_remainder=shuffle).map(batch).prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def median_step(model, data, repeats=10):
+    model.train_on_batch(*data)
+    times = []
+    for _ in range(repeats):
+        begin = time.time()
+        model.train_on_batch(*data)
+        times.append(time.time() - begin)
+    return float(np.median(times))
+
+
+def grow(args, data, n_class):
+    """
+    Train the new lanes and the decoder and save the grown model to `args.save_dir/trained_model.h5`.
+    :return: the grown LaneCapsNet train model
+    """
+    assert args.lane_ids is None, 'Grow a model with all its lanes'
+    (x_train, y_train), (x_test, y_test) = data
+    input_shape = x_train.shape[1:]
+    old_layout = lane_layout(args)
+    layout = old_layout + (args.new_lane_layout or [(args.new_lane_size or old_layout[-1][0],
+                                                     args.new_lane_depth or old_layout[-1][1])] * args.new_lanes)
+    old_lanes = len(old_layout)
+
+    old_model, _, _ = build_trained_model(args)
+    old_model = per_lane_model(old_model, args)
+    frozen_train, frozen_test = cache_frozen(old_model, args, data, os.path.join(args.save_dir, 'frozen'))
+
+    model = grow_model(input_shape, n_class, args, layout, old_lanes, dropout=args.dropout)
+    grow_decoder(old_model.get_layer('decoder'), model.get_layer('decoder'), n_class, old_lanes)
+    model.compile(optimizer=optimizers.legacy.Adam(learning_rate=args.lr), loss=[margin_loss, 'mse'],
+                  loss_weights=[1., args.lam_recon], metrics={'capsnet': 'accuracy'})
+    model.summary()
+
+    telemetry = Telemetry(args.save_dir)
+    lr_decay = callbacks.LearningRateScheduler(schedule=lambda epoch: args.lr * (args.lr_decay ** epoch))
+    history = model.fit(dataset(x_train, y_train, frozen_train, args.batch_size, n_class), epochs=args.epochs,
+                        validation_data=dataset(x_test, y_test, frozen_test, args.batch_size, n_class, shuffle=False),
+                        callbacks=[telemetry, lr_decay, callbacks.CSVLogger(args.save_dir + '/log.csv')])
+    step_time = telemetry.phases['step'].sketch.quantile(0.5)
+
+    # The grown model as a whole: the old lanes from the old model, the new ones and the decoder just trained
+    grown, _, _ = LaneCapsNet(input_shape, n_class, args.routings, lanetype=args.lane_type, gpus=0,
+                              routing_tol=args.routing_tol, lane_layout=layout)
+    for name, value in lane_weights(old_model, range(old_lanes), old_layout).items():
+        grown.get_layer(name).set_weights(value)
+    for name, value in lane_weights(model, range(old_lanes, len(layout)), layout).items():
+        grown.get_layer(name).set_weights(value)
+    grown.get_layer('decoder').set_weights(model.get_layer('decoder').get_weights())
+    grown.save_weights(args.save_dir + '/trained_model.h5')
+
+    summary = {'lane_layout': format_lane_layout(layout), 'old_lanes': old_lanes, 'new_lanes': len(layout) - old_lanes,
+               'step_time': step_time,
+               'metrics': {key: float(values[-1]) for key, values in history.history.items()}}
+    print('[MO833] Grow,Old lanes,%d,New lanes,%d,Step time,%.4f' % (old_lanes, len(layout) - old_lanes, step_time))
+    if args.compare:
+        # A step of the whole grown model, as when fine-tuning every lane
+        grown.compile(optimizer=optimizers.legacy.Adam(learning_rate=args.lr), loss=[margin_loss, 'mse'],
+                      loss_weights=[1., args.lam_recon])
+        x = np.asarray(x_train[:args.batch_size])
+        y = np.asarray(y_train[:args.batch_size])
+        y = np.eye(n_class, dtype=np.float32)[y] if y.ndim == 1 else y
+        summary['full_step_time'] = median_step(grown, ([x, y], [y, x]))
+        print('[MO833] Grow,Lanes,%d,Full model step time,%.4f' % (len(layout), summary['full_step_time']))
+    with open(args.save_dir + '/grow.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+    print('Grown model saved to \'%s/trained_model.h5\', load it with --lane_layout %s' %
+          (args.save_dir, summary['lane_layout']))
+    return grown
+
+
+if __name__ == "__main__":
+    parser = add_model_arguments(argparse.ArgumentParser(description="Grow a trained LaneCapsNet with new lanes"))
+    parser.add_argument('--new_lanes', default=4, type=int,
+                        help="Number of lanes added")
+    parser.add_argument('--new_lane_size', default=None, type=int,
+                        help="Size of the new lanes, that of the last old lane by default")
+    parser.add_argument('--new_lane_depth', default=None, type=int,
+                        help="Depth of the new lanes, that of the last old lane by default")
+    parser.add_argument('--new_lane_layout', default=None, type=parse_lane_layout,
+                        help="Size and depth of every new lane, see costmodel.py. Overrides --new_lanes, "
+                             "--new_lane_size and --new_lane_depth")
+    parser.add_argument('--epochs', default=2, type=int)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--lr', default=0.001, type=float)
+    parser.add_argument('--lr_decay', default=0.9, type=float)
+    parser.add_argument('--lam_recon', default=0.392, type=float)
+    parser.add_argument('--dropout', default=0, type=float)
+    parser.add_argument('--data_cache', default=datacache.DEFAULT_CACHE_DIR,
+                        help="Directory of the preprocessed dataset cache, see datacache.py. '' loads the dataset in "
+                             "this process only")
+    parser.add_argument('--compare', action='store_true',
+                        help="Also time a training step of the whole grown model")
+    parser.add_argument('--save_dir', default='./result/grown')
+    args = parser.parse_args()
+    if args.lane_layout is not None:
+        args.num_lanes = len(args.lane_layout)
+    assert args.weights is not None, 'Grow a trained model, given with -w'
+    os.makedirs(args.save_dir, exist_ok=True)
+
+    if args.data_cache:
+        data, n_class = datacache.load(args.dataset, args.data_cache)
+    else:
+        data = load_mnist() if args.dataset == 'mnist' else load_cifar()
+        n_class = DATASETS[args.dataset][1]
+    grow(args, data, n_class)
@@ -0,0 +1,347 @@
+"""
+Lane model-parallel training. Lanes only meet at the concatenation of their digit capsules, so instead of every worker
+holding all the lanes and all-reducing all their gradients (`MultiWorkerMirroredStrategy`), every worker owns a subset
+of the lanes and trains it on the whole batch. Worker 0 also owns `Length`, the decoder and the loss: every step the
+other workers send it the digit capsules of their lanes, shape=[batch, n_class, lanes], and it sends them back the
+gradients of the loss with respect to them. That is n_class floats per image and lane each way, instead of all the
+weights.
+
+Every worker reads the same batches, shuffled and shift-augmented with the same seed, so images are never sent. The
+lanes are partitioned into contiguous groups of about the same FLOPs (see costmodel.py). At the end worker 0 gathers
+the weights of all the lanes and saves them as a LaneCapsNet model, loadable with `capsnet.py -w`.
+
+Workers connect with `multiprocessing.connection` to the address of worker 0 in the cluster configuration, the same
+TF_CONFIG format as capsnet.py. On one host, in two shells:
+    python lane_parallel.py --config config/config0.json --num_lanes 16 --lane_size 2 --epochs 10
+    python lane_parallel.py --config config/config1.json --num_lanes 16 --lane_size 2 --epochs 10
+"""
+
+import argparse
+import json
+import os
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import backend as K
+from tensorflow.keras import layers, models, optimizers
+
+from capslayer import Length, Mask
+from capsnet import Decoder, Lane, LaneCapsNet, load_cifar, load_mnist, margin_loss
+from costmodel import lane_cost, model_cost
+from export import add_model_arguments, build_trained_model
+from lane_pool import lane_layout
+
+
+def partition_lanes(lanes, input_shape, n_class, num_workers):
+    """
+    Split the lanes into `num_workers` contiguous groups of about the same FLOPs, at least one lane each.
+    :param lanes: the (size, depth) of every lane
+    :return: list of the lane ids of every worker
+    """
+    assert len(lanes) >= num_workers, 'Every worker needs at least one lane'
+    flops = [lane_cost(input_shape, n_class, size, depth)['flops'] for size, depth in lanes]
+    cumulative = np.cumsum(flops) / np.sum(flops)
+    partitions, start = [], 0
+    for w in range(num_workers):
+        end = int(np.argmin(np.abs(cumulative - (w + 1) / num_workers))) + 1
+        end = min(max(end, start + 1), len(lanes) - (num_workers - w - 1))
+        partitions.append(list(range(start, end)))
+        start = end
+    return partitions
+
+
+def lane_model(input_shape, n_class, args, lanes, lane_ids):
+    """
+    The lanes `lane_ids` of a LaneCapsNet, from images to their digit capsules, shape=[None, n_class, len(lane_ids)].
+    Layers are named as in LaneCapsNet.
+    """
+    x = layers.Input(shape=input_shape)
+    outputs = [Lane(i, n_class, lanes[i][0], args.lane_type, x, args.routings, stacked=lanes[i][1],
+                    routing_tol=args.routing_tol) for i in lane_ids]
+    digitcaps = layers.Concatenate(axis=1)(outputs) if len(outputs) > 1 else outputs[0]
+    return models.Model(x, layers.Permute([2, 1])(digitcaps))
+
+
+def head_model(input_shape, n_class, num_lanes, dropout=0.):
+    """
+    Where all the lanes meet: from the digit capsules of every lane and the labels to the capsule lengths and the
+    reconstruction, as in LaneCapsNet.
+    """
+    digitcaps = layers.Input(shape=(n_class, num_lanes))
+    y = layers.Input(shape=(n_class,))
+    dropped = layers.Dropout(dropout, (1, num_lanes))(digitcaps)
+    out_caps = Length(name='capsnet')(dropped)
+    decoder = Decoder(input_shape, n_class, num_lanes)
+    return models.Model([digitcaps, y], [out_caps, decoder(Mask()([digitcaps, y]))])
+
+
+def shift_batch(x, shift_fraction, rng):
+    """
+    Randomly shift every image of a batch by up to `shift_fraction` of its size in each direction, filling with zeros,
+    as `pipeline.shift`.
+    """
+    n, height, width, _ = x.shape
+    pad_height, pad_width = int(round(height * shift_fraction)), int(round(width * shift_fraction))
+    padded = np.pad(x, [[0, 0], [pad_height, pad_height], [pad_width, pad_width], [0, 0]])
+    rows = rng.randint(0, 2 * pad_height + 1, n)[:, None] + np.arange(height)
+    cols = rng.randint(0, 2 * pad_width + 1, n)[:, None] + np.arange(width)
+    return padded[np.arange(n)[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+
+def batches(x, y, batch_size, epoch, seed, shift_fraction=0.):
+    """
+    The training batches of an epoch, the same on every worker for the same seed.
+    """
+    rng = np.random.RandomState(seed + epoch)
+    order = rng.permutation(len(x))
+    for i in range(len(x) // batch_size):
+        index = order[i * batch_size:(i + 1) * batch_size]
+        x_batch = shift_batch(x[index], shift_fraction, rng) if shift_fraction > 0 else x[index]
+        yield x_batch, y[index]
+
+
+class Exchange(object):
+    """
+    The links between worker 0 and the others. Arrays are sent as raw float32 bytes, their shapes being known to both
+    ends.
+
+    :param address: (host, port) of worker 0
+    :param rank: index of this worker
+    :param num_workers: number of workers
+    """
+    def __init__(self, address, rank, num_workers, authkey=b'lane_parallel'):
+        self.rank = rank
+        self.seconds = 0.
+        self.bytes = 0
+        self.conns = {}
+        if rank == 0:
+            self.listener = Listener(address, authkey=authkey)
+            while len(self.conns) < num_workers - 1:
+                conn = self.listener.accept()
+                self.conns[conn.recv()] = conn
+        else:
+            while True:
+                try:
+                    conn = Client(address, authkey=authkey)
+                    break
+                except ConnectionRefusedError:
+                    time.sleep(1)
+            conn.send(rank)
+            self.conns[0] = conn
+
+    def send(self, rank, array):
+        begin = time.perf_counter()
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        self.conns[rank].send_bytes(array)
+        self.bytes += array.nbytes
+        self.seconds += time.perf_counter() - begin
+
+    def recv(self, rank, shape):
+        begin = time.perf_counter()
+        array = np.empty(shape, dtype=np.float32)
+        # A byte view, as a multi-dimensional buffer is sized by its first dimension only
+        self.conns[rank].recv_bytes_into(memoryview(array).cast('B'))
+        self.bytes += array.nbytes
+        self.seconds += time.perf_counter() - begin
+        return array
+
+    def close(self):
+        for conn in self.conns.values():
+            conn.close()
+        if self.rank == 0:
+            self.listener.close()
+
+
+class LaneParallelTrainer(object):
+    """
+    The part of a lane model-parallel LaneCapsNet trained by one worker: its lanes, and on worker 0 also the head
+    (`Length`, decoder and loss).
+
+    :param partitions: the lane ids of every worker, see `partition_lanes`
+    """
+    def __init__(self, args, input_shape, n_class, rank, partitions, exchange):
+        self.args = args
+        self.rank = rank
+        self.partitions = partitions
+        self.exchange = exchange
+        self.n_class = n_class
+        self.lanes = lane_layout(args)
+        self.lane_model = lane_model(input_shape, n_class, args, self.lanes, partitions[rank])
+        self.optimizer = optimizers.legacy.Adam(learning_rate=args.lr)
+        self.variables = self.lane_model.trainable_variables
+        if rank == 0:
+            self.head = head_model(input_shape, n_class, len(self.lanes), args.dropout)
+            self.variables = self.variables + self.head.trainable_variables
+        self.length = Length()
+        self.train_step = tf.function(self._train_step)
+        self.eval_step = tf.function(self._eval_step)
+
+    def _gather(self, digitcaps):
+        # Worker 0: the digit capsules of all the lanes, in lane order
+        gathered = [digitcaps] + [self.exchange.recv(w, (len(digitcaps), self.n_class, len(lane_ids)))
+                                  for w, lane_ids in enumerate(self.partitions) if w > 0]
+        return np.concatenate(gathered, axis=2)
+
+    def _scatter(self, gradients):
+        # Worker 0: send every worker the gradients of its lanes, keep its own
+        for w, lane_ids in enumerate(self.partitions):
+            if w > 0:
+                self.exchange.send(w, gradients[:, :, lane_ids[0]:lane_ids[-1] + 1])
+        return gradients[:, :, :len(self.partitions[0])]
+
+    def _send_recv(self, digitcaps):
+        # Other workers: send the digit capsules of their lanes, get back their gradients
+        self.exchange.send(0, digitcaps)
+        return self.exchange.recv(0, digitcaps.shape)
+
+    def _send(self, digitcaps):
+        self.exchange.send(0, digitcaps)
+        return np.float32(0.)
+
+    def _train_step(self, x, y):
+        with tf.GradientTape() as lane_tape:
+            digitcaps = self.lane_model(x, training=True)
+        if self.rank > 0:
+            gradients = tf.numpy_function(self._send_recv, [digitcaps], tf.float32)
+            gradients.set_shape(digitcaps.shape)
+            lane_gradients = lane_tape.gradient(digitcaps, self.variables, output_gradients=gradients)
+            self.optimizer.apply_gradients(zip(lane_gradients, self.variables))
+            return tf.constant(0.), tf.constant(0.)
+
+        all_digitcaps = tf.numpy_function(self._gather, [digitcaps], tf.float32)
+        all_digitcaps.set_shape([x.shape[0], self.n_class, len(self.lanes)])
+        with tf.GradientTape() as head_tape:
+            head_tape.watch(all_digitcaps)
+            out_caps, x_recon = self.head([all_digitcaps, y], training=True)
+            loss = margin_loss(y, out_caps) + self.args.lam_recon * tf.reduce_mean(tf.square(x - x_recon))
+        head_gradients = head_tape.gradient(loss, [all_digitcaps] + self.head.trainable_variables)
+        gradients = tf.numpy_function(self._scatter, [head_gradients[0]], tf.float32)
+        gradients.set_shape(digitcaps.shape)
+        lane_gradients = lane_tape.gradient(digitcaps, self.lane_model.trainable_variables,
+                                            output_gradients=gradients)
+        self.optimizer.apply_gradients(zip(lane_gradients + head_gradients[1:], self.variables))
+        accuracy = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(out_caps, 1), tf.argmax(y, 1)), tf.float32))
+        return loss, accuracy
+
+    def _eval_step(self, x, y):
+        digitcaps = self.lane_model(x, training=False)
+        if self.rank > 0:
+            tf.numpy_function(self._send, [digitcaps], tf.float32)
+            return tf.constant(0.)
+        all_digitcaps = tf.numpy_function(self._gather, [digitcaps], tf.float32)
+        all_digitcaps.set_shape([x.shape[0], self.n_class, len(self.lanes)])
+        out_caps = self.length(all_digitcaps)
+        return tf.reduce_sum(tf.cast(tf.equal(tf.argmax(out_caps, 1), tf.argmax(y, 1)), tf.float32))
+
+    def weights(self):
+        """
+        The weights of the layers of this worker, by layer name.
+        """
+        weights = {layer.name: layer.get_weights() for layer in self.lane_model.layers if layer.weights}
+        if self.rank == 0:
+            weights['decoder'] = self.head.get_layer('decoder').get_weights()
+        return weights
+
+    def set_weights(self, model):
+        """
+        Set the weights of this worker's layers from a LaneCapsNet model with the same layer names.
+        """
+        for name, _ in self.weights().items():
+            target = self.head.get_layer(name) if name == 'decoder' else self.lane_model.get_layer(name)
+            target.set_weights(model.get_layer(name).get_weights())
+
+
+def train(args, data, rank, num_workers, address):
+    """
+    Train this worker's part of the model. Worker 0 saves the whole model to `args.save_dir/trained_model.h5`.
+    """
+    (x_train, y_train), (x_test, y_test) = data
+    input_shape, n_class = x_train.shape[1:], y_train.shape[1]
+    lanes = lane_layout(args)
+    partitions = partition_lanes(lanes, input_shape, n_class, num_workers)
+    exchange = Exchange(address, rank, num_workers)
+    trainer = LaneParallelTrainer(args, input_shape, n_class, rank, partitions, exchange)
+    if args.weights is not None:
+        trainer.set_weights(build_trained_model(args)[0])
+
+    steps = len(x_train) // args.batch_size
+    print('[MO833] Rank,%d,Lanes,%s,Params,%d' % (rank, '-'.join(str(i) for i in partitions[rank]),
+                                                  trainer.lane_model.count_params()))
+    if rank == 0:
+        print('[MO833] Exchanged bytes per step,%d,All-reduced bytes per step,%d' %
+              (2 * 4 * args.batch_size * n_class * (len(lanes) - len(partitions[0])),
+               4 * model_cost(input_shape, n_class, lanes)['train']['params']))
+
+    log = []
+    for epoch in range(args.epochs):
+        K.set_value(trainer.optimizer.learning_rate, args.lr * (args.lr_decay ** epoch))
+        exchange.seconds, exchange.bytes = 0., 0
+        begin = time.time()
+        losses, accuracies = [], []
+        for x, y in batches(x_train, y_train, args.batch_size, epoch, args.seed, args.shift_fraction):
+            loss, accuracy = trainer.train_step(tf.constant(x), tf.constant(y))
+            losses.append(float(loss))
+            accuracies.append(float(accuracy))
+        elapsed = time.time() - begin
+        print('[MO833] Rank,%d,Epoch,%d,Step time,%.4f,Exchange time,%.4f,Exchanged MB,%.3f' %
+              (rank, epoch, elapsed / steps, exchange.seconds / steps, exchange.bytes / 2. ** 20))
+
+        correct = 0.
+        for i in range(0, len(x_test) - args.batch_size + 1, args.batch_size):
+            correct += float(trainer.eval_step(tf.constant(x_test[i:i + args.batch_size]),
+                                               tf.constant(y_test[i:i + args.batch_size])))
+        if rank == 0:
+            val_accuracy = correct / ((len(x_test) // args.batch_size) * args.batch_size)
+            log.append({'epoch': epoch, 'loss': float(np.mean(losses)), 'capsnet_accuracy': float(np.mean(accuracies)),
+                        'val_capsnet_accuracy': val_accuracy, 'time': elapsed})
+            print('Epoch %d: loss %.4f, accuracy %.4f, val_accuracy %.4f' %
+                  (epoch, log[-1]['loss'], log[-1]['capsnet_accuracy'], val_accuracy))
+
+    # Gather the weights of every lane in worker 0
+    if rank == 0:
+        weights = trainer.weights()
+        for w in range(1, num_workers):
+            weights.update(exchange.conns[w].recv())
+        model, _, _ = LaneCapsNet(input_shape, n_class, args.routings, gpus=0, lane_layout=lanes)
+        for name, value in weights.items():
+            model.get_layer(name).set_weights(value)
+        model.save_weights(os.path.join(args.save_dir, 'trained_model.h5'))
+        with open(os.path.join(args.save_dir, 'lane_parallel.json'), 'w') as f:
+            json.dump({'partitions': partitions, 'epochs': log}, f, indent=2)
+        print('Trained model saved to \'%s/trained_model.h5\'' % args.save_dir)
+    else:
+        exchange.conns[0].send(trainer.weights())
+    exchange.close()
+
+
+if __name__ == "__main__":
+    parser = add_model_arguments(argparse.ArgumentParser(description="Lane model-parallel LaneCapsNet training"))
+    parser.add_argument('--config', default='tf_config.json',
+                        help="Cluster configuration, as TF_CONFIG. Worker 0 listens on its address")
+    parser.add_argument('--epochs', default=2, type=int)
+    parser.add_argument('--batch_size', default=32, type=int,
+                        help="Every worker runs its lanes on the whole batch")
+    parser.add_argument('--lr', default=0.001, type=float)
+    parser.add_argument('--lr_decay', default=0.9, type=float)
+    parser.add_argument('--lam_recon', default=0.392, type=float)
+    parser.add_argument('--shift_fraction', default=0.1, type=float)
+    parser.add_argument('--dropout', default=0, type=float)
+    parser.add_argument('--seed', default=0, type=int,
+                        help="Seed of the order and augmentation of the batches, the same on every worker")
+    parser.add_argument('--save_dir', default='./result')
+    args = parser.parse_args()
+    if args.lane_layout is not None:
+        args.num_lanes = len(args.lane_layout)
+    assert not args.fused_lanes and args.lane_ids is None, 'Lane model-parallel training runs separate lanes'
+
+    with open(args.config) as f:
+        tf_config = json.load(f)
+    workers = tf_config['cluster']['worker']
+    rank = tf_config['task']['index']
+    host, port = workers[0].rsplit(':', 1)
+    os.makedirs(args.save_dir, exist_ok=True)
+
+    data = load_mnist() if args.dataset == 'mnist' else load_cifar()
+    train(args, data, rank, len(workers), (host, int(port)))
@@ -0,0 +1,286 @@
+"""
+Lane-parallel CPU inference. The lanes of a trained LaneCapsNet are independent until their digit capsules are
+concatenated, so they are partitioned across a pool of long-lived worker processes, each pinned to its own cores and
+holding its lanes' weights. For every batch each worker computes the digit capsules of its lanes, and the driver
+assembles the [batch, n_class, num_lanes] tensor and applies `Length`.
+
+Usage:
+    python lane_pool.py -w result/trained_model.h5 --num_lanes 16 --lane_size 8 --workers 4
+    python lane_pool.py --benchmark --lanes 2 4 8 16 32 --workers 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def _lane_worker(conn, shm_name, max_batch, input_shape, n_class, args, lane_ids, weights, cores):
+    """
+    Worker process: build the lanes `lane_ids`, then compute their digit capsules for every batch put in the shared
+    memory block until told to stop.
+    """
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    import tensorflow as tf
+    from tensorflow.keras import layers, models
+    from capsnet import Lane
+
+    threads = len(cores) if cores else 1
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    x = layers.Input(shape=input_shape)
+    layout = lane_layout(args)
+    lanes = [Lane(i, n_class, layout[i][0], args.lane_type, x, args.routings, stacked=layout[i][1],
+                  routing_tol=args.routing_tol) for i in lane_ids]
+    # digitcaps.shape=[None, len(lane_ids), n_class]
+    digitcaps = layers.Concatenate(axis=1)(lanes) if len(lanes) > 1 else lanes[0]
+    model = models.Model(x, digitcaps)
+    for name, value in weights.items():
+        model.get_layer(name).set_weights(value)
+
+    predict = tf.function(lambda batch: model(batch, training=False),
+                          input_signature=[tf.TensorSpec([None] + list(input_shape), tf.float32)])
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    inputs = np.ndarray((max_batch,) + tuple(input_shape), dtype=np.float32, buffer=shm.buf)
+    conn.send('ready')
+    while True:
+        n = conn.recv()
+        if n is None:
+            break
+        conn.send(predict(inputs[:n]).numpy())
+    del inputs
+    shm.close()
+
+
+def lane_layout(args):
+    """
+    The (size, depth) of every lane of the model described by `args`.
+    """
+    if args.lane_layout is not None:
+        return args.lane_layout
+    return [(args.lane_size, args.lane_depth)] * args.num_lanes
+
+
+def lane_weights(model, lane_ids, layout):
+    """
+    The weights of the layers of lanes `lane_ids` of a per-lane LaneCapsNet, by layer name.
+    :param layout: the (size, depth) of every lane, see `lane_layout`
+    """
+    weights = {}
+    for i in lane_ids:
+        names = ['digitcaps' + str(i)]
+        for d in range(layout[i][1]):
+            names += ['conv1' + str(i) + 'd' + str(d), 'primarycap_conv2d' + str(i + 1000*d)]
+        for name in names:
+            weights[name] = model.get_layer(name).get_weights()
+    return weights
+
+
+def per_lane_model(model, args):
+    """
+    `model` itself if its lanes are separate layers, otherwise an equivalent per-lane LaneCapsNet train model with the
+    weights of its fused lanes.
+    """
+    from capsnet import LaneCapsNet
+    try:
+        fused = model.get_layer('fused_lanes')
+    except ValueError:
+        return model
+    input_shape, n_class = model.input_shape[0][1:], model.output_shape[0][-1]
+    lane_model, _, _ = LaneCapsNet(input_shape, n_class, args.routings, num_lanes=args.num_lanes,
+                                   lanesize=args.lane_size, lanedepth=args.lane_depth, lanetype=args.lane_type, gpus=0,
+                                   lane_layout=args.lane_layout)
+    fused.store_lane_weights(lane_model)
+    return lane_model
+
+
+class LanePool(object):
+    """
+    Pool of worker processes computing the lanes of a per-lane LaneCapsNet `model`, partitioned into `num_workers`
+    contiguous groups. Worker w is pinned to cores [w*cores_per_worker, (w+1)*cores_per_worker).
+
+    :param model: a per-lane LaneCapsNet train model with trained weights, see `per_lane_model`
+    :param args: the architecture arguments of the model (num_lanes, lane_size, lane_depth, lane_layout, lane_type,
+        routings)
+    :param max_batch: largest batch that can be predicted at once
+    """
+    def __init__(self, model, args, input_shape, n_class, num_workers=2, cores_per_worker=None, max_batch=256):
+        self.num_lanes = args.num_lanes
+        self.n_class = n_class
+        self.input_shape = tuple(input_shape)
+        self.max_batch = max_batch
+        num_workers = min(num_workers, self.num_lanes)
+        if cores_per_worker is None:
+            cores_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max_batch * int(np.prod(input_shape)) * 4)
+        self.inputs = np.ndarray((max_batch,) + self.input_shape, dtype=np.float32, buffer=self.shm.buf)
+
+        context = multiprocessing.get_context('spawn')
+        self.partitions = np.array_split(np.arange(self.num_lanes), num_workers)
+        self.conns, self.workers = [], []
+        for w, lane_ids in enumerate(self.partitions):
+            lane_ids = [int(i) for i in lane_ids]
+            cores = [c % (os.cpu_count() or 1) for c in range(w * cores_per_worker, (w + 1) * cores_per_worker)]
+            conn, child_conn = context.Pipe()
+            worker = context.Process(target=_lane_worker, daemon=True,
+                                     args=(child_conn, self.shm.name, max_batch, self.input_shape, n_class, args,
+                                           lane_ids, lane_weights(model, lane_ids, lane_layout(args)), cores))
+            worker.start()
+            # Only the worker holds its end, so that the pipe reports the worker's death
+            child_conn.close()
+            self.conns.append(conn)
+            self.workers.append(worker)
+        try:
+            for w in range(len(self.workers)):
+                assert self._recv(w) == 'ready'
+        except Exception:
+            self.close()
+            raise
+
+    def _dead(self, w):
+        self.workers[w].join(1.)
+        return RuntimeError('Lane worker %d (lanes %s) exited with code %s' %
+                            (w, [int(i) for i in self.partitions[w]], self.workers[w].exitcode))
+
+    def _send(self, w, message):
+        try:
+            self.conns[w].send(message)
+        except OSError:
+            raise self._dead(w)
+
+    def _recv(self, w, poll_secs=1.):
+        """
+        The next message of worker `w`, raising a RuntimeError if the worker dies instead of waiting forever.
+        """
+        conn, worker = self.conns[w], self.workers[w]
+        try:
+            while not conn.poll(poll_secs):
+                if not worker.is_alive() and not conn.poll():
+                    raise EOFError
+            return conn.recv()
+        except (EOFError, OSError):
+            raise self._dead(w)
+
+    def digitcaps(self, x):
+        """
+        :param x: images, shape=[n, width, height, channels], n <= max_batch
+        :return: digit capsules, shape=[n, n_class, num_lanes]
+        """
+        n = len(x)
+        self.inputs[:n] = x
+        for w in range(len(self.workers)):
+            self._send(w, n)
+        digitcaps = np.empty([n, self.n_class, self.num_lanes], dtype=np.float32)
+        for w, lane_ids in enumerate(self.partitions):
+            # [n, len(lane_ids), n_class] -> [n, n_class, len(lane_ids)]
+            digitcaps[:, :, lane_ids] = np.transpose(self._recv(w), [0, 2, 1])
+        return digitcaps
+
+    def predict(self, x):
+        """
+        Capsule lengths of any number of images, `max_batch` images at a time.
+        :return: shape=[None, n_class]
+        """
+        outputs = []
+        for i in range(0, len(x), self.max_batch):
+            digitcaps = self.digitcaps(x[i:i + self.max_batch])
+            # Length
+            outputs.append(np.sqrt(np.sum(np.square(digitcaps), -1) + 1e-7))
+        return np.concatenate(outputs)
+
+    def close(self):
+        for conn, worker in zip(self.conns, self.workers):
+            try:
+                conn.send(None)
+            except OSError:
+                # The worker is dead already
+                pass
+            worker.join(10)
+            if worker.is_alive():
+                worker.terminate()
+            conn.close()
+        del self.inputs
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _time(fn, x, repeats):
+    fn(x)  # warm up
+    latencies = []
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        fn(x)
+        latencies.append(time.perf_counter() - begin)
+    return float(np.median(latencies))
+
+
+def benchmark(args, lane_counts, batch_size, repeats, num_workers):
+    """
+    Latency and throughput of the classification output of the monolithic model against the lane pool, as the number
+    of lanes grows. The models are randomly initialized, unless `args.weights` is given.
+    """
+    from export import DATASETS, build_trained_model, classifier
+
+    input_shape, n_class = DATASETS[args.dataset]
+    x = np.random.rand(batch_size, *input_shape).astype(np.float32)
+    results = []
+    for num_lanes in lane_counts:
+        args.num_lanes = num_lanes
+        model, _, _ = build_trained_model(args)
+        clf = classifier(model)
+        model = per_lane_model(model, args)
+        monolithic = _time(lambda batch: clf.predict_on_batch(batch), x, repeats)
+        pool = LanePool(model, args, input_shape, n_class, num_workers=num_workers, max_batch=batch_size)
+        pooled = _time(pool.predict, x, repeats)
+        pool.close()
+        results.append({'num_lanes': num_lanes, 'workers': min(num_workers, num_lanes), 'batch_size': batch_size,
+                        'monolithic_latency': monolithic, 'monolithic_throughput': batch_size / monolithic,
+                        'pool_latency': pooled, 'pool_throughput': batch_size / pooled})
+        print('[MO833] Lanes,%d,Monolithic latency,%.4f,Throughput,%.1f,Pool latency,%.4f,Throughput,%.1f' %
+              (num_lanes, monolithic, batch_size / monolithic, pooled, batch_size / pooled))
+    return results
+
+
+if __name__ == "__main__":
+    from export import DATASETS, add_model_arguments, build_trained_model
+
+    parser = add_model_arguments(argparse.ArgumentParser(description="Lane-parallel CPU inference"))
+    parser.add_argument('--workers', default=2, type=int,
+                        help="Number of worker processes")
+    parser.add_argument('--batch_size', default=100, type=int)
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Compare the monolithic classifier with the lane pool")
+    parser.add_argument('--lanes', default=[2, 4, 8, 16, 32], type=int, nargs='+',
+                        help="Numbers of lanes to benchmark")
+    parser.add_argument('--repeats', default=20, type=int)
+    parser.add_argument('--output', default=None,
+                        help="Write the benchmark results to this JSON file")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        results = benchmark(args, args.lanes, args.batch_size, args.repeats, args.workers)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+    else:
+        from capsnet import load_mnist, load_cifar
+        input_shape, n_class = DATASETS[args.dataset]
+        model, _, _ = build_trained_model(args)
+        model = per_lane_model(model, args)
+        _, (x_test, y_test) = load_mnist() if args.dataset == 'mnist' else load_cifar()
+        pool = LanePool(model, args, input_shape, n_class, num_workers=args.workers, max_batch=args.batch_size)
+        begin = time.time()
+        y_pred = pool.predict(x_test)
+        elapsed = time.time() - begin
+        pool.close()
+        print('Test acc:', np.mean(np.argmax(y_pred, 1) == np.argmax(y_test, 1)))
+        print('[MO833] Workers,%d,Images,%d,Time,%.4f,Throughput,%.1f' %
+              (args.workers, len(x_test), elapsed, len(x_test) / elapsed))
@@ -0,0 +1,166 @@
+"""
+Lane importance and pruning. Every lane of a LaneCapsNet adds one dimension to every digit capsule, so lanes can be
+removed from a trained model without retraining the others. The digit capsules of a validation set are computed once;
+each lane is then scored by ablation (the accuracy lost without it) and by its share of the length of the true class
+capsule, and lanes are added greedily, best first, until the accuracy target is met. The model with only those lanes,
+and the matching rows of the decoder input, is saved and its classifier exported.
+
+capsnet.py trains on the whole training set, so the lanes are selected on the first `--num_val` images of the test set
+and the accuracy of the pruned model is reported on the rest of it, which neither training nor selection has seen.
+
+Usage:
+    python lane_prune.py -w result/trained_model.h5 --num_lanes 16 --lane_size 8 --max_drop 0.005 \
+        --save_dir result/pruned
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from tensorflow.keras import models
+
+from capsnet import LaneCapsNet
+from export import DATASETS, add_model_arguments, build_trained_model, classifier, export_classifier
+from lane_pool import per_lane_model
+
+
+def digit_capsules(model, x, batch_size=256):
+    """
+    :return: the digit capsules of a LaneCapsNet train model for images x, shape=[None, n_class, num_lanes]
+    """
+    digitcaps = models.Model(model.inputs[0], model.get_layer('capsnet').input)
+    return digitcaps.predict(x, batch_size=batch_size, verbose=0)
+
+
+def subset_accuracy(digitcaps, y, lanes):
+    """
+    Accuracy of the model made of `lanes` only, from the digit capsules of the full model.
+    """
+    lengths = np.sum(np.square(digitcaps[:, :, lanes]), -1)
+    return float(np.mean(np.argmax(lengths, 1) == np.argmax(y, 1)))
+
+
+def lane_scores(digitcaps, y):
+    """
+    :return: accuracy of all the lanes, and for every lane a dict with its ablation score (accuracy lost without it)
+        and its length contribution (mean share of the squared length of the true class capsule)
+    """
+    num_lanes = digitcaps.shape[2]
+    accuracy = subset_accuracy(digitcaps, y, list(range(num_lanes)))
+    # true.shape=[None, num_lanes], the true class capsule of every image
+    true = np.square(digitcaps[np.arange(len(y)), np.argmax(y, 1)])
+    contribution = np.mean(true / np.maximum(np.sum(true, -1, keepdims=True), 1e-12), 0)
+    scores = []
+    for lane in range(num_lanes):
+        others = [l for l in range(num_lanes) if l != lane]
+        ablation = accuracy - subset_accuracy(digitcaps, y, others) if others else accuracy
+        scores.append({'lane': lane, 'ablation': ablation, 'contribution': float(contribution[lane])})
+    return accuracy, scores
+
+
+def greedy_selection(digitcaps, y, scores, target):
+    """
+    Add lanes one at a time, the one giving the best accuracy first (ties broken by ablation score), until the
+    accuracy reaches `target`.
+    :return: the selected lanes in ascending order, and the accuracy after every addition
+    """
+    num_lanes = digitcaps.shape[2]
+    selected, path = [], []
+    while len(selected) < num_lanes:
+        candidates = [lane for lane in range(num_lanes) if lane not in selected]
+        best = max(candidates, key=lambda lane: (subset_accuracy(digitcaps, y, selected + [lane]),
+                                                 scores[lane]['ablation']))
+        selected.append(best)
+        path.append({'lane': best, 'accuracy': subset_accuracy(digitcaps, y, selected)})
+        if path[-1]['accuracy'] >= target:
+            break
+    return sorted(selected), path
+
+
+def prune(model, args, lane_ids, input_shape, n_class):
+    """
+    A LaneCapsNet with only the lanes `lane_ids` of a per-lane model, with their weights and the decoder's.
+    :return: train_model, eval_model, manipulate_model of the pruned LaneCapsNet
+    """
+    pruned = LaneCapsNet(input_shape, n_class, args.routings, num_lanes=args.num_lanes, lanesize=args.lane_size,
+                         lanedepth=args.lane_depth, lanetype=args.lane_type, gpus=0, lane_ids=lane_ids,
+                         lane_layout=args.lane_layout)
+    pruned_model = pruned[0]
+    for layer in pruned_model.layers:
+        if layer.weights and layer.name != 'decoder':
+            layer.set_weights(model.get_layer(layer.name).get_weights())
+
+    # The decoder input is the masked digit capsules flattened, row class*num_lanes + lane
+    weights = model.get_layer('decoder').get_weights()
+    rows = [c * args.num_lanes + lane for c in range(n_class) for lane in lane_ids]
+    weights[0] = weights[0][rows]
+    pruned_model.get_layer('decoder').set_weights(weights)
+    return pruned
+
+
+def _latency(model, x, repeats=10):
+    clf = classifier(model)
+    clf.predict_on_batch(x)
+    latencies = []
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        clf.predict_on_batch(x)
+        latencies.append(time.perf_counter() - begin)
+    return float(np.median(latencies))
+
+
+if __name__ == "__main__":
+    from capsnet import load_mnist, load_cifar
+
+    parser = add_model_arguments(argparse.ArgumentParser(description="Lane importance and pruning"))
+    parser.add_argument('--num_val', default=5000, type=int,
+                        help="Number of test images, from the start, used as validation set to select the lanes. "
+                             "The accuracy is reported on the other test images")
+    parser.add_argument('--max_drop', default=0.005, type=float,
+                        help="Validation accuracy that can be lost by pruning")
+    parser.add_argument('--target_accuracy', default=None, type=float,
+                        help="Validation accuracy to reach, instead of --max_drop")
+    parser.add_argument('--save_dir', default='result/pruned')
+    parser.add_argument('--batch_size', default=100, type=int)
+    args = parser.parse_args()
+
+    input_shape, n_class = DATASETS[args.dataset]
+    _, (x_test, y_test) = load_mnist() if args.dataset == 'mnist' else load_cifar()
+    # Held out from training: the validation set selects the lanes, the rest of the test set reports their accuracy
+    if not 0 < args.num_val < len(x_test):
+        parser.error('--num_val should leave test images to report the accuracy on, the test set has %d' % len(x_test))
+    x_val, y_val = x_test[:args.num_val], y_test[:args.num_val]
+    x_test, y_test = x_test[args.num_val:], y_test[args.num_val:]
+    os.makedirs(args.save_dir, exist_ok=True)
+
+    model, _, _ = build_trained_model(args)
+    model = per_lane_model(model, args)
+    digitcaps = digit_capsules(model, x_val)
+    accuracy, scores = lane_scores(digitcaps, y_val)
+    target = args.target_accuracy if args.target_accuracy is not None else accuracy - args.max_drop
+    lane_ids, path = greedy_selection(digitcaps, y_val, scores, target)
+    for score in sorted(scores, key=lambda s: -s['ablation']):
+        print('[MO833] Lane,%d,Ablation,%.4f,Contribution,%.4f' % (score['lane'], score['ablation'],
+                                                                  score['contribution']))
+
+    pruned_model, _, _ = prune(model, args, lane_ids, input_shape, n_class)
+    pruned_model.save_weights(os.path.join(args.save_dir, 'pruned_model.h5'))
+    export_classifier(pruned_model, os.path.join(args.save_dir, 'classifier'))
+
+    test_caps = digit_capsules(model, x_test)
+    x_batch = x_test[:args.batch_size]
+    report = {'lane_ids': lane_ids, 'num_lanes': args.num_lanes, 'target_accuracy': target,
+              'num_val': len(x_val), 'num_test': len(x_test),
+              'val_accuracy': accuracy, 'pruned_val_accuracy': path[-1]['accuracy'],
+              'test_accuracy': subset_accuracy(test_caps, y_test, list(range(args.num_lanes))),
+              'pruned_test_accuracy': subset_accuracy(test_caps, y_test, lane_ids),
+              'latency': _latency(model, x_batch), 'pruned_latency': _latency(pruned_model, x_batch),
+              'scores': scores, 'greedy_path': path}
+    with open(os.path.join(args.save_dir, 'lanes.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print('[MO833] Lanes,%d/%d,Val acc,%.4f->%.4f,Test acc,%.4f->%.4f,Latency,%.4f->%.4f' %
+          (len(lane_ids), args.num_lanes, accuracy, report['pruned_val_accuracy'], report['test_accuracy'],
+           report['pruned_test_accuracy'], report['latency'], report['pruned_latency']))
+    print('Pruned model saved to \'%s\', lane ids: %s' % (args.save_dir, lane_ids))
@@ -0,0 +1,173 @@
+"""
+tf.data input pipeline for training LaneCapsNet. Batches are streamed shuffled, shift-augmented in parallel and
+prefetched, and under a distribution strategy every worker only reads its own shard of the training set. The pipeline
+holds indices only and reads every batch from the arrays, which can be memory-mapped.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import callbacks
+
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def shift(image, shift_fraction):
+    """
+    Randomly shift an image by up to `shift_fraction` of its size in each direction, filling with zeros.
+    :param image: 3D tensor, shape=[width, height, channels]
+    :param shift_fraction: fraction of pixels to shift at most in each direction
+    :return: a Tensor with same shape as image
+    """
+    height, width, channels = image.shape
+    pad_height, pad_width = int(round(height * shift_fraction)), int(round(width * shift_fraction))
+    padded = tf.pad(image, [[pad_height, pad_height], [pad_width, pad_width], [0, 0]])
+    return tf.image.random_crop(padded, [height, width, channels])
+
+
+def _gather(x, y, n_class):
+    """
+    The function reading a batch of (image, one-hot label) by index. Only the batch is read, so x and y can be
+    memory-mapped (see `datacache.py`) without being copied into the pipeline.
+    """
+    def gather(indices):
+        return x[indices], y[indices]
+
+    def batch(indices):
+        images, labels = tf.numpy_function(gather, [indices], [tf.as_dtype(x.dtype), tf.as_dtype(y.dtype)])
+        images = tf.ensure_shape(tf.cast(images, tf.float32), (None,) + tuple(x.shape[1:]))
+        if y.ndim == 1:
+            labels = tf.one_hot(tf.cast(labels, tf.int32), n_class)
+        return images, tf.ensure_shape(tf.cast(labels, tf.float32), (None, n_class))
+    return batch
+
+
+def _capsnet_batch(x, y):
+    # LaneCapsNet takes [x, y] as inputs and [y, x] as targets
+    return (x, y), (y, x)
+
+
+class _BatchSampler(object):
+    """
+    Batches of indices of a shard, shuffled again every pass over it, of as many indices as asked for every batch.
+    """
+    def __init__(self, indices):
+        self.indices = indices
+        self.order = np.random.permutation(indices)
+        self.position = 0
+
+    def __call__(self, size):
+        batch = []
+        while size > 0:
+            if self.position == len(self.order):
+                self.order, self.position = np.random.permutation(self.indices), 0
+            taken = self.order[self.position:self.position + size]
+            self.position += len(taken)
+            size -= len(taken)
+            batch.append(taken)
+        return np.concatenate(batch)
+
+
+def train_dataset(x, y, batch_size, shift_fraction=0., input_context=None, monitor=None, n_class=None,
+                  local_batch=None):
+    """
+    Training input pipeline: shuffle, shift augmentation, batch and prefetch, repeated forever.
+    :param x: images, shape=[None, width, height, channels]
+    :param y: one-hot labels, shape=[None, n_class], or class ids, shape=[None]
+    :param batch_size: global batch size
+    :param shift_fraction: fraction of pixels to shift at most in each direction, 0 disables augmentation
+    :param input_context: `tf.distribute.InputContext`, when given only this worker's shard is read and the batch size
+        is the per-replica one
+    :param monitor: an `InputWait` callback, told when each batch is handed to the model
+    :param n_class: number of classes, needed when y are class ids
+    :param local_batch: a CPU `tf.Variable`, when given every batch has as many images as it holds when the batch is
+        drawn instead of batch_size, e.g. sized by a `BatchBalancer`. The batches already prefetched keep their size
+    :return: a `tf.data.Dataset` of ((x, y), (y, x)) batches
+    """
+    indices = np.arange(len(x))
+    if input_context is not None:
+        batch_size = input_context.get_per_replica_batch_size(batch_size)
+        if input_context.num_input_pipelines > 1:
+            indices = indices[input_context.input_pipeline_id::input_context.num_input_pipelines]
+
+    if local_batch is None:
+        dataset = tf.data.Dataset.from_tensor_slices(indices)
+        dataset = dataset.shuffle(len(indices), reshuffle_each_iteration=True).repeat()
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+    else:
+        # Drawn one batch at a time, in order, the sampler holding the position in the shard
+        sampler = _BatchSampler(indices)
+        dataset = tf.data.Dataset.from_tensors(0).repeat().map(
+            lambda _: tf.ensure_shape(tf.numpy_function(sampler, [local_batch.read_value()], tf.int64), (None,)))
+    dataset = dataset.map(_gather(x, y, n_class or y.shape[1]), num_parallel_calls=AUTOTUNE)
+    if shift_fraction > 0:
+        dataset = dataset.map(lambda images, labels: (tf.map_fn(lambda image: shift(image, shift_fraction), images),
+                                                      labels), num_parallel_calls=AUTOTUNE)
+    dataset = dataset.map(_capsnet_batch, num_parallel_calls=AUTOTUNE)
+
+    options = tf.data.Options()
+    # Sharded above, the strategy should not shard again
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    dataset = dataset.with_options(options).prefetch(AUTOTUNE)
+
+    if monitor is not None:
+        dataset = dataset.map(monitor.handoff)
+    return dataset
+
+
+def eval_dataset(x, y, batch_size, n_class=None):
+    """
+    Validation input pipeline, without shuffle and augmentation. Sharded by the strategy per batch.
+    """
+    dataset = tf.data.Dataset.from_tensor_slices(np.arange(len(x))).batch(batch_size)
+    dataset = dataset.map(_gather(x, y, n_class or y.shape[1])).map(_capsnet_batch)
+
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    return dataset.with_options(options).prefetch(AUTOTUNE)
+
+
+class InputWait(callbacks.Callback):
+    """
+    Measure how long training waits on the input pipeline. The pipeline marks the time each batch leaves the prefetch
+    buffer; the time from the start of a training step to that mark is time the model spent waiting for input.
+    """
+    def __init__(self, rank=0):
+        super(InputWait, self).__init__()
+        self.rank = rank
+        self.handoff_time = 0.
+        self.batch_begin = 0.
+        self.epoch_wait = 0.
+        self.total_wait = 0.
+        self.batch_wait = 0.
+        self.traced = False
+
+    def _mark(self):
+        self.handoff_time = time.time()
+        return 0.
+
+    def handoff(self, *batch):
+        mark = tf.py_function(self._mark, [], tf.float32)
+        with tf.control_dependencies([mark]):
+            return tf.nest.map_structure(tf.identity, batch)
+
+    def on_train_begin(self, logs=None):
+        self.traced = False
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_wait = 0.
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_begin = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        # The first step also traces the train function before its batch is pulled
+        self.batch_wait = max(0., self.handoff_time - self.batch_begin) if self.traced else 0.
+        self.traced = True
+        self.epoch_wait += self.batch_wait
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.total_wait += self.epoch_wait
+        print(f"\n[MO833] Rank,{self.rank},Epoch,{epoch},Input wait,{self.epoch_wait:.4f}")
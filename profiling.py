@@ -0,0 +1,227 @@
+"""
+Profiler captures of slow training steps, broken down per lane and per layer. `ProfilerTrigger` keeps the step times of
+a rolling window and, when a step takes much longer than a percentile of the window, traces the next few steps with the
+TensorFlow profiler. A capture can also be asked for at any time by sending SIGUSR1 to the worker or by creating the
+flag file `{directory}/profile-now`. Between captures its cost is a comparison per step.
+
+Every trace is broken down by the layer names of LaneCapsNet: `conv1{lane}d{depth}`, `primarycap_*{lane + 1000*depth}`
+and `digitcaps{lane}` (split into the prediction vectors and the routing) are lane layers, `fused_lanes` all the lanes
+together, and the decoder, the optimizer and the input pipeline are shared. Time is the time of the ops of a layer,
+forward and backward, and memory the bytes allocated for their outputs and temporaries.
+
+Usage:
+    python profiling.py result/profiles/0-1    # break down a trace again
+"""
+
+import argparse
+import collections
+import glob
+import json
+import os
+import re
+import signal
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import callbacks
+
+
+# Layer name patterns: (pattern, function from the match to (lane, layer)), lane None for the shared layers
+LAYERS = [
+    (re.compile(r'(?:^|/)conv1(\d+)d(\d+)(?:/|$)'), lambda m: (int(m.group(1)), 'conv1d' + m.group(2))),
+    (re.compile(r'(?:^|/)primarycap_(conv2d|reshape|squash)(\d+)(?:/|$)'),
+     lambda m: (int(m.group(2)) % 1000, 'primarycap_%s_d%d' % (m.group(1), int(m.group(2)) // 1000))),
+    (re.compile(r'(?:^|/)digitcaps(\d+)/einsum(?:/|$)'), lambda m: (int(m.group(1)), 'digitcaps_prediction')),
+    (re.compile(r'(?:^|/)digitcaps(\d+)(?:/|$)'), lambda m: (int(m.group(1)), 'digitcaps_routing')),
+    (re.compile(r'(?:^|/)fused_lanes(?:/|$)'), lambda m: (None, 'fused_lanes')),
+    (re.compile(r'(?:^|/)decoder(?:/|$)'), lambda m: (None, 'decoder')),
+    (re.compile(r'(?:^|/)capsnet(?:/|$)'), lambda m: (None, 'length')),
+    (re.compile(r'(?:^|/)lambda(?:_\d+)?/'), lambda m: (None, 'lambda')),
+    (re.compile(r'^(?:Adam|SGD|RMSprop)/'), lambda m: (None, 'optimizer')),
+    (re.compile(r'Iterator'), lambda m: (None, 'input')),
+]
+
+# Op events are named `op_name:OpType`, the other events are runtime activity
+OP_EVENT = re.compile(r'^([\w./-]+):\w+$')
+
+
+def attribute(op_name):
+    """
+    The lane and layer of a TensorFlow op.
+    :return: (lane, layer), lane None for the layers shared by every lane, layer 'other' when unknown
+    """
+    for pattern, name in LAYERS:
+        match = pattern.search(op_name)
+        if match:
+            return name(match)
+    return None, 'other'
+
+
+def _stats(plane, stats):
+    values = {}
+    for stat in stats:
+        name = plane.stat_metadata[stat.metadata_id].name
+        if stat.HasField('str_value'):
+            values[name] = stat.str_value
+        elif stat.HasField('ref_value'):
+            values[name] = plane.stat_metadata[stat.ref_value].name
+        else:
+            values[name] = stat.int64_value or stat.uint64_value or stat.double_value
+    return values
+
+
+def breakdown(trace_dir):
+    """
+    Per lane and per layer time and memory of the ops in a trace.
+    :param trace_dir: the log directory given to the profiler
+    :return: list of dicts with lane (None for shared layers), layer, ops, time (seconds, summed over the steps of the
+        trace) and allocated bytes, the slowest first
+    """
+    from tensorflow.tsl.profiler.protobuf import xplane_pb2
+
+    paths = sorted(glob.glob(os.path.join(trace_dir, 'plugins', 'profile', '*', '*.xplane.pb')))
+    if not paths:
+        return []
+    space = xplane_pb2.XSpace()
+    with open(paths[-1], 'rb') as f:
+        space.ParseFromString(f.read())
+
+    rows = collections.defaultdict(lambda: {'ops': 0, 'time': 0., 'bytes': 0})
+    for plane in space.planes:
+        for line in plane.lines:
+            for event in line.events:
+                name = plane.event_metadata[event.metadata_id].name
+                if name == 'MemoryAllocation':
+                    stats = _stats(plane, event.stats)
+                    if 'tf_op' in stats:
+                        rows[attribute(stats['tf_op'])]['bytes'] += int(stats.get('allocation_bytes', 0))
+                elif OP_EVENT.match(name):
+                    # Ops run by the threads of the input pipeline are input, whatever their name
+                    row = rows[(None, 'input') if line.name.startswith('tf_data') else
+                               attribute(OP_EVENT.match(name).group(1))]
+                    row['ops'] += 1
+                    row['time'] += event.duration_ps * 1e-12
+    return sorted([dict(lane=lane, layer=layer, **row) for (lane, layer), row in rows.items()],
+                  key=lambda row: -row['time'])
+
+
+class ProfilerTrigger(callbacks.Callback):
+    """
+    Trace `steps` training steps when one takes `factor` times longer than the `percentile` of the last `window` ones,
+    or when asked to (SIGUSR1 or the flag file `{directory}/profile-now`), then write the breakdown of the trace to
+    `{directory}/profile-{rank}-{capture}.json`. The trace itself is in `{directory}/{rank}-{capture}`.
+
+    :param percentile: percentile of the window a step has to exceed, None for on demand captures only
+    :param factor: how many times the percentile a step has to take, so that the usual jitter is not captured
+    :param cooldown: steps after a capture before the next automatic one
+    :param max_captures: maximum number of automatic captures
+    """
+    def __init__(self, directory, rank=0, percentile=99., factor=1.5, window=200, steps=5, cooldown=1000,
+                 max_captures=3):
+        super(ProfilerTrigger, self).__init__()
+        self.directory = directory
+        self.rank = rank
+        self.percentile = percentile
+        self.factor = factor
+        self.steps = steps
+        self.cooldown = cooldown
+        self.max_captures = max_captures
+        self.flag = os.path.join(directory, 'profile-now')
+        self.times = collections.deque(maxlen=window)
+        self.threshold = float('inf')
+        self.measured = 0
+        self.since_capture = cooldown
+        self.automatic = 0
+        self.captures = 0
+        self.capturing = None
+        self.requested = False
+        self.batch_begin = 0.
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._request)
+
+    def _request(self, signum, frame):
+        self.requested = True
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_begin = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step = time.time() - self.batch_begin
+        if self.capturing is not None:
+            self.capturing['steps'] += 1
+            if self.capturing['steps'] >= self.steps:
+                self._stop()
+            return
+
+        self.since_capture += 1
+        reason = None
+        # The flag file is looked for every 10 steps
+        if self.requested or (batch % 10 == 0 and os.path.exists(self.flag)):
+            reason = 'signal' if self.requested else 'flag'
+        elif step > self.threshold and self.since_capture >= self.cooldown and self.automatic < self.max_captures:
+            reason = 'slow_step'
+            self.automatic += 1
+        if reason is not None:
+            self._start(reason, step)
+        # The first step traces the train function
+        elif self.measured > 0 or batch > 0:
+            self.times.append(step)
+            self.measured += 1
+            # Automatic captures start once the window is full
+            if self.percentile is not None and self.measured >= self.times.maxlen and self.measured % 10 == 0:
+                self.threshold = self.factor * float(np.percentile(self.times, self.percentile))
+
+    def on_train_end(self, logs=None):
+        if self.capturing is not None:
+            self._stop()
+
+    def _start(self, reason, step):
+        self.requested = False
+        if os.path.exists(self.flag):
+            os.remove(self.flag)
+        self.captures += 1
+        trace_dir = os.path.join(self.directory, '%d-%d' % (self.rank, self.captures))
+        try:
+            tf.profiler.experimental.start(trace_dir)
+        except (tf.errors.AlreadyExistsError, tf.errors.UnavailableError) as e:
+            # Another profiler session is running, e.g. the TensorBoard callback's
+            print('[MO833] Rank,%d,Profile,%d,Not started,%s' % (self.rank, self.captures, e.message))
+            return
+        self.capturing = {'capture': self.captures, 'reason': reason, 'step_time': step,
+                          'threshold': self.threshold if self.threshold != float('inf') else None,
+                          'trace_dir': trace_dir, 'steps': 0}
+
+    def _stop(self):
+        tf.profiler.experimental.stop()
+        capture, self.capturing = self.capturing, None
+        self.since_capture = 0
+        rows = breakdown(capture['trace_dir'])
+        with open(os.path.join(self.directory, 'profile-%d-%d.json' % (self.rank, capture['capture'])), 'w') as f:
+            json.dump(dict(capture, rank=self.rank, breakdown=rows), f, indent=2)
+        print('[MO833] Rank,%d,Profile,%d,Reason,%s,Step time,%.4f,Steps,%d' %
+              (self.rank, capture['capture'], capture['reason'], capture['step_time'], capture['steps']))
+        print_breakdown(rows, self.rank, capture['capture'])
+
+
+def print_breakdown(rows, rank=0, capture=0, top=20):
+    for row in rows[:top]:
+        print('[MO833] Rank,%d,Profile,%d,Lane,%s,Layer,%s,Ops,%d,Time,%.4f,Bytes,%d' %
+              (rank, capture, 'shared' if row['lane'] is None else row['lane'], row['layer'], row['ops'],
+               row['time'], row['bytes']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per lane and per layer breakdown of a profiler trace")
+    parser.add_argument('trace_dir', help="Log directory of the trace, e.g. result/profiles/0-1")
+    parser.add_argument('--top', default=20, type=int,
+                        help="Number of rows printed")
+    parser.add_argument('--output', default=None,
+                        help="Write the breakdown to this JSON file")
+    args = parser.parse_args()
+
+    rows = breakdown(args.trace_dir)
+    print_breakdown(rows, top=args.top)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
@@ -0,0 +1,169 @@
+"""
+Reduced precision inference for CPU. Converts the classifier of a trained LaneCapsNet (as in export.py) to:
+    int8      TFLite, weights and activations quantized to int8, calibrated on training images. Ops without an int8
+              kernel stay in float
+    float16   TFLite, weights stored as float16
+    bfloat16  Keras, computed in bfloat16 with the `mixed_bfloat16` policy, exported as a SavedModel
+and reports the accuracy, model size and CPU latency of each against the float32 classifier, on the test set of the
+dataset. Sizes are those of the files written to the output directory: the TFLite flatbuffers, and the whole SavedModel
+directory of bfloat16, whose weights are kept in float32.
+
+Usage:
+    python quantize.py -w result/trained_model.h5 --num_lanes 16 --lane_size 8 --modes int8 float16 bfloat16
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import mixed_precision
+
+from export import add_model_arguments, build_trained_model, classifier, export_classifier
+
+
+MODES = ['int8', 'float16', 'bfloat16']
+
+
+def _serving_function(clf):
+    input_shape = list(clf.input_shape[1:])
+    serve = tf.function(lambda x: clf(x, training=False),
+                        input_signature=[tf.TensorSpec([None] + input_shape, tf.float32, name='x')])
+    return serve.get_concrete_function()
+
+
+def convert_tflite(clf, mode='float32', calibration=None):
+    """
+    Convert a classifier to TFLite.
+    :param clf: the classifier of a LaneCapsNet, see `export.classifier`
+    :param mode: 'float32', 'float16' or 'int8'
+    :param calibration: images whose activation ranges calibrate the int8 quantization
+    :return: the TFLite flatbuffer, as bytes
+    """
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([_serving_function(clf)], clf)
+    if mode == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'int8':
+        assert calibration is not None, 'int8 quantization needs calibration images'
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([calibration[i:i + 1]] for i in range(len(calibration)))
+    return converter.convert()
+
+
+def tflite_predictor(flatbuffer, batch_size, num_threads=None):
+    """
+    :return: a function from a batch of at most `batch_size` images to capsule lengths, running `flatbuffer`
+    """
+    interpreter = tf.lite.Interpreter(model_content=flatbuffer, num_threads=num_threads or os.cpu_count())
+    input_index = interpreter.get_input_details()[0]['index']
+    output_index = interpreter.get_output_details()[0]['index']
+    shape = list(interpreter.get_input_details()[0]['shape'])
+
+    def predict(x):
+        if len(x) != shape[0]:
+            shape[0] = len(x)
+            interpreter.resize_tensor_input(input_index, shape)
+            interpreter.allocate_tensors()
+        interpreter.set_tensor(input_index, x)
+        interpreter.invoke()
+        return interpreter.get_tensor(output_index)
+
+    interpreter.resize_tensor_input(input_index, [batch_size] + shape[1:])
+    interpreter.allocate_tensors()
+    shape[0] = batch_size
+    return predict
+
+
+def _directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def build_bfloat16_classifier(args, export_dir):
+    """
+    The classifier of the LaneCapsNet described by `args`, with its trained weights, computing in bfloat16. Weights are
+    kept in float32 and cast when used. It is exported to `export_dir`, see `export.export_classifier`.
+    :return: a function from a batch of images to capsule lengths, bytes of the exported SavedModel on disk
+    """
+    policy = mixed_precision.global_policy()
+    mixed_precision.set_global_policy('mixed_bfloat16')
+    try:
+        model, _, _ = build_trained_model(args)
+    finally:
+        mixed_precision.set_global_policy(policy)
+    clf = classifier(model)
+    export_classifier(model, export_dir)
+    return lambda x: clf.predict_on_batch(x).astype(np.float32), _directory_bytes(export_dir)
+
+
+def evaluate(predict, x, y, batch_size):
+    """
+    :return: accuracy of `predict` on (x, y), median latency of a batch of `batch_size` images
+    """
+    correct, latencies = 0, []
+    predict(x[:batch_size])  # warm up
+    for i in range(0, len(x) - batch_size + 1, batch_size):
+        begin = time.perf_counter()
+        y_pred = predict(x[i:i + batch_size])
+        latencies.append(time.perf_counter() - begin)
+        correct += np.sum(np.argmax(y_pred, 1) == np.argmax(y[i:i + batch_size], 1))
+    return correct / (len(latencies) * batch_size), float(np.median(latencies))
+
+
+def quantize(args, data, modes):
+    """
+    Convert the trained classifier to every mode and compare them with the float32 classifier.
+    :param data: ((x_train, y_train), (x_test, y_test))
+    :return: list of dicts with mode, accuracy, accuracy_delta, size_bytes and latency of every model
+    """
+    (x_train, _), (x_test, y_test) = data
+    x_test, y_test = x_test[:args.num_test], y_test[:args.num_test]
+    calibration = x_train[np.random.RandomState(0).choice(len(x_train), args.calibration, replace=False)]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    model, _, _ = build_trained_model(args)
+    clf = classifier(model)
+    # The float32 TFLite model is the size reference of the converted ones
+    size = len(convert_tflite(clf, 'float32'))
+    accuracy, latency = evaluate(clf.predict_on_batch, x_test, y_test, args.batch_size)
+    results = [{'mode': 'float32', 'accuracy': accuracy, 'accuracy_delta': 0., 'size_bytes': size,
+                'latency': latency}]
+
+    for mode in modes:
+        if mode == 'bfloat16':
+            predict, size = build_bfloat16_classifier(args, os.path.join(args.output_dir, 'classifier-bfloat16'))
+        else:
+            flatbuffer = convert_tflite(clf, mode, calibration)
+            path = os.path.join(args.output_dir, 'classifier-%s.tflite' % mode)
+            with open(path, 'wb') as f:
+                f.write(flatbuffer)
+            predict, size = tflite_predictor(flatbuffer, args.batch_size), len(flatbuffer)
+        accuracy, latency = evaluate(predict, x_test, y_test, args.batch_size)
+        results.append({'mode': mode, 'accuracy': accuracy, 'accuracy_delta': accuracy - results[0]['accuracy'],
+                        'size_bytes': size, 'latency': latency})
+
+    for result in results:
+        print('[MO833] Mode,%s,Accuracy,%.4f,Delta,%.4f,Size,%d,Latency,%.4f' %
+              (result['mode'], result['accuracy'], result['accuracy_delta'], result['size_bytes'], result['latency']))
+    with open(os.path.join(args.output_dir, 'quantize.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    from capsnet import load_mnist, load_cifar
+
+    parser = add_model_arguments(argparse.ArgumentParser(description="Reduced precision LaneCapsNet classifiers"))
+    parser.add_argument('--modes', default=MODES, nargs='+', choices=MODES)
+    parser.add_argument('--output_dir', default='result/quantized',
+                        help="Where the TFLite models, the bfloat16 SavedModel and the report are written")
+    parser.add_argument('--calibration', default=500, type=int,
+                        help="Number of training images calibrating the int8 quantization")
+    parser.add_argument('--num_test', default=10000, type=int,
+                        help="Number of test images evaluated")
+    parser.add_argument('--batch_size', default=100, type=int)
+    args = parser.parse_args()
+
+    quantize(args, load_mnist() if args.dataset == 'mnist' else load_cifar(), args.modes)
@@ -0,0 +1,226 @@
+"""
+Hyperparameter sweeps of capsnet.py on one multi-core host. The runs of a grid or random search spec are scheduled
+`--parallel` at a time, each one pinned to its own `--cores_per_run` cores with as many TensorFlow threads, training
+as a single worker in its own directory `sweep_dir/runs/<run id>`. The accuracy, step time, number of parameters and
+peak memory of every run (its `summary.json`) are aggregated into `sweep_dir/results.csv`.
+
+A sweep can be stopped and started again: finished runs are skipped and interrupted ones resume from their last
+checkpoint.
+
+Spec, as JSON, with the arguments of capsnet.py:
+    {"grid": {"num_lanes": [2, 4, 8], "lane_size": [1, 2, 4]},
+     "fixed": {"epochs": 10, "dataset": "mnist"}}
+    {"random": {"num_lanes": [4, 8, 16], "lr": {"log_uniform": [1e-4, 1e-2]}, "batch_size": {"int_uniform": [32, 128]}},
+     "samples": 20, "seed": 0, "fixed": {"epochs": 10}}
+
+Usage:
+    python sweep.py --spec spec.json --sweep_dir sweeps/lanes --parallel 4 --cores_per_run 4
+    python sweep.py --sweep_dir sweeps/lanes --parallel 4 --cores_per_run 4    # resume
+"""
+
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+# Columns of the results table taken from the summary of a run
+RESULTS = ['val_capsnet_accuracy', 'step_time', 'params', 'peak_rss_mb', 'elapsed']
+
+
+def _sample(values, rng):
+    if isinstance(values, list):
+        return values[rng.randint(len(values))]
+    (distribution, (low, high)), = values.items()
+    if distribution == 'uniform':
+        return float(rng.uniform(low, high))
+    if distribution == 'log_uniform':
+        return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    if distribution == 'int_uniform':
+        return int(rng.randint(low, high + 1))
+    raise ValueError('Unknown distribution %s' % distribution)
+
+
+def expand(spec):
+    """
+    The runs of a sweep spec, in a stable order.
+    :return: list of dicts of capsnet.py arguments, the swept ones and the fixed ones
+    """
+    fixed = spec.get('fixed', {})
+    if 'grid' in spec:
+        grid = spec['grid']
+        swept = [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+    elif 'random' in spec:
+        rng = np.random.RandomState(spec.get('seed', 0))
+        swept = [{name: _sample(values, rng) for name, values in spec['random'].items()}
+                 for _ in range(spec['samples'])]
+    else:
+        raise ValueError('A sweep spec has a "grid" or a "random" search')
+    return [dict(fixed, **params) for params in swept]
+
+
+def run_id(params):
+    """
+    A short name of a run, the same for the same arguments.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+
+
+def command(params, run_dir):
+    """
+    The capsnet.py command line of a run. Interrupted runs resume from their checkpoints.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'capsnet.py')
+    arguments = [sys.executable, script, '--save_dir', run_dir, '--tf_config', '']
+    for name, value in sorted(params.items()):
+        if isinstance(value, bool):
+            arguments += ['--' + name] if value else []
+        elif isinstance(value, list):
+            arguments += ['--' + name] + [str(v) for v in value]
+        else:
+            arguments += ['--' + name, str(value)]
+    if os.path.isdir(os.path.join(run_dir, 'checkpoints')):
+        arguments += ['--load_dir', os.path.join(run_dir, 'checkpoints')]
+    return arguments
+
+
+def launch(params, run_dir, cores):
+    """
+    Start a run pinned to `cores`, with as many intra-op threads, its output written to `run_dir/log.txt`.
+    :return: the process
+    """
+    env = dict(os.environ, TF_NUM_INTRAOP_THREADS=str(len(cores)), TF_NUM_INTEROP_THREADS='1',
+               OMP_NUM_THREADS=str(len(cores)))
+    # Runs are single workers, whatever the environment of the sweep
+    env.pop('TF_CONFIG', None)
+    pin = (lambda: os.sched_setaffinity(0, cores)) if hasattr(os, 'sched_setaffinity') else None
+    with open(os.path.join(run_dir, 'log.txt'), 'a') as log:
+        return subprocess.Popen(command(params, run_dir), stdout=log, stderr=subprocess.STDOUT, env=env,
+                                preexec_fn=pin, cwd=run_dir)
+
+
+def run_sweep(runs, sweep_dir, parallel, cores_per_run):
+    """
+    Run every run not finished yet, `parallel` at a time. Run p of the ones running together gets cores
+    [p*cores_per_run, (p+1)*cores_per_run).
+    :param runs: list of dicts of capsnet.py arguments, see `expand`
+    :return: dict of run id: exit status of the runs started
+    """
+    pending = []
+    for params in runs:
+        run_dir = os.path.abspath(os.path.join(sweep_dir, 'runs', run_id(params)))
+        os.makedirs(run_dir, exist_ok=True)
+        with open(os.path.join(run_dir, 'params.json'), 'w') as f:
+            json.dump(params, f, indent=2)
+        if not os.path.exists(os.path.join(run_dir, 'summary.json')):
+            pending.append((run_id(params), params, run_dir))
+    print('[MO833] Sweep,%s,Runs,%d,Done,%d,Pending,%d' % (sweep_dir, len(runs), len(runs) - len(pending),
+                                                            len(pending)))
+
+    slots = [[c % (os.cpu_count() or 1) for c in range(p * cores_per_run, (p + 1) * cores_per_run)]
+             for p in range(parallel)]
+    running, statuses = {}, {}
+    try:
+        while pending or running:
+            for slot in range(parallel):
+                if slot not in running and pending:
+                    name, params, run_dir = pending.pop(0)
+                    running[slot] = (name, launch(params, run_dir, slots[slot]), time.time())
+                    print('[MO833] Run,%s,Started,Cores,%s' % (name, '-'.join(str(c) for c in slots[slot])))
+            time.sleep(1)
+            for slot, (name, process, begin) in list(running.items()):
+                if process.poll() is not None:
+                    del running[slot]
+                    statuses[name] = process.returncode
+                    print('[MO833] Run,%s,Status,%d,Time,%.1f' % (name, process.returncode, time.time() - begin))
+    finally:
+        # Interrupted runs resume from their checkpoints the next time
+        for name, process, _ in running.values():
+            process.terminate()
+            process.wait()
+    return statuses
+
+
+def aggregate(runs, sweep_dir):
+    """
+    Write the results table of the sweep to `sweep_dir/results.csv`, one row per run with its swept arguments and
+    `RESULTS`, empty for runs not finished. A finished run without a validation accuracy, or without a step time when
+    it resumed after its last step, has None, written empty.
+    :return: the rows, as dicts
+    """
+    names = sorted(set(itertools.chain(*runs)))
+    rows = []
+    for params in runs:
+        row = dict({name: params.get(name, '') for name in names}, run=run_id(params), done=False)
+        path = os.path.join(sweep_dir, 'runs', row['run'], 'summary.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                summary = json.load(f)
+            row.update(done=True, params=summary['params'], step_time=summary['step_time'],
+                       peak_rss_mb=summary['peak_rss_mb'], elapsed=summary['elapsed'],
+                       val_capsnet_accuracy=summary['metrics'].get('val_capsnet_accuracy'))
+        rows.append(row)
+    with open(os.path.join(sweep_dir, 'results.csv'), 'w') as f:
+        writer = csv.DictWriter(f, ['run', 'done'] + names + RESULTS, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+def _rank(row):
+    # Best validation accuracy first, then the finished runs without one, then the runs not finished
+    if not row['done']:
+        return 2, 0.
+    if row['val_capsnet_accuracy'] is None:
+        return 1, 0.
+    return 0, -row['val_capsnet_accuracy']
+
+
+def print_results(rows):
+    for row in sorted(rows, key=_rank):
+        if not row['done']:
+            print('[MO833] Run,%s,Not done' % row['run'])
+            continue
+        accuracy, step_time = row['val_capsnet_accuracy'], row['step_time']
+        print('[MO833] Run,%s,Val acc,%s,Step time,%s,Params,%d,Peak RSS,%.1f' %
+              (row['run'], 'missing' if accuracy is None else '%.4f' % accuracy,
+               'missing' if step_time is None else '%.4f' % step_time, row['params'], row['peak_rss_mb']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hyperparameter sweeps of capsnet.py")
+    parser.add_argument('--spec', default=None,
+                        help="JSON sweep spec. Without it, resumes the sweep in --sweep_dir")
+    parser.add_argument('--sweep_dir', default='result/sweep')
+    parser.add_argument('--parallel', default=2, type=int,
+                        help="Number of runs at a time")
+    parser.add_argument('--cores_per_run', default=None, type=int,
+                        help="Cores and intra-op threads of every run, all the cores split between the parallel runs "
+                             "by default")
+    args = parser.parse_args()
+
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    spec_path = os.path.join(args.sweep_dir, 'spec.json')
+    if args.spec is not None:
+        with open(args.spec) as f:
+            spec = json.load(f)
+        with open(spec_path, 'w') as f:
+            json.dump(spec, f, indent=2)
+    else:
+        with open(spec_path) as f:
+            spec = json.load(f)
+    cores_per_run = args.cores_per_run or max(1, (os.cpu_count() or 1) // args.parallel)
+
+    runs = expand(spec)
+    statuses = run_sweep(runs, args.sweep_dir, args.parallel, cores_per_run)
+    print_results(aggregate(runs, args.sweep_dir))
+    print('Results written to \'%s\'' % os.path.join(args.sweep_dir, 'results.csv'))
+    if any(statuses.values()):
+        sys.exit(1)
@@ -0,0 +1,283 @@
+"""
+Low-overhead training telemetry: constant-memory streaming statistics and a callback that times the phases of every
+training step (data wait, forward/backward, checkpoint) and validation, tagged by worker, buffered to a CSV file.
+"""
+
+import json
+import math
+import os
+import time
+
+from tensorflow.keras import callbacks
+
+
+class RunningStats(object):
+    """
+    Streaming count, mean, variance, min and max of a series (Welford's algorithm), in constant memory.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+
+    @property
+    def variance(self):
+        """
+        Population variance.
+        """
+        return self.m2 / self.count if self.count > 0 else 0.
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class QuantileSketch(object):
+    """
+    Streaming quantiles with relative error `alpha`: values are counted in logarithmic buckets, so memory only depends
+    on the range of the values, and is capped at `max_buckets` by merging the lowest buckets.
+    """
+    def __init__(self, alpha=0.01, max_buckets=2048):
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, x):
+        self.count += 1
+        if x <= 0:
+            self.zeros += 1
+            return
+        key = int(math.ceil(math.log(x) / self.log_gamma))
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            lowest, second = sorted(self.buckets)[:2]
+            self.buckets[second] += self.buckets.pop(lowest)
+
+    def quantile(self, q):
+        """
+        :param q: quantile in [0, 1]
+        :return: estimate of the q-quantile, 0 if empty
+        """
+        if self.count == 0:
+            return 0.
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                # Middle of the bucket (gamma^(key-1), gamma^key]
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class PhaseStats(object):
+    """
+    Running statistics and quantiles of the durations of one phase.
+    """
+    def __init__(self):
+        self.stats = RunningStats()
+        self.sketch = QuantileSketch()
+
+    def add(self, x):
+        self.stats.add(x)
+        self.sketch.add(x)
+
+    def summary(self):
+        return {'count': self.stats.count, 'mean': self.stats.mean, 'std': self.stats.std,
+                'min': self.stats.min if self.stats.count else 0., 'max': self.stats.max if self.stats.count else 0.,
+                'p50': self.sketch.quantile(0.5), 'p90': self.sketch.quantile(0.9), 'p99': self.sketch.quantile(0.99)}
+
+
+def significant_digit(x):
+    """
+    The first significant digit of a positive number and its decimal position, e.g. 0.0057 -> (5, 3), 0.3 -> (3, 1).
+    Read from the decimal representation, dividing by a power of ten truncates 0.3 to 2.9999... -> 2.
+    """
+    mantissa, exponent = ('%e' % x).split('e')
+    return int(mantissa[0]), -int(exponent)
+
+
+class Telemetry(callbacks.Callback):
+    """
+    Time every training step and split it into phases: waiting on input (from an `InputWait` callback), forward/backward
+    and checkpointing (from an `AsyncCheckpoint` callback); and time validation. One row per step, and one with batch -1
+    per validation, is buffered and appended to `{directory}/telemetry-{rank}.csv` every `flush_every` rows or
+    `flush_secs` seconds, and a summary of every phase is written to `{directory}/telemetry-{rank}.json` at the end of
+    training.
+    Should come after the `InputWait` and `AsyncCheckpoint` callbacks in the callback list.
+
+    :param directory: where the telemetry files are written
+    :param rank: worker tag of every row
+    """
+    PHASES = ['step', 'data_wait', 'compute', 'checkpoint', 'validation']
+
+    def __init__(self, directory, rank=0, input_wait=None, checkpoint=None, flush_every=1000, flush_secs=30.):
+        super(Telemetry, self).__init__()
+        self.rank = rank
+        self.input_wait = input_wait
+        self.checkpoint = checkpoint
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        self.path = os.path.join(directory, 'telemetry-%d' % rank)
+        self.phases = {phase: PhaseStats() for phase in self.PHASES}
+        self.rows = []
+        self.last_flush = time.time()
+        self.epoch = 0
+        self.batch_begin = 0.
+        self.test_begin = 0.
+        self.checkpoint_time = 0.
+        if not os.path.exists(self.path + '.csv'):
+            with open(self.path + '.csv', 'w') as f:
+                f.write('rank,epoch,batch,' + ','.join(self.PHASES) + '\n')
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_begin = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step = time.time() - self.batch_begin
+        data_wait = self.input_wait.batch_wait if self.input_wait is not None else 0.
+        checkpoint = 0.
+        if self.checkpoint is not None:
+            checkpoint = self.checkpoint.blocking_time - self.checkpoint_time
+            self.checkpoint_time = self.checkpoint.blocking_time
+        compute = max(0., step - data_wait - checkpoint)
+
+        self.phases['step'].add(step)
+        self.phases['data_wait'].add(data_wait)
+        self.phases['compute'].add(compute)
+        if checkpoint > 0:
+            self.phases['checkpoint'].add(checkpoint)
+        self._row(batch, step, data_wait, compute, checkpoint, 0.)
+
+    def on_test_begin(self, logs=None):
+        self.test_begin = time.time()
+
+    def on_test_end(self, logs=None):
+        validation = time.time() - self.test_begin
+        self.phases['validation'].add(validation)
+        self._row(-1, 0., 0., 0., 0., validation)
+
+    def on_train_end(self, logs=None):
+        self.flush()
+        summary = {phase: stats.summary() for phase, stats in self.phases.items()}
+        with open(self.path + '.json', 'w') as f:
+            json.dump({'rank': self.rank, 'phases': summary}, f)
+        for phase in self.PHASES:
+            s = summary[phase]
+            print(f"[MO833] Rank,{self.rank},Phase,{phase},Count,{s['count']},Mean,{s['mean']:.4f},Std,{s['std']:.4f},"
+                  f"P50,{s['p50']:.4f},P90,{s['p90']:.4f},P99,{s['p99']:.4f}")
+
+    def _row(self, batch, *seconds):
+        self.rows.append('%d,%d,%d,' % (self.rank, self.epoch, batch) + ','.join('%.6f' % s for s in seconds))
+        if len(self.rows) >= self.flush_every or time.time() - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            with open(self.path + '.csv', 'a') as f:
+                f.write('\n'.join(self.rows) + '\n')
+            self.rows = []
+        self.last_flush = time.time()
+
+
+class RoutingIterations(callbacks.Callback):
+    """
+    Routing iterations used in every training step by every layer with adaptive routing, recovered from the running
+    means of their `{layer}_routings` metrics. Written to `{directory}/routings-{rank}.csv` (one row per step and layer)
+    at the end of every epoch, with a per-layer summary and histogram in `{directory}/routings-{rank}.json` at the end
+    of training.
+    """
+    def __init__(self, directory, rank=0):
+        super(RoutingIterations, self).__init__()
+        self.rank = rank
+        self.path = os.path.join(directory, 'routings-%d' % rank)
+        self.stats = {}
+        self.histograms = {}
+        self.means = {}
+        self.rows = []
+        self.epoch = 0
+        if not os.path.exists(self.path + '.csv'):
+            with open(self.path + '.csv', 'w') as f:
+                f.write('rank,epoch,batch,layer,iterations\n')
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        # Metrics are reset at every epoch
+        self.means = {}
+
+    def on_train_batch_end(self, batch, logs=None):
+        for key, mean in (logs or {}).items():
+            if not key.endswith('_routings'):
+                continue
+            layer = key[:-len('_routings')]
+            # The mean of the first batch+1 steps, without the mean of the first batch steps
+            iterations = float(mean) * (batch + 1) - self.means.get(layer, 0.) * batch
+            self.means[layer] = float(mean)
+            self.stats.setdefault(layer, RunningStats()).add(iterations)
+            histogram = self.histograms.setdefault(layer, {})
+            histogram[int(round(iterations))] = histogram.get(int(round(iterations)), 0) + 1
+            self.rows.append('%d,%d,%d,%s,%.2f' % (self.rank, self.epoch, batch, layer, iterations))
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.rows:
+            with open(self.path + '.csv', 'a') as f:
+                f.write('\n'.join(self.rows) + '\n')
+            self.rows = []
+
+    def on_train_end(self, logs=None):
+        summary = {layer: {'count': s.count, 'mean': s.mean, 'std': s.std, 'min': s.min, 'max': s.max,
+                           'histogram': {str(k): v for k, v in sorted(self.histograms[layer].items())}}
+                   for layer, s in self.stats.items()}
+        with open(self.path + '.json', 'w') as f:
+            json.dump({'rank': self.rank, 'layers': summary}, f)
+        for layer, s in sorted(summary.items()):
+            print(f"[MO833] Rank,{self.rank},Layer,{layer},Routings mean,{s['mean']:.2f},Min,{s['min']:.0f},"
+                  f"Max,{s['max']:.0f}")
+
+
+class StartupTimer(object):
+    """
+    Wall time of the consecutive phases of the startup of a run, each one ending with a call to `lap`.
+
+    :param begin: when startup began, e.g. before the imports
+    """
+    def __init__(self, begin):
+        self.last = begin
+        self.phases = []
+        self.done = False
+
+    def lap(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, rank=0, directory=None):
+        """
+        Print the phases and write them to `{directory}/startup-{rank}.json`. Ends the startup.
+        """
+        self.done = True
+        total = sum(seconds for _, seconds in self.phases)
+        for phase, seconds in self.phases:
+            print(f"[MO833] Rank,{rank},Startup,{phase},Time,{seconds:.4f}")
+        print(f"[MO833] Rank,{rank},Startup,total,Time,{total:.4f}")
+        if directory is not None:
+            with open(os.path.join(directory, 'startup-%d.json' % rank), 'w') as f:
+                json.dump({'rank': rank, 'phases': dict(self.phases), 'total': total}, f)
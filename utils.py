@@ -1,10 +1,9 @@
 import numpy as np
-from matplotlib import pyplot as plt
-import csv
 import math
-import pandas
 
 def plot_log(filename, show=True):
+    from matplotlib import pyplot as plt
+    import pandas
 
     data = pandas.read_csv(filename)
 
@@ -30,6 +29,11 @@ def plot_log(filename, show=True):
 
 
 def combine_images(generated_images, height=None, width=None):
+    """
+    Tile images into a grid of `height` rows and `width` columns, row by row, the missing tiles being zeros.
+    :param generated_images: shape=[num, rows, cols] or [num, rows, cols, channels]
+    :return: shape=[height*rows, width*cols] for single channel images, [height*rows, width*cols, channels] otherwise
+    """
     num = generated_images.shape[0]
     if width is None and height is None:
         width = int(math.sqrt(num))
@@ -39,15 +43,16 @@ def combine_images(generated_images, height=None, width=None):
     elif height is not None and width is None:  # width not given
         width = int(math.ceil(float(num)/height))
 
-    shape = generated_images.shape[1:3]
-    image = np.zeros((height*shape[0], width*shape[1]),
-                     dtype=generated_images.dtype)
-    for index, img in enumerate(generated_images):
-        i = int(index/width)
-        j = index % width
-        image[i*shape[0]:(i+1)*shape[0], j*shape[1]:(j+1)*shape[1]] = \
-            img[:, :, 0]
-    return image
+    rows, cols = generated_images.shape[1:3]
+    images = generated_images.reshape(num, rows, cols, -1)[:height*width]
+    channels = images.shape[3]
+    if len(images) < height*width:
+        images = np.concatenate([images, np.zeros((height*width - len(images), rows, cols, channels),
+                                                  dtype=images.dtype)])
+    # [height, width, rows, cols, channels] -> [height, rows, width, cols, channels]
+    image = images.reshape(height, width, rows, cols, channels).transpose(0, 2, 1, 3, 4)
+    image = image.reshape(height*rows, width*cols, channels)
+    return image[:, :, 0] if channels == 1 else image
 
 if __name__=="__main__":
     plot_log('result/log.csv')